@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from .convert import run_job
+from .fileio import atomic_write
+
+# Command line batch converter, runs without blender:
+#   python -m mc2_map_toolkit tex texture_x -o out/textures
+#   python -m mc2_map_toolkit xmod city/la/models -o out/models --format gltf
+#   python -m mc2_map_toolkit to-json city/la/hoods -o out/json
+#   python -m mc2_map_toolkit from-json out/json -o city/la/hoods
+# Inputs are files or directories searched recursively, files are spread over a pool of worker processes
+
+COMMANDS = {
+    # command: (input extensions, help)
+    'tex': (('.tex',), "Convert .tex textures to PNG"),
+    'xmod': (('.xmod',), "Convert .xmod models (with their .xbcpv colors) to glTF or OBJ"),
+    'to-json': (('.hood', '.prop'), "Convert .hood and .prop files to JSON"),
+    'from-json': (('.json',), "Convert JSON files made by to-json back to .hood and .prop files"),
+}
+
+def find_files(inputs, extensions):
+    # (file, directory outputs are placed relative to) of every matching input file
+    files = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend((os.path.join(root, name), path) for name in sorted(names)
+                             if name.lower().endswith(extensions))
+        elif os.path.isfile(path):
+            files.append((path, os.path.dirname(path)))
+        else:
+            print('Input not found: ' + path, file = sys.stderr)
+    return files
+
+def output_path(src, base_dir, output_dir, command, args):
+    if output_dir is None:
+        dst = src # Next to the source file
+    else:
+        dst = os.path.join(output_dir, os.path.relpath(src, base_dir or '.'))
+
+    if command == 'tex':
+        return os.path.splitext(dst)[0] + '.png'
+    if command == 'xmod':
+        return os.path.splitext(dst)[0] + '.' + args.format
+    if command == 'to-json':
+        return dst + '.json' # example.hood.json, from-json strips the .json again
+    return os.path.splitext(dst)[0] # from_json adds the extension of the format when there is none left
+
+def make_jobs(command, args):
+    jobs = []
+    for src, base_dir in find_files(args.inputs, COMMANDS[command][0]):
+        dst = output_path(src, base_dir, args.output, command, args)
+        if command == 'tex':
+            jobs.append(('tex', src, dst, {'mip_level': args.mip_level}))
+        elif command == 'xmod':
+            jobs.append((args.format, src, dst, {'use_cpv': not args.no_cpv}))
+        else:
+            jobs.append((command, src, dst, {}))
+
+    # Largest files first, so a big file picked up last doesn't keep one worker busy after the rest are done
+    jobs.sort(key = lambda job: os.path.getsize(job[1]), reverse = True)
+    return jobs
+
+def run_jobs(jobs, processes, quiet = False):
+    results = []
+    start = time.perf_counter()
+
+    if processes > 1 and len(jobs) > 1:
+        chunksize = max(1, min(16, len(jobs) // (processes * 8)))
+        with multiprocessing.Pool(processes) as pool:
+            for result in pool.imap_unordered(run_job, jobs, chunksize):
+                results.append(result)
+                report_progress(result, len(results), len(jobs), quiet)
+    else:
+        for job in jobs:
+            results.append(run_job(job))
+            report_progress(results[-1], len(results), len(jobs), quiet)
+
+    return results, time.perf_counter() - start
+
+def report_progress(result, done, total, quiet):
+    src, dst, error, trace = result
+    if error is not None:
+        print('[%d/%d] FAILED %s: %s' % (done, total, src, error), file = sys.stderr)
+    elif not quiet:
+        print('[%d/%d] %s -> %s' % (done, total, src, dst), file = sys.stderr)
+
+def write_report(filepath, command, results, elapsed):
+    report = {
+        'command': command,
+        'seconds': round(elapsed, 3),
+        'converted': [{'source': src, 'output': dst} for src, dst, error, trace in results if error is None],
+        'failed': [{'source': src, 'error': error, 'traceback': trace} for src, dst, error, trace in results if error is not None],
+    }
+    atomic_write(filepath, json.dumps(report, indent = 1))
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog = 'python -m mc2_map_toolkit', description = "Batch convert MC2 assets without blender")
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+    for command, (extensions, help) in COMMANDS.items():
+        sub = subparsers.add_parser(command, help = help, description = help)
+        sub.add_argument('inputs', nargs = '+', help = "Files or directories (searched recursively for %s files)" % ', '.join(extensions))
+        sub.add_argument('-o', '--output', help = "Output directory, directory inputs keep their layout in it. Defaults to next to each input file")
+        sub.add_argument('-j', '--jobs', type = int, default = os.cpu_count() or 1, help = "Worker processes (default: cpu count)")
+        sub.add_argument('--report', help = "Write a JSON report of converted and failed files")
+        sub.add_argument('-q', '--quiet', action = 'store_true', help = "Only print failures and the summary")
+        if command == 'tex':
+            sub.add_argument('--mip-level', type = int, default = 0, help = "Mip level to write, each level halves the resolution")
+        elif command == 'xmod':
+            sub.add_argument('--format', choices = ('gltf', 'obj'), default = 'gltf')
+            sub.add_argument('--no-cpv', action = 'store_true', help = "Ignore .xbcpv files, use the xmod vertex colors")
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    args = parse_args(argv)
+    jobs = make_jobs(args.command, args)
+    if not jobs:
+        print('No input files found', file = sys.stderr)
+        return 1
+
+    results, elapsed = run_jobs(jobs, max(1, args.jobs), args.quiet)
+    failed = [result for result in results if result[2] is not None]
+    print('Converted %d of %d files in %.1fs, %d failed' % (len(results) - len(failed), len(results), elapsed, len(failed)), file = sys.stderr)
+
+    if args.report:
+        write_report(args.report, args.command, results, elapsed)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import shutil
+import threading
+from .manifest import hash_file
+from .fileio import atomic_open, atomic_write, fsync_dirs, make_dirs
+from .catalog import list_files
+
+# Versioned backups of a map's game files in city/<map>/backup. File contents are stored once,
+# keyed by hash, under objects/, and every export run that overwrites files writes a snapshot:
+# snapshots/<id>.json = {'time': ..., 'files': {file name: hash}}, the content those files had before that run
+
+SNAPSHOT_ID_FORMAT = '%06d'
+
+class BackupStore:
+    def __init__(self, city_path):
+        self.city_path = city_path
+        self.backup_path = os.path.join(city_path, 'backup')
+        self.objects_path = os.path.join(self.backup_path, 'objects')
+        self.snapshots_path = os.path.join(self.backup_path, 'snapshots')
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_path, digest[:2], digest)
+
+    def store_file(self, fp):
+        # Add the current content of a file to the store, content that's already stored costs nothing.
+        # The object is on disk when this returns, before the export replaces the file it came from
+        digest = hash_file(fp)
+        obj_fp = self.object_path(digest)
+        if not os.path.exists(obj_fp) or os.path.getsize(obj_fp) != os.path.getsize(fp): # Size catches objects cut short by a crash
+            make_dirs(os.path.dirname(obj_fp))
+            # A copy, not a link, anything that rewrites the game file in place would change the stored object too
+            with open(fp, 'rb') as src, atomic_open(obj_fp, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        return digest
+
+    def list_snapshots(self):
+        if not os.path.isdir(self.snapshots_path):
+            return []
+        return sorted(f[:-5] for f in os.listdir(self.snapshots_path) if f.endswith('.json'))
+
+    def load_snapshot(self, snapshot_id):
+        with open(os.path.join(self.snapshots_path, snapshot_id + '.json'), 'r') as file:
+            return json.load(file)
+
+    def save_snapshot(self, files, snapshot_time = None):
+        snapshots = self.list_snapshots()
+        snapshot_id = SNAPSHOT_ID_FORMAT % (int(snapshots[-1]) + 1 if snapshots else 0)
+        make_dirs(self.snapshots_path)
+        snapshot = {'time': time.time() if snapshot_time is None else snapshot_time, 'files': files}
+        atomic_write(os.path.join(self.snapshots_path, snapshot_id + '.json'), json.dumps(snapshot, indent = 1))
+        return snapshot_id
+
+    def has_backups(self):
+        # Polled on every panel redraw, answered from the catalog without touching the disk
+        return bool(list_files(self.snapshots_path, '.json')) or bool(list_files(self.backup_path))
+
+    def legacy_files(self):
+        # Plain copies of original files written by older versions into the backup folder
+        if not os.path.isdir(self.backup_path):
+            return []
+        return [f for f in os.listdir(self.backup_path) if os.path.isfile(os.path.join(self.backup_path, f))]
+
+    def migrate_legacy(self):
+        # Move legacy copies into the store as the first snapshot
+        legacy = self.legacy_files()
+        if not legacy or self.list_snapshots():
+            return
+        files = {f: self.store_file(os.path.join(self.backup_path, f)) for f in legacy}
+        self.save_snapshot(files, 0)
+        # Removed once the objects and the snapshot pointing at them are on disk
+        for f in legacy:
+            os.remove(os.path.join(self.backup_path, f))
+
+    def restore_state(self, snapshot_id):
+        # Content every file had before the chosen run: its earliest backup from that run on.
+        # Files not backed up since weren't overwritten by an export and are left alone
+        files = {}
+        for later_id in self.list_snapshots():
+            if later_id >= snapshot_id:
+                for name, digest in self.load_snapshot(later_id)['files'].items():
+                    files.setdefault(name, digest)
+        return files
+
+    def restore(self, snapshot_id):
+        # Only touch files whose current content differs from the snapshot, returns the restored file names.
+        # Every object is checked against its hash first, a damaged backup leaves all files alone
+        changed = {}
+        for name, digest in self.restore_state(snapshot_id).items():
+            fp = os.path.join(self.city_path, name)
+            if os.path.exists(fp) and hash_file(fp) == digest:
+                continue
+            obj_fp = self.object_path(digest)
+            if not os.path.exists(obj_fp) or hash_file(obj_fp) != digest:
+                raise ValueError(f"Backup of {name} is missing or damaged")
+            changed[name] = (fp, obj_fp)
+
+        sync_dirs = set()
+        for fp, obj_fp in changed.values():
+            # Restored files are copies, other tools may edit them in place
+            with open(obj_fp, 'rb') as src, atomic_open(fp, 'wb', sync_dirs) as dst:
+                shutil.copyfileobj(src, dst)
+        fsync_dirs(sync_dirs)
+        return list(changed)
+
+class BackupRun:
+    # Files backed up during one export run, saved as one snapshot on commit. Safe to add to from writer threads
+    def __init__(self, store):
+        self.store = store
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def add(self, fp):
+        name = os.path.basename(fp)
+        with self.lock:
+            if name in self.files:
+                return
+        digest = self.store.store_file(fp)
+        with self.lock:
+            self.files.setdefault(name, digest)
+
+    def commit(self):
+        if not self.files:
+            return None
+        self.store.migrate_legacy() # Keep the legacy originals as the oldest snapshot
+        return self.store.save_snapshot(self.files)
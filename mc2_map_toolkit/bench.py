@@ -0,0 +1,176 @@
+import os
+import sys
+import json
+import time
+import glob
+import fnmatch
+import platform
+import argparse
+import tempfile
+import shutil
+import statistics
+from .synthetic import SCALES, generate_city
+from .tex_file import TEXFile
+from .xmod import read_xmod, read_xbcpv
+from .convert import build_model_faces, hood_to_dict, dict_to_hood, prop_file_to_dict, dict_to_prop_file
+from .formats import read_hood, read_prop_file, read_level, read_pdef, read_city_model_def
+from .fileio import atomic_write
+
+# Benchmark suite of the bpy-free pipeline stages (parsing, texture decoding, mesh building and serializing)
+# on a synthetic city, run in plain CPython:
+#   python -m mc2_map_toolkit.bench --scale medium --save baseline.json
+#   python -m mc2_map_toolkit.bench --scale medium --compare baseline.json
+# Every stage is run --repeat times and its fastest run is compared, compare mode exits with 1 when a stage
+# got slower than the threshold allows
+
+class CityFiles:
+    # Files of the benchmarked map and the data stages that don't time reading start from
+    def __init__(self, mc2_dir, map_name):
+        city_path = os.path.join(mc2_dir, 'city', map_name)
+        models_path = os.path.join(city_path, 'models')
+        self.lvl = os.path.join(city_path, map_name + '.lvl')
+        self.prop = os.path.join(city_path, map_name + '.prop')
+        self.hoods = sorted(glob.glob(os.path.join(city_path, '*.hood')))
+        self.pdefs = sorted(glob.glob(os.path.join(city_path, '*.pdef')))
+        self.ccs = sorted(glob.glob(os.path.join(models_path, '*.cc')))
+        self.xmods = sorted(glob.glob(os.path.join(models_path, '*.xmod')))
+        self.xbcpvs = sorted(glob.glob(os.path.join(models_path, '*.xbcpv')))
+
+        # Textures by format name
+        self.textures = {}
+        for fp in sorted(glob.glob(os.path.join(mc2_dir, 'texture_x', '*.tex'))):
+            self.textures.setdefault(TEXFile(fp).format.name.lower(), []).append(fp)
+
+        self.models = []
+        for fp in self.xmods:
+            xbcpv_fp = os.path.splitext(fp)[0] + '.xbcpv'
+            self.models.append((read_xmod(fp), read_xbcpv(xbcpv_fp) if os.path.exists(xbcpv_fp) else None))
+        self.parsed_hoods = [read_hood(fp) for fp in self.hoods]
+        self.parsed_props = read_prop_file(self.prop) if os.path.exists(self.prop) else None
+
+def decode_textures(filepaths):
+    # What load_texture_from_path does before handing pixels to blender
+    for fp in filepaths:
+        tf = TEXFile(fp)
+        tf.strip_mips(0)
+        if tf.is_compressed_format():
+            tf.decompress()
+        tf.get_pixels()
+    return len(filepaths)
+
+def serialize_props(prop_file):
+    prop_file.serialize()
+    return len(prop_file.all_props())
+
+def get_stages(files):
+    # Stage name -> function returning the number of items it processed
+    stages = {
+        'parse.xmod': lambda: len([read_xmod(fp) for fp in files.xmods]),
+        'parse.xbcpv': lambda: len([read_xbcpv(fp) for fp in files.xbcpvs]),
+        'parse.hood': lambda: len([read_hood(fp) for fp in files.hoods]),
+        'parse.prop': lambda: len(read_prop_file(files.prop).all_props()),
+        'parse.lvl': lambda: len(read_level(files.lvl).hoods),
+        'parse.cc': lambda: len([read_city_model_def(fp) for fp in files.ccs]),
+        'parse.pdef': lambda: len([read_pdef(fp) for fp in files.pdefs]),
+        'build.mesh': lambda: sum(len(build_model_faces(model, cpvs)) for model, cpvs in files.models),
+        # Unedited blocks are written back from their source, new or edited ones through the writer templates
+        'serialize.hood.source': lambda: len([hood.serialize() for hood in files.parsed_hoods]),
+        'serialize.hood.format': lambda: len([dict_to_hood(hood_to_dict(hood)).serialize() for hood in files.parsed_hoods]),
+        'serialize.prop.source': lambda: serialize_props(files.parsed_props),
+        'serialize.prop.format': lambda: serialize_props(dict_to_prop_file(prop_file_to_dict(files.parsed_props))),
+    }
+    for fmt, filepaths in files.textures.items():
+        stages['decode.tex.' + fmt] = lambda filepaths = filepaths: decode_textures(filepaths)
+    return stages
+
+def run_stage(func, repeat):
+    times = []
+    items = 0
+    for i in range(repeat):
+        start = time.perf_counter()
+        items = func()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times), 'items': items, 'repeat': repeat}
+
+def run_benchmarks(files, repeat = 5, patterns = None, quiet = False):
+    results = {}
+    for name, func in get_stages(files).items():
+        if patterns and not any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+            continue
+        results[name] = result = run_stage(func, repeat)
+        if not quiet:
+            print('%-28s %10.2f ms  (median %.2f ms, %d items)' % (name, result['min'] * 1000, result['median'] * 1000, result['items']))
+    return results
+
+def compare_results(baseline, current, threshold):
+    # (stage, baseline seconds, current seconds, change) of the stages both runs have, and the regressed ones
+    rows = []
+    regressions = []
+    for name, result in current.items():
+        base = baseline.get(name)
+        if base is None or base['min'] <= 0.0:
+            continue
+        change = result['min'] / base['min'] - 1.0
+        rows.append((name, base['min'], result['min'], change))
+        if change > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog = 'python -m mc2_map_toolkit.bench', description = "Benchmark the bpy-free pipeline stages on a synthetic city")
+    parser.add_argument('--dir', help = "MC2 directory to benchmark, generated first if it has no city yet. Defaults to a temporary directory")
+    parser.add_argument('--scale', choices = sorted(SCALES), default = 'small')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--map', default = 'synth', help = "Map name")
+    parser.add_argument('--repeat', type = int, default = 5, help = "Runs per stage, the fastest one counts")
+    parser.add_argument('--stages', nargs = '+', help = "Stage name patterns to run, like decode.* or parse.xmod")
+    parser.add_argument('--save', help = "Write the results to a JSON baseline")
+    parser.add_argument('--compare', help = "Compare the results with a JSON baseline")
+    parser.add_argument('--threshold', type = float, default = 0.1, help = "Slowdown that counts as a regression (default 0.1, 10%%)")
+    parser.add_argument('--generate-only', action = 'store_true', help = "Only generate the city into --dir")
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    args = parse_args(argv)
+    mc2_dir = args.dir or tempfile.mkdtemp(prefix = 'mc2_bench_')
+    try:
+        if not os.path.exists(os.path.join(mc2_dir, 'city', args.map)):
+            start = time.perf_counter()
+            counts = generate_city(mc2_dir, args.scale, args.seed, args.map)
+            print('Generated %s city in %.1fs: %s' % (args.scale, time.perf_counter() - start,
+                                                      ', '.join('%d %s' % (n, ext) for ext, n in sorted(counts.items()))))
+        if args.generate_only:
+            return 0
+
+        results = run_benchmarks(CityFiles(mc2_dir, args.map), args.repeat, args.stages)
+    finally:
+        if args.dir is None:
+            shutil.rmtree(mc2_dir, ignore_errors = True)
+
+    if args.save:
+        report = {
+            'meta': {'scale': args.scale, 'seed': args.seed, 'repeat': args.repeat, 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                     'python': platform.python_version(), 'implementation': platform.python_implementation(),
+                     'platform': platform.platform()},
+            'stages': results,
+        }
+        atomic_write(args.save, json.dumps(report, indent = 1))
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            baseline = json.load(file)
+        if baseline['meta'].get('scale') != args.scale:
+            print('Baseline was made at %s scale' % baseline['meta'].get('scale'), file = sys.stderr)
+
+        rows, regressions = compare_results(baseline['stages'], results, args.threshold)
+        print()
+        for name, base, current, change in rows:
+            flag = ' REGRESSION' if name in regressions else ''
+            print('%-28s %10.2f ms -> %10.2f ms  %+6.1f%%%s' % (name, base * 1000, current * 1000, change * 100, flag))
+        if regressions:
+            print('%d of %d stages regressed by more than %.0f%%' % (len(regressions), len(rows), args.threshold * 100), file = sys.stderr)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
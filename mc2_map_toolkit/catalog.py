@@ -0,0 +1,107 @@
+import os
+import time
+
+# Catalog of the MC2 directory's files: city folders, models, pdefs, hoods, texture_x and so on. Every
+# directory gets read with one os.scandir on its first lookup and names are looked up case insensitively,
+# game files mix cases. A directory is read again when its mtime changed, which is checked at most every
+# CHECK_INTERVAL seconds, so panel polls and importer lookups are dict hits. Operators that write files
+# invalidate the directories they wrote to, so their own changes show up right away
+
+CHECK_INTERVAL = 2.0 # Seconds a directory's mtime is trusted without checking
+
+class DirIndex:
+    __slots__ = ('path', 'mtime', 'checked', 'files', 'dirs')
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None # None while the directory doesn't exist
+        self.checked = 0.0
+        self.files = {} # Lower case name -> name
+        self.dirs = {}
+
+    def scan(self, mtime):
+        self.mtime = mtime
+        self.files.clear()
+        self.dirs.clear()
+        if mtime is None:
+            return
+        try:
+            with os.scandir(self.path) as entries:
+                for entry in entries:
+                    try:
+                        names = self.dirs if entry.is_dir() else self.files
+                    except OSError:
+                        continue
+                    names[entry.name.lower()] = entry.name
+        except OSError:
+            self.mtime = None
+
+    def refresh(self, now):
+        self.checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self.mtime:
+            self.scan(mtime)
+
+_dirs = {} # Normalized directory path -> DirIndex
+
+def get_dir(path):
+    key = os.path.normcase(os.path.normpath(path))
+    index = _dirs.get(key)
+    if index is None:
+        index = _dirs[key] = DirIndex(path)
+    now = time.monotonic()
+    if now - index.checked >= CHECK_INTERVAL:
+        index.refresh(now)
+    return index
+
+def find_file(path):
+    # Path of the file with its name cased like on disk, None if there's no such file
+    dir, name = os.path.split(path)
+    index = get_dir(dir)
+    found = index.files.get(name.lower())
+    return os.path.join(dir, found) if found is not None else None
+
+def find_dir(path):
+    dir, name = os.path.split(os.path.normpath(path))
+    index = get_dir(dir)
+    found = index.dirs.get(name.lower())
+    return os.path.join(dir, found) if found is not None else None
+
+def file_exists(path):
+    return find_file(path) is not None
+
+def dir_exists(path):
+    return get_dir(path).mtime is not None
+
+def list_files(path, ext = None):
+    # Names of the files in a directory, ext (like '.cc') matches case insensitively
+    names = get_dir(path).files
+    if ext is None:
+        return list(names.values())
+    ext = ext.lower()
+    return [name for lower, name in names.items() if lower.endswith(ext)]
+
+def invalidate(path = None):
+    # Forget a directory and everything below it, or the whole catalog
+    if path is None:
+        _dirs.clear()
+        return
+    key = os.path.normcase(os.path.normpath(path))
+    for dir_key in list(_dirs):
+        if dir_key == key or dir_key.startswith(key + os.sep):
+            del _dirs[dir_key]
+
+def validate_mc2_dir(path: str) -> (bool, str):
+    if not path:
+        return False, 'No path set'
+    if not dir_exists(path): # Called on every panel redraw, the catalog keeps it off the disk
+        return False, 'Directory does not exist'
+
+    unique_folders = ['anim', 'bound', 'fonts', 'geometry', 'model', 'tune'] # Folders unique to assets_p
+    for f in unique_folders:
+        if find_dir(os.path.join(path, f)) is None:
+            return False, 'Assets not extracted'
+    return True, ''
@@ -0,0 +1,276 @@
+import os
+import sys
+import json
+import math
+import struct
+import zlib
+import traceback
+from array import array
+from .fileio import atomic_write
+from .tex_file import TEXFile
+from .xmod import read_xmod, iter_material_triangles, order_cpv_ids, read_xbcpv
+from .formats import (Hood, UniqueComponent, InstanceComponent, PropFile, PropTemplate, PropInstance,
+                      read_hood, read_prop_file, read_text)
+
+# Bpy-free file converters used by the command line batch converter (python -m mc2_map_toolkit).
+# Models are written in the orientation the blender importer gives them, converted to the y-up axes of glTF/OBJ
+
+# Textures
+
+def png_chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+def encode_png(width, height, rgba):
+    stride = width * 4
+    rows = b''.join(b'\x00' + bytes(rgba[y * stride:(y + 1) * stride]) for y in range(height)) # Filter type 0 per row
+    return (b'\x89PNG\r\n\x1a\n' +
+            png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) +
+            png_chunk(b'IDAT', zlib.compress(rows, 6)) +
+            png_chunk(b'IEND', b''))
+
+def tex_to_png(src, dst, mip_level = 0):
+    tf = TEXFile(src)
+    if not tf.is_valid():
+        raise ValueError('Invalid TEX file')
+    tf.strip_mips(mip_level)
+    if tf.is_compressed_format():
+        tf.decompress()
+    atomic_write(dst, encode_png(tf.width, tf.height, tf.get_rgba_bytes()), 'wb', set())
+
+# Models
+
+def to_y_up(vector3):
+    # Game space to the blender importer's space (translate_vector3), then blender's z-up to y-up
+    x, y, z = vector3
+    return (0.0 - x, y, 0.0 - z) # Not -x, which writes 0 as -0
+
+def normalized(vector3):
+    length = math.sqrt(sum(v * v for v in vector3))
+    return tuple(v / length for v in vector3) if length > 0.0 else (0.0, 1.0, 0.0)
+
+def build_model_faces(model, cpvs = None):
+    # Triangles of every material in import order, as the same faces import_xmod creates:
+    # [(material, [corner, ...])], corners being (vidx, nidx, u1idx, color)
+    tris_check = set()
+    adj_ctr = 0
+    faces = []
+    xbcpv_id_lists = []
+    for mod_mat in model.materials:
+        mat_corners = []
+        mat_xbcpv_ids = []
+        for adj_ids, adjuncts in iter_material_triangles(model, mod_mat, tris_check, adj_ctr):
+            mat_corners.extend(adjuncts)
+            mat_xbcpv_ids.extend(adj_ids)
+        adj_ctr += sum(packet.num_adjs for packet in mod_mat.packets)
+        faces.append((mod_mat, mat_corners))
+        xbcpv_id_lists.append(mat_xbcpv_ids)
+
+    # Corner colors come from the xbcpv file when there is one, in the face corner order it was written in
+    cpv_ids = iter(order_cpv_ids(model, xbcpv_id_lists)) if cpvs is not None else None
+    return [(mod_mat, [(a[0], a[1], a[3], cpvs[next(cpv_ids)] if cpv_ids is not None else model.colors[a[2]])
+                       for a in corners])
+            for mod_mat, corners in faces if corners]
+
+def read_model(src, use_cpv = True):
+    model = read_xmod(src)
+    xbcpv_fp = os.path.splitext(src)[0] + '.xbcpv'
+    cpvs = read_xbcpv(xbcpv_fp) if use_cpv and os.path.exists(xbcpv_fp) else None
+    return model, build_model_faces(model, cpvs)
+
+def material_texture(mod_mat):
+    return mod_mat.textures[0] if mod_mat.textures else None # Only the first texture is used, like on import
+
+def xmod_to_obj(src, dst, use_cpv = True):
+    # OBJ has no corner colors, cpvs only apply to glTF
+    model, faces = read_model(src, False)
+    mtl_name = os.path.splitext(os.path.basename(dst))[0] + '.mtl'
+
+    lines = ['mtllib %s\n' % mtl_name, 'o %s\n' % model.name]
+    lines.extend('v %.6f %.6f %.6f\n' % to_y_up(v) for v in model.verts)
+    lines.extend('vt %.6f %.6f\n' % (u, 1.0 - v) for u, v in model.tex1s) # OBJ uvs start at the bottom
+    lines.extend('vn %.6f %.6f %.6f\n' % normalized(to_y_up(n)) for n in model.normals)
+    lines.append('s 1\n')
+
+    mtl_lines = []
+    for mod_mat, corners in faces:
+        lines.append('usemtl %s\n' % mod_mat.name)
+        for c_idx in range(0, len(corners), 3):
+            lines.append('f' + ''.join(' %d/%d/%d' % (c[0] + 1, c[2] + 1, c[1] + 1) for c in corners[c_idx:c_idx + 3]) + '\n')
+
+        mtl_lines.append('newmtl %s\nKd %.6f %.6f %.6f\n' % ((mod_mat.name,) + tuple(mod_mat.diffuse)))
+        texture = material_texture(mod_mat)
+        if texture is not None:
+            mtl_lines.append('map_Kd %s.png\n' % texture)
+
+    atomic_write(os.path.join(os.path.dirname(dst), mtl_name), ''.join(mtl_lines), 'w', set())
+    atomic_write(dst, ''.join(lines), 'w', set())
+
+def le_bytes(values, typecode):
+    data = array(typecode, values)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data.tobytes()
+
+def xmod_to_gltf(src, dst, use_cpv = True):
+    model, faces = read_model(src, use_cpv)
+    if not faces:
+        raise ValueError('Model has no faces')
+    normals = [normalized(to_y_up(n)) for n in model.normals]
+
+    # glTF vertices carry every attribute, so corners sharing all of them become one vertex
+    vertex_ids = {}
+    positions, vertex_normals, uvs, colors = [], [], [], []
+    primitive_indices = []
+    for mod_mat, corners in faces:
+        indices = []
+        for corner in corners:
+            v_id = vertex_ids.get(corner)
+            if v_id is None:
+                v_id = vertex_ids[corner] = len(vertex_ids)
+                positions.extend(to_y_up(model.verts[corner[0]]))
+                vertex_normals.extend(normals[corner[1]])
+                uvs.extend(model.tex1s[corner[2]]) # glTF uvs start at the top like the game's
+                colors.extend(corner[3])
+            indices.append(v_id)
+        primitive_indices.append(indices)
+
+    gltf = {'asset': {'version': '2.0', 'generator': 'MC2 Map Toolkit'},
+            'scene': 0, 'scenes': [{'nodes': [0]}], 'nodes': [{'name': model.name, 'mesh': 0}],
+            'buffers': [], 'bufferViews': [], 'accessors': [], 'materials': [], 'textures': [], 'images': []}
+    blob = bytearray()
+
+    def add_accessor(values, typecode, component_type, accessor_type, count, target, bounds = None):
+        data = le_bytes(values, typecode)
+        gltf['bufferViews'].append({'buffer': 0, 'byteOffset': len(blob), 'byteLength': len(data), 'target': target})
+        blob.extend(data)
+        blob.extend(b'\x00' * (-len(blob) % 4)) # Accessors need 4 byte alignment
+        accessor = {'bufferView': len(gltf['bufferViews']) - 1, 'componentType': component_type,
+                    'type': accessor_type, 'count': count}
+        if bounds is not None:
+            accessor['min'], accessor['max'] = bounds
+        gltf['accessors'].append(accessor)
+        return len(gltf['accessors']) - 1
+
+    count = len(vertex_ids)
+    positions = array('f', positions) # Bounds have to match the stored float32 values
+    bounds = ([min(positions[i::3]) for i in range(3)], [max(positions[i::3]) for i in range(3)])
+    attributes = {'POSITION': add_accessor(positions, 'f', 5126, 'VEC3', count, 34962, bounds),
+                  'NORMAL': add_accessor(vertex_normals, 'f', 5126, 'VEC3', count, 34962),
+                  'TEXCOORD_0': add_accessor(uvs, 'f', 5126, 'VEC2', count, 34962),
+                  'COLOR_0': add_accessor(colors, 'f', 5126, 'VEC4', count, 34962)}
+
+    images = {}
+    primitives = []
+    for (mod_mat, corners), indices in zip(faces, primitive_indices):
+        material = {'name': mod_mat.name, 'pbrMetallicRoughness': {'metallicFactor': 0.0}}
+        texture = material_texture(mod_mat)
+        if texture is not None:
+            if texture not in images:
+                images[texture] = len(gltf['images'])
+                gltf['images'].append({'uri': texture + '.png'})
+                gltf['textures'].append({'source': images[texture]})
+            material['pbrMetallicRoughness']['baseColorTexture'] = {'index': images[texture]}
+        else:
+            material['pbrMetallicRoughness']['baseColorFactor'] = list(mod_mat.diffuse) + [1.0]
+        gltf['materials'].append(material)
+
+        primitives.append({'attributes': attributes, 'material': len(gltf['materials']) - 1,
+                           'indices': add_accessor(indices, 'I', 5125, 'SCALAR', len(indices), 34963)})
+    gltf['meshes'] = [{'name': model.name, 'primitives': primitives}]
+
+    bin_name = os.path.splitext(os.path.basename(dst))[0] + '.bin'
+    gltf['buffers'].append({'uri': bin_name, 'byteLength': len(blob)})
+    for key in ('materials', 'textures', 'images'):
+        if not gltf[key]:
+            del gltf[key]
+
+    atomic_write(os.path.join(os.path.dirname(dst), bin_name), bytes(blob), 'wb', set())
+    atomic_write(dst, json.dumps(gltf, indent = 1), 'w', set())
+
+# .hood and .prop
+
+def hood_to_dict(hood):
+    return {
+        'format': 'hood',
+        'name': hood.name,
+        'uniques': [{'name': u.name, 'emin': u.emin, 'emax': u.emax} for u in hood.uniques],
+        'instances': [{'type': i.type, 'owner': i.owner, 'extension': i.extension,
+                       'matrix': i.matrix, 'emin': i.emin, 'emax': i.emax} for i in hood.instances],
+    }
+
+def dict_to_hood(data):
+    hood = Hood(data['name'])
+    hood.uniques = [UniqueComponent(u['name'], u['emin'], u['emax']) for u in data['uniques']]
+    hood.instances = [InstanceComponent(i['type'], i['owner'], i['extension'], i['matrix'], i['emin'], i['emax'])
+                      for i in data['instances']]
+    return hood
+
+PROP_JSON_CLASSES = (('props', 'props'), ('props_fixed', 'fixed_props'), ('props_gfx', 'gfx_props'),
+                     ('unclassified', 'unclassified')) # JSON key, PropFile attribute
+
+def prop_file_to_dict(prop_file):
+    data = {'format': 'prop', 'templates': []}
+    for template in prop_file.templates:
+        data['templates'].append({
+            'name': template.name, 'animation': template.animation,
+            'parts': [{'name': name, 'offset': offset} for name, offset in template.parts],
+            'fixedobject': template.fixedobject, 'obstacle': template.obstacle, 'gfxonly': template.gfxonly,
+            'drivable': template.drivable, 'far': template.far,
+        })
+    for key, attr in PROP_JSON_CLASSES:
+        data[key] = [{'id': p.id, 'template': p.template, 'matrix': p.matrix} for p in getattr(prop_file, attr)]
+    return data
+
+def dict_to_prop_file(data):
+    prop_file = PropFile()
+    for t in data['templates']:
+        template = PropTemplate(t['name'])
+        template.parts = [(part['name'], tuple(part['offset'])) for part in t['parts']]
+        for flag in ('animation', 'fixedobject', 'obstacle', 'gfxonly', 'drivable', 'far'):
+            setattr(template, flag, t[flag])
+        prop_file.templates.append(template)
+    for key, attr in PROP_JSON_CLASSES:
+        setattr(prop_file, attr, [PropInstance(p['id'], p['matrix'], p['template']) for p in data.get(key, [])])
+    return prop_file
+
+def to_json(src, dst):
+    if src.lower().endswith('.hood'):
+        data = hood_to_dict(read_hood(src))
+    else:
+        data = prop_file_to_dict(read_prop_file(src))
+    atomic_write(dst, json.dumps(data, indent = 1), 'w', set())
+
+def from_json(src, dst):
+    data = json.loads(read_text(src))
+    if data.get('format') == 'hood':
+        text = dict_to_hood(data).serialize()
+    elif data.get('format') == 'prop':
+        text = dict_to_prop_file(data).serialize()
+    else:
+        raise ValueError('Not a hood or prop JSON file')
+    if not os.path.splitext(dst)[1]:
+        dst += '.' + data['format']
+    atomic_write(dst, text, 'w', set())
+    return dst
+
+# Batch jobs
+
+CONVERTERS = {
+    'tex': tex_to_png,
+    'gltf': xmod_to_gltf,
+    'obj': xmod_to_obj,
+    'to-json': to_json,
+    'from-json': from_json,
+}
+
+def run_job(job):
+    # Pool worker: (converter, source, destination, options) -> (source, destination, error, traceback).
+    # Converters may return a different destination. Errors are returned instead of raised, so one broken
+    # file doesn't stop the batch
+    converter, src, dst, options = job
+    try:
+        os.makedirs(os.path.dirname(dst) or '.', exist_ok = True)
+        dst = CONVERTERS[converter](src, dst, **options) or dst
+        return src, dst, None, None
+    except Exception as ex:
+        return src, dst, '%s: %s' % (type(ex).__name__, ex), traceback.format_exc()
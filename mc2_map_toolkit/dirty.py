@@ -0,0 +1,135 @@
+import bpy
+import os
+import json
+from bpy.app.handlers import persistent
+from .fileio import atomic_write
+
+# Dirty tracking for exports. Hoods and prop classes are clean once exported, until one of their
+# objects or collections changes. Keys: ('hood', hood name) and ('prop', class name).
+# The clean keys are saved with the .blend, as <blend name>_<map>_clean.json next to the instance store, so
+# exports right after opening it still skip what didn't change and serialize the rest from the store
+
+_clean = set()
+_cached_blocks = {} # Key -> exported text of a clean prop class
+_ignored = set() # Names of objects and collections changed by streaming, their next update isn't an edit
+
+def is_dirty(key):
+    return key not in _clean
+
+def mark_clean(key, block = None):
+    _clean.add(key)
+    if block is not None:
+        _cached_blocks[key] = block
+
+def mark_dirty(key):
+    _clean.discard(key)
+    _cached_blocks.pop(key, None)
+
+def mark_all_dirty():
+    _clean.clear()
+    _cached_blocks.clear()
+
+def save_dirty_state():
+    return set(_clean), dict(_cached_blocks)
+
+def restore_dirty_state(state):
+    # Undo the dirty marks of changes that were put back, like detaching instances to write the library cache
+    _clean.clear()
+    _clean.update(state[0])
+    _cached_blocks.clear()
+    _cached_blocks.update(state[1])
+
+def get_clean_path(map_name):
+    if not bpy.data.filepath:
+        return None
+    return os.path.splitext(bpy.data.filepath)[0] + '_' + map_name + '_clean.json'
+
+def forget_saved_clean(map_name):
+    # For changes to the map files the saved .blend doesn't know about, like exports and restored backups.
+    # Reopening it marks everything dirty then, until it's saved again
+    fp = get_clean_path(map_name)
+    if fp is not None and os.path.exists(fp):
+        os.remove(fp)
+
+def ignore_update(id):
+    # For display changes made by the add-on itself (streaming, lod switching). The depsgraph update they cause
+    # comes after the change, so it's skipped by name in the handler instead of restoring the dirty state
+    _ignored.add(id.name)
+
+def get_cached_block(key):
+    return _cached_blocks.get(key) if key in _clean else None
+
+def get_dirty_key(id):
+    if 'mc2_hood' in id:
+        return ('hood', id['mc2_hood'])
+    if 'mc2_prop_class' in id:
+        return ('prop', id['mc2_prop_class'])
+    return None
+
+@persistent
+def dirty_depsgraph_update(scene, depsgraph):
+    ignored = set(_ignored)
+    _ignored.clear()
+    if not _clean:
+        return # Everything is dirty already
+
+    for update in depsgraph.updates:
+        id = update.id.original
+        if not isinstance(id, (bpy.types.Object, bpy.types.Collection)) or id.name in ignored:
+            continue
+
+        # Selection and display changes update objects too, only moves and mesh edits change exports
+        if isinstance(id, bpy.types.Object) and not (update.is_updated_transform or update.is_updated_geometry):
+            continue
+
+        key = get_dirty_key(id)
+        if key is not None:
+            mark_dirty(key)
+        else:
+            # Untagged data: source models and prop templates feed the extents and templates of everything,
+            # and scenes spawned before tagging can't be told apart
+            mark_all_dirty()
+            return
+
+@persistent
+def dirty_reset(*args):
+    mark_all_dirty()
+
+@persistent
+def dirty_save_post(*args):
+    # The objects saved now match the last export of every clean key
+    map_name = bpy.context.scene.mc2_props.map_name
+    if not _clean:
+        forget_saved_clean(map_name) # Nothing exported, .blend files of other work don't get one
+        return
+    atomic_write(get_clean_path(map_name), json.dumps(sorted(_clean)))
+
+@persistent
+def dirty_load_post(*args):
+    mark_all_dirty()
+    fp = get_clean_path(bpy.context.scene.mc2_props.map_name)
+    if fp is None or not os.path.exists(fp):
+        return
+    try:
+        with open(fp, 'r') as file:
+            _clean.update(tuple(key) for key in json.load(file))
+    except (OSError, ValueError):
+        pass # Everything stays dirty
+
+def register():
+    bpy.app.handlers.depsgraph_update_post.append(dirty_depsgraph_update)
+    for handlers in (bpy.app.handlers.undo_post, bpy.app.handlers.redo_post):
+        handlers.append(dirty_reset)
+    bpy.app.handlers.save_post.append(dirty_save_post)
+    bpy.app.handlers.load_post.append(dirty_load_post)
+
+def unregister():
+    if dirty_depsgraph_update in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.remove(dirty_depsgraph_update)
+    for handlers in (bpy.app.handlers.undo_post, bpy.app.handlers.redo_post):
+        if dirty_reset in handlers:
+            handlers.remove(dirty_reset)
+    if dirty_save_post in bpy.app.handlers.save_post:
+        bpy.app.handlers.save_post.remove(dirty_save_post)
+    if dirty_load_post in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(dirty_load_post)
@@ -0,0 +1,59 @@
+import os
+import threading
+from contextlib import contextmanager
+
+# Crash-safe writes: files are written to a temp file next to the target, flushed to disk and renamed
+# over the target, so an export that fails or gets interrupted never leaves a truncated game file
+
+def fsync_dir(path):
+    # Make renames in a directory durable, directories can't be opened for syncing on windows
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def fsync_dirs(dirs):
+    for path in dirs:
+        fsync_dir(path)
+    dirs.clear()
+
+def make_dirs(path):
+    # os.makedirs for directories crash-safe files go into, the entries of new directories are synced too
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        return
+    parent = os.path.dirname(path)
+    make_dirs(parent)
+    try:
+        os.mkdir(path)
+    except FileExistsError:
+        return # Made by another writer thread
+    fsync_dir(parent)
+
+@contextmanager
+def atomic_open(filepath, mode = 'w', sync_dirs = None, newline = None):
+    # sync_dirs collects the directories to fsync once at the end of an export run, without it the directory is synced right away
+    dir = os.path.dirname(os.path.abspath(filepath))
+    tmp_fp = os.path.join(dir, '.%s.%d.tmp' % (os.path.basename(filepath), threading.get_ident()))
+    try:
+        with open(tmp_fp, mode, newline = newline) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_fp, filepath)
+    except BaseException:
+        if os.path.exists(tmp_fp):
+            os.remove(tmp_fp)
+        raise
+
+    if sync_dirs is None:
+        fsync_dir(dir)
+    else:
+        sync_dirs.add(dir)
+
+def atomic_write(filepath, data, mode = 'w', sync_dirs = None, newline = None):
+    with atomic_open(filepath, mode, sync_dirs, newline) as file:
+        file.write(data)
@@ -0,0 +1,463 @@
+import os
+from .lexer import tokenize, to_floats, is_number
+from .writers import (HOOD_HEADER_TEMPLATE, PROP_HEADER_TEMPLATE, format_unique, format_instance,
+                      format_prop_template, format_prop)
+
+# Bpy-free data model of the MC2 text formats. Parsers keep the source text of every block they read,
+# serializers write blocks whose values didn't change back as they were read and edited or new blocks
+# in the exporter format, so parsing and serializing an unedited file gives back the same bytes.
+# .lvl, .pdef and .cc files are only read by the toolkit, edited values are written back into their source lines
+
+def translate_vector3(vector3):
+    # Game space to blender space
+    x, y, z = vector3
+    return (-x, z, y)
+
+def split_blocks(lines, block_keys):
+    # Header lines and tokens before the first block, then (key, values, lines, tokens) of every top level block.
+    # Blocks run until the next block, so blank lines and anything unknown stay with the block before them
+    header_tokens = []
+    block_tokens = header_tokens
+    starts = []
+    for token in tokenize(lines):
+        if token[3] == 0 and token[1] in block_keys:
+            block_tokens = [token]
+            starts.append((token[0], token[1], token[2], block_tokens))
+        else:
+            block_tokens.append(token)
+
+    blocks = []
+    for idx, (start, key, values, tokens) in enumerate(starts):
+        end = starts[idx + 1][0] if idx + 1 < len(starts) else len(lines)
+        blocks.append((key, values, lines[start:end], tokens))
+    header = lines[:starts[0][0]] if starts else lines
+    return header, header_tokens, blocks
+
+def detect_newline(text):
+    # Line ending of the first line, generated text of a parsed file uses it too
+    end = text.find('\n')
+    return '\r\n' if end > 0 and text[end - 1] == '\r' else '\n'
+
+def to_newline(text, newline):
+    # Writers format with \n
+    return text if newline == '\n' else text.replace('\n', newline)
+
+def format_value(value):
+    return '%.6f' % value if isinstance(value, float) else str(value)
+
+def replace_line_values(line, key, values):
+    # Write new values into a source line, keeping its indentation, key, separator and line ending
+    body = line.rstrip('\r\n')
+    ending = line[len(body):]
+    indent = body[:len(body) - len(body.lstrip())]
+    separator = '\t' if '\t' in body.strip() else ' '
+    tokens = ([key] if key else []) + [format_value(v) for v in values]
+    return indent + separator.join(tokens) + ending
+
+class SourceBlock:
+    # A block that remembers its source text and the values it was parsed with
+    __slots__ = ('source', 'parsed')
+
+    def __init__(self):
+        self.source = None
+        self.parsed = None
+
+    def key(self, idx):
+        return (idx,) + self.values()
+
+    def serialize(self, idx = 0, newline = '\n'):
+        if self.source is not None and self.parsed == self.key(idx):
+            return self.source
+        return to_newline(self.format(idx), newline)
+
+# .hood
+
+class UniqueComponent(SourceBlock):
+    __slots__ = ('name', 'emin', 'emax')
+
+    def __init__(self, name = '', emin = (0.0, 0.0, 0.0), emax = (0.0, 0.0, 0.0)):
+        super().__init__()
+        self.name = name
+        self.emin = tuple(emin)
+        self.emax = tuple(emax)
+
+    def values(self):
+        return (self.name, tuple(self.emin), tuple(self.emax))
+
+    def format(self, idx):
+        return format_unique(idx, self.name, self.emin, self.emax)
+
+class InstanceComponent(SourceBlock):
+    __slots__ = ('type', 'owner', 'extension', 'matrix', 'emin', 'emax')
+
+    def __init__(self, type = '', owner = '', extension = '', matrix = (0.0,) * 12, emin = (0.0, 0.0, 0.0), emax = (0.0, 0.0, 0.0)):
+        super().__init__()
+        self.type = type
+        self.owner = owner
+        self.extension = extension
+        self.matrix = tuple(matrix) # 4 Matrix34 rows (3 rotation rows and translation) flattened
+        self.emin = tuple(emin)
+        self.emax = tuple(emax)
+
+    def values(self):
+        return (self.type, self.owner, self.extension, tuple(self.matrix), tuple(self.emin), tuple(self.emax))
+
+    def format(self, idx):
+        return format_instance(idx, self.type, self.owner, self.extension, self.matrix, self.emin, self.emax)
+
+class Hood:
+    __slots__ = ('name', 'uniques', 'instances', 'header', 'parsed_header', 'newline')
+
+    def __init__(self, name = ''):
+        self.name = name
+        self.uniques = []
+        self.instances = []
+        self.header = None
+        self.parsed_header = None
+        self.newline = '\n'
+
+    def header_values(self):
+        return (self.name, len(self.uniques), len(self.instances))
+
+    def serialize(self):
+        if self.header is not None and self.parsed_header == self.header_values():
+            parts = [self.header]
+        else:
+            parts = [to_newline(HOOD_HEADER_TEMPLATE % self.header_values(), self.newline)]
+        parts.extend(unique.serialize(idx, self.newline) for idx, unique in enumerate(self.uniques))
+        parts.extend(inst.serialize(idx, self.newline) for idx, inst in enumerate(self.instances))
+        return ''.join(parts)
+
+def parse_unique(idx, lines, tokens):
+    unique = UniqueComponent()
+    for l_idx, key, values, depth in tokens:
+        if key == 'name:': unique.name = values[0]
+        elif key == 'emin': unique.emin = to_floats(values)
+        elif key == 'emax': unique.emax = to_floats(values)
+    unique.source = ''.join(lines)
+    unique.parsed = unique.key(idx)
+    return unique
+
+def parse_instance(idx, lines, tokens):
+    inst = InstanceComponent()
+    rows = []
+    for l_idx, key, values, depth in tokens:
+        if key == 'type:': inst.type = values[0]
+        elif key == 'owner:': inst.owner = values[0]
+        elif key == 'extension:': inst.extension = values[0]
+        elif key == 'emin': inst.emin = to_floats(values)
+        elif key == 'emax': inst.emax = to_floats(values)
+        elif is_number(key): rows.append(float(key)); rows.extend(to_floats(values))
+    inst.matrix = tuple(rows)
+    inst.source = ''.join(lines)
+    inst.parsed = inst.key(idx)
+    return inst
+
+def parse_hood(text):
+    hood = Hood()
+    hood.newline = detect_newline(text)
+    header, header_tokens, blocks = split_blocks(text.splitlines(keepends = True), ('unique_component', 'instance_component'))
+
+    counts = [0, 0]
+    for l_idx, key, values, depth in header_tokens:
+        if key == 'name:': hood.name = values[0]
+        elif key == 'num_unique_components:': counts[0] = int(values[0])
+        elif key == 'num_instance_components:': counts[1] = int(values[0])
+    hood.header = ''.join(header)
+    hood.parsed_header = (hood.name, counts[0], counts[1])
+
+    for key, values, lines, tokens in blocks:
+        if key == 'unique_component':
+            hood.uniques.append(parse_unique(int(values[0]), lines, tokens))
+        else:
+            hood.instances.append(parse_instance(int(values[0]), lines, tokens))
+    return hood
+
+# .prop
+
+class PropTemplate(SourceBlock):
+    __slots__ = ('name', 'animation', 'parts', 'fixedobject', 'obstacle', 'gfxonly', 'drivable', 'far')
+
+    def __init__(self, name = ''):
+        super().__init__()
+        self.name = name
+        self.animation = 0
+        self.parts = [] # (name, offset), offsets in game space
+        self.fixedobject = 0
+        self.obstacle = 0
+        self.gfxonly = 0
+        self.drivable = 0
+        self.far = 0
+
+    def values(self):
+        return (self.name, self.animation, tuple((name, tuple(offset)) for name, offset in self.parts),
+                self.fixedobject, self.obstacle, self.gfxonly, self.drivable, self.far)
+
+    def format(self, idx):
+        return format_prop_template(self.name, self.animation, self.parts,
+                                    self.fixedobject, self.obstacle, self.gfxonly, self.drivable, self.far)
+
+class PropInstance(SourceBlock):
+    __slots__ = ('id', 'matrix', 'template')
+
+    def __init__(self, id = '', matrix = (0.0,) * 12, template = ''):
+        super().__init__()
+        self.id = id
+        self.matrix = tuple(matrix) # 4 Matrix34 rows flattened
+        self.template = template
+
+    def values(self):
+        return (self.id, tuple(self.matrix), self.template)
+
+    def format(self, idx):
+        return format_prop(self.id, self.matrix, self.template)
+
+PROP_TEMPLATE_FLAGS = {'animation:': 'animation', 'FixedObject:': 'fixedobject', 'Obstacle:': 'obstacle',
+                       'GfxOnly:': 'gfxonly', 'Drivable:': 'drivable', 'Far:': 'far'}
+
+class PropFile:
+    # Props are stored by class, in file order: regular (hitable/movable), fixed and visual-only props
+    __slots__ = ('templates', 'props', 'fixed_props', 'gfx_props', 'unclassified', 'header', 'parsed_header', 'newline')
+
+    def __init__(self):
+        self.templates = []
+        self.props = []
+        self.fixed_props = []
+        self.gfx_props = []
+        self.unclassified = [] # Props past the counts of the header
+        self.header = None
+        self.parsed_header = None
+        self.newline = '\n'
+
+    def prop_classes(self):
+        return (('props', self.props), ('props_fixed', self.fixed_props), ('props_gfx', self.gfx_props))
+
+    def all_props(self):
+        return self.props + self.fixed_props + self.gfx_props + self.unclassified
+
+    def header_values(self):
+        return (len(self.props), len(self.fixed_props), len(self.gfx_props), len(self.templates))
+
+    def serialize(self):
+        if self.header is not None and self.parsed_header == self.header_values():
+            parts = [self.header]
+        else:
+            parts = [to_newline(PROP_HEADER_TEMPLATE % self.header_values(), self.newline)]
+        parts.extend(template.serialize(idx, self.newline) for idx, template in enumerate(self.templates))
+        parts.extend(prop.serialize(newline = self.newline) for prop in self.all_props())
+        return ''.join(parts)
+
+def parse_prop_template(idx, lines, tokens):
+    template = PropTemplate(tokens[0][2][0])
+    part = None
+    for l_idx, key, values, depth in tokens[1:]:
+        if key == 'part':
+            part = ['', (0.0, 0.0, 0.0)]
+            template.parts.append(part)
+        elif key == 'name:' and part is not None: part[0] = values[0]
+        elif key == 'offset:' and part is not None: part[1] = to_floats(values)
+        elif key in PROP_TEMPLATE_FLAGS: setattr(template, PROP_TEMPLATE_FLAGS[key], int(values[0]))
+    template.parts = [tuple(part) for part in template.parts]
+    template.source = ''.join(lines)
+    template.parsed = template.key(idx)
+    return template
+
+def parse_prop_instance(lines, tokens):
+    prop = PropInstance(tokens[0][2][0])
+    rows = []
+    for l_idx, key, values, depth in tokens[1:]:
+        if key == 'prop_template:': prop.template = values[0]
+        elif is_number(key): rows.append(float(key)); rows.extend(to_floats(values))
+    prop.matrix = tuple(rows)
+    prop.source = ''.join(lines)
+    prop.parsed = prop.key(0)
+    return prop
+
+def parse_prop_file(text):
+    prop_file = PropFile()
+    prop_file.newline = detect_newline(text)
+    header, header_tokens, blocks = split_blocks(text.splitlines(keepends = True), ('prop_template', 'prop'))
+
+    counts = {}
+    for l_idx, key, values, depth in header_tokens:
+        if values:
+            counts[key] = int(values[0])
+    prop_file.header = ''.join(header)
+    prop_file.parsed_header = (counts.get('prop_count:', 0), counts.get('fixed_prop_count:', 0),
+                               counts.get('gfx_prop_count:', 0), counts.get('num_prop_types:', 0))
+
+    class_counts = prop_file.parsed_header[:3]
+    for key, values, lines, tokens in blocks:
+        if key == 'prop_template':
+            prop_file.templates.append(parse_prop_template(len(prop_file.templates), lines, tokens))
+            continue
+
+        # Classes follow each other in the file, the header counts tell where one ends
+        prop = parse_prop_instance(lines, tokens)
+        for (prop_class, props), count in zip(prop_file.prop_classes(), class_counts):
+            if len(props) < count:
+                props.append(prop)
+                break
+        else:
+            prop_file.unclassified.append(prop)
+    return prop_file
+
+# Read-only formats
+
+class SourceLines:
+    # Source lines of a file and where each parsed value came from:
+    # (attribute, item indices...) -> (line index, key, parsed value)
+    __slots__ = ('lines', 'fields')
+
+    def __init__(self, text):
+        self.lines = text.splitlines(keepends = True)
+        self.fields = {}
+
+    def add(self, field, l_idx, key, value):
+        self.fields[field] = (l_idx, key, value)
+
+    def count(self, attr):
+        return sum(1 for field in self.fields if field[0] == attr)
+
+    def replace(self, obj):
+        # Source lines with the values that changed since parsing written back
+        lines = list(self.lines)
+        for field, (l_idx, key, parsed) in self.fields.items():
+            value = getattr(obj, field[0])
+            for item in field[1:]:
+                value = value[item]
+            values = tuple(value) if isinstance(value, (tuple, list)) else (value,)
+            if values != (tuple(parsed) if isinstance(parsed, (tuple, list)) else (parsed,)):
+                lines[l_idx] = replace_line_values(lines[l_idx], key, values)
+        return lines
+
+    def serialize(self, obj):
+        return ''.join(self.replace(obj))
+
+class Level:
+    __slots__ = ('extents_min', 'extents_max', 'hoods', 'source')
+
+    def __init__(self):
+        self.extents_min = (0.0, 0.0, 0.0)
+        self.extents_max = (0.0, 0.0, 0.0)
+        self.hoods = [] # Hood names in file order
+        self.source = None
+
+    def serialize(self):
+        if len(self.hoods) != self.source.count('hoods'):
+            raise ValueError("Adding or removing level hoods isn't supported")
+        return self.source.serialize(self)
+
+def parse_level(text):
+    level = Level()
+    level.source = source = SourceLines(text)
+    tokens = list(tokenize(source.lines))
+
+    # Extents values and hood names are on the token after their key
+    for idx, (l_idx, key, values, depth) in enumerate(tokens):
+        if key == 'extents_min' or key == 'extents_max':
+            n_idx, n_key, n_values, n_depth = tokens[idx + 1]
+            extents = to_floats([n_key] + n_values)
+            setattr(level, key, extents)
+            source.add((key,), n_idx, None, extents)
+        elif key == 'hood':
+            n_idx, n_key, n_values, n_depth = tokens[idx + 1]
+            source.add(('hoods', len(level.hoods)), n_idx, n_key, n_values[0])
+            level.hoods.append(n_values[0])
+    return level
+
+class PropDef:
+    __slots__ = ('name', 'lods', 'sphere', 'source', 'lods_line', 'parsed_lods')
+
+    def __init__(self, name = ''):
+        self.name = name
+        self.lods = [] # LOD levels, ['0', '2'] etc.
+        self.sphere = None # Bounding sphere x, y, z, radius
+        self.source = None
+        self.lods_line = None
+        self.parsed_lods = None
+
+    def serialize(self):
+        lines = self.source.replace(self)
+        if self.lods_line is not None and tuple(self.lods) != self.parsed_lods:
+            # Lod levels share a line with their count
+            lines[self.lods_line] = replace_line_values(lines[self.lods_line], 'lods:', [len(self.lods)] + list(self.lods))
+        return ''.join(lines)
+
+def parse_pdef(name, text):
+    pdef = PropDef(name)
+    pdef.source = source = SourceLines(text)
+    for l_idx, key, values, depth in tokenize(source.lines):
+        if key == 'lods:':
+            numlods = int(values[0])
+            pdef.lods = values[-numlods:] if numlods else []
+            pdef.lods_line = l_idx
+            pdef.parsed_lods = tuple(pdef.lods)
+        elif key == 'sphere:':
+            pdef.sphere = to_floats(values[:4])
+            source.add(('sphere',), l_idx, key, pdef.sphere)
+        # TODO: Parse lightdata here
+    return pdef
+
+class CityModelDef:
+    __slots__ = ('num_inst_cpv', 'bounding_sphere', 'lods', 'source')
+
+    def __init__(self):
+        self.num_inst_cpv = 0
+        self.bounding_sphere = (0.0, 0.0, 0.0, 0.0)
+        self.lods = {} # LOD level -> model extensions
+        self.source = None
+
+    def serialize(self):
+        if sum(len(exts) for exts in self.lods.values()) != self.source.count('lods'):
+            raise ValueError("Adding or removing city model lods isn't supported")
+        return self.source.serialize(self)
+
+def parse_city_model_def(text):
+    cc = CityModelDef()
+    cc.source = source = SourceLines(text)
+
+    # Instance count and bounding sphere are the first two lines
+    tokens = tokenize(source.lines)
+    l_idx, key, values, depth = next(tokens)
+    cc.num_inst_cpv = int(values[0])
+    source.add(('num_inst_cpv',), l_idx, key, cc.num_inst_cpv)
+    l_idx, key, values, depth = next(tokens)
+    cc.bounding_sphere = to_floats(values)
+    source.add(('bounding_sphere',), l_idx, key, cc.bounding_sphere)
+
+    # Model extensions of every lod block, one per line until the block closes
+    exts = None
+    for l_idx, key, values, depth in tokens:
+        if key == 'lod':
+            level = int(values[0])
+            exts = cc.lods[level] = []
+        elif exts is not None:
+            if key[0] == '}':
+                exts = None
+            else:
+                source.add(('lods', level, len(exts)), l_idx, None, key)
+                exts.append(key)
+    return cc
+
+# Files
+
+def read_text(filepath):
+    # newline='' keeps \r\n line endings, so written back files get the same bytes
+    with open(filepath, 'r', newline = '') as file:
+        return file.read()
+
+def read_hood(filepath):
+    return parse_hood(read_text(filepath))
+
+def read_prop_file(filepath):
+    return parse_prop_file(read_text(filepath))
+
+def read_level(filepath):
+    return parse_level(read_text(filepath))
+
+def read_pdef(filepath):
+    return parse_pdef(os.path.splitext(os.path.basename(filepath))[0], read_text(filepath))
+
+def read_city_model_def(filepath):
+    return parse_city_model_def(read_text(filepath))
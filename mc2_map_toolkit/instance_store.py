@@ -0,0 +1,189 @@
+import bpy
+import os
+import json
+import numpy as np
+from bpy.app.handlers import persistent
+from .formats import Hood, UniqueComponent, InstanceComponent, PropInstance
+from .fileio import atomic_open, atomic_write
+
+# Columnar store of a spawned city's components and props, one numpy structured array per map, saved as
+# <blend name>_<map>_instances.npy next to the .blend and memory-mapped on load. Names are ids into a string
+# table kept in <blend name>_<map>_instances_names.json, a table that only grows so ids stay valid. Filled at spawn time and
+# updated with every hood and prop class an export snapshots. Exports serialize hoods and prop classes that are
+# clean (see dirty.py) from it instead of walking their objects. It's written when the .blend is saved, like the
+# clean keys, so both always describe the objects of the saved file
+
+KIND_UNIQUE = 0
+KIND_INSTANCE = 1
+KIND_PROP = 2
+
+PROP_CLASSES = ('props', 'props_fixed', 'props_gfx')
+
+INSTANCE_DTYPE = np.dtype([
+    ('hood', 'i4'), # Name ids, the empty name for props
+    ('kind', 'u1'),
+    ('index', 'i4'), # Component index in the hood, prop index in its class
+    ('type', 'i4'), # Unique name, instance type or prop template
+    ('owner', 'i4'),
+    ('extension', 'i4'), # Instance extension or prop id
+    ('matrix', 'f8', (12,)), # 4 Matrix34 rows flattened
+    ('emin', 'f8', (3,)),
+    ('emax', 'f8', (3,)),
+    ('prop_class', 'u1'),
+])
+
+NO_MATRIX = (0.0,) * 12
+NO_EXTENTS = (0.0, 0.0, 0.0)
+
+class InstanceStore:
+    def __init__(self, data = None, names = None):
+        self.data = data if data is not None else np.zeros(0, dtype = INSTANCE_DTYPE)
+        self.names = names if names is not None else [''] # Name id -> name
+        self.name_ids = {name: idx for idx, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.data)
+
+    def intern(self, name):
+        idx = self.name_ids.get(name)
+        if idx is None:
+            idx = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return idx
+
+    def name_id(self, name):
+        # -1 for names the store never saw, matches no rows
+        return self.name_ids.get(name, -1)
+
+    def replace(self, remove_mask, rows):
+        # Drop the masked rows and append new ones with a single copy of the array
+        keep = self.data if remove_mask is None else self.data[~remove_mask]
+        self.data = np.concatenate((keep, np.array(rows, dtype = INSTANCE_DTYPE)))
+
+    # Hoods
+
+    def set_hoods(self, hoods):
+        # hoods: hood name -> formats.Hood
+        intern = self.intern
+        empty = intern('')
+        rows = []
+        for name, hood in hoods.items():
+            hood_id = intern(name)
+            rows.extend((hood_id, KIND_UNIQUE, idx, intern(u.name), empty, empty, NO_MATRIX, u.emin, u.emax, 0)
+                        for idx, u in enumerate(hood.uniques))
+            rows.extend((hood_id, KIND_INSTANCE, idx, intern(i.type), intern(i.owner), intern(i.extension), i.matrix, i.emin, i.emax, 0)
+                        for idx, i in enumerate(hood.instances))
+        hood_ids = [self.intern(name) for name in hoods]
+        self.replace(np.isin(self.data['hood'], hood_ids) & (self.data['kind'] != KIND_PROP), rows)
+
+    def has_hood(self, name):
+        return bool(np.any(self.data['hood'] == self.name_id(name)))
+
+    def to_hood(self, name):
+        names = self.names
+        rows = self.data[self.data['hood'] == self.name_id(name)]
+        rows = rows[np.lexsort((rows['index'], rows['kind']))]
+        hood = Hood(name)
+        for row in rows[rows['kind'] == KIND_UNIQUE].tolist():
+            hood.uniques.append(UniqueComponent(names[row[3]], row[7], row[8]))
+        for row in rows[rows['kind'] == KIND_INSTANCE].tolist():
+            hood.instances.append(InstanceComponent(names[row[3]], names[row[4]], names[row[5]], row[6], row[7], row[8]))
+        return hood
+
+    # Props
+
+    def set_props(self, prop_class, props):
+        # props: formats.PropInstance list of one class
+        intern = self.intern
+        empty = intern('')
+        class_idx = PROP_CLASSES.index(prop_class)
+        rows = [(empty, KIND_PROP, idx, intern(p.template), empty, intern(p.id), p.matrix, NO_EXTENTS, NO_EXTENTS, class_idx)
+                for idx, p in enumerate(props)]
+        self.replace((self.data['kind'] == KIND_PROP) & (self.data['prop_class'] == class_idx), rows)
+
+    def has_props(self, prop_class):
+        return bool(np.any((self.data['kind'] == KIND_PROP) & (self.data['prop_class'] == PROP_CLASSES.index(prop_class))))
+
+    def to_props(self, prop_class):
+        names = self.names
+        rows = self.data[(self.data['kind'] == KIND_PROP) & (self.data['prop_class'] == PROP_CLASSES.index(prop_class))]
+        rows = rows[np.argsort(rows['index'], kind = 'stable')]
+        return [PropInstance(names[row[5]], row[6], names[row[3]]) for row in rows.tolist()]
+
+    # Files
+
+    def save(self, filepath):
+        # Copy out of the memory map first, the mapped file is about to be replaced. The name table goes first,
+        # it only grows, so it always covers the ids of the array file next to it
+        self.data = np.array(self.data)
+        atomic_write(get_names_path(filepath), json.dumps(self.names))
+        with atomic_open(filepath, 'wb') as file:
+            np.save(file, self.data, allow_pickle = False)
+
+    @classmethod
+    def load(cls, filepath):
+        names_fp = get_names_path(filepath)
+        if not os.path.exists(names_fp):
+            return cls() # Written by an older version, gets refilled on the next spawn or export
+        data = np.load(filepath, mmap_mode = 'r', allow_pickle = False)
+        if data.dtype != INSTANCE_DTYPE:
+            return cls()
+        with open(names_fp, 'r') as file:
+            return cls(data, json.load(file))
+
+def get_names_path(filepath):
+    return os.path.splitext(filepath)[0] + '_names.json'
+
+
+_stores = {} # Map name -> InstanceStore of the open .blend
+
+def get_store_path(map_name):
+    # None while the .blend is unsaved, the store then only lives in memory until the file is saved
+    if not bpy.data.filepath:
+        return None
+    return os.path.splitext(bpy.data.filepath)[0] + '_' + map_name + '_instances.npy'
+
+def get_store(map_name):
+    store = _stores.get(map_name)
+    if store is None:
+        register() # The module is imported on first use, not when the add-on loads
+        fp = get_store_path(map_name)
+        store = InstanceStore.load(fp) if fp is not None and os.path.exists(fp) else InstanceStore()
+        _stores[map_name] = store
+    return store
+
+def save_store(map_name):
+    fp = get_store_path(map_name)
+    store = _stores.get(map_name)
+    if fp is not None and store is not None:
+        store.save(fp)
+
+def remove_store(map_name):
+    _stores.pop(map_name, None)
+    fp = get_store_path(map_name)
+    for path in (fp, get_names_path(fp)) if fp is not None else ():
+        if os.path.exists(path):
+            os.remove(path)
+
+@persistent
+def store_save_post(*args):
+    # Only written here, exports and spawns change the objects of the .blend too, which are saved now.
+    # Stores of an unsaved .blend or one saved under a new name are written next to it
+    for map_name in list(_stores):
+        save_store(map_name)
+
+@persistent
+def store_load_post(*args):
+    _stores.clear()
+
+def register():
+    if store_save_post not in bpy.app.handlers.save_post:
+        bpy.app.handlers.save_post.append(store_save_post)
+    if store_load_post not in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.append(store_load_post)
+
+def unregister():
+    if store_save_post in bpy.app.handlers.save_post:
+        bpy.app.handlers.save_post.remove(store_save_post)
+    if store_load_post in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(store_load_post)
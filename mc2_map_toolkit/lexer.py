@@ -0,0 +1,32 @@
+# Tokenizer shared by the MC2 text formats (.xmod, .cc, .pdef, .prop, .hood, .lvl). A file is read and
+# decoded once, then every non-empty line becomes one token (line index, key, values, depth) in a single pass,
+# depth being the number of { blocks the line is inside of. Splitting and number conversion run in C
+# (str.split, map), parsers only dispatch on keys
+
+def tokenize(lines):
+    depth = 0
+    for l_idx, line in enumerate(lines):
+        values = line.split()
+        if not values:
+            continue
+        key = values[0]
+        if key[0] == '}':
+            depth -= 1
+            yield l_idx, key, values[1:], depth
+        else:
+            yield l_idx, key, values[1:], depth
+            if values[-1] == '{':
+                depth += 1
+
+def to_floats(values):
+    return tuple(map(float, values))
+
+def to_ints(values):
+    return list(map(int, values))
+
+def is_number(token):
+    try:
+        float(token)
+        return True
+    except ValueError:
+        return False
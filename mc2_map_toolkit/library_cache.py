@@ -0,0 +1,94 @@
+import bpy
+import os
+import json
+import hashlib
+from contextlib import contextmanager
+from .manifest import source_changed
+from .fileio import atomic_write
+from .catalog import file_exists
+
+# Cache of a map's imported and spawned data as .blend libraries in city/<map>/cache: the city models, the
+# prop templates, the spawned props and every hood in a library of its own. index.json records the files
+# each library was made from, library file names carry a hash of those files' hashes. Loading appends the
+# libraries whose sources didn't change, everything else goes through the normal import and spawn
+
+CACHE_VERSION = 1
+INSTANCE_KEY = 'mc2_instance_collection'
+
+def get_cache_dir(city_path):
+    return os.path.join(city_path, 'cache')
+
+def load_index(cache_dir):
+    fp = os.path.join(cache_dir, 'index.json')
+    if os.path.exists(fp):
+        with open(fp, 'r') as file:
+            index = json.load(file)
+        if index.get('version') == CACHE_VERSION:
+            return index
+    return {'version': CACHE_VERSION, 'entries': {}}
+
+def save_index(cache_dir, index):
+    atomic_write(os.path.join(cache_dir, 'index.json'), json.dumps(index, indent = 1))
+
+def sources_key(sources, options):
+    # Hash of the source file hashes and the options the library was made with
+    data = json.dumps([sorted((p, record['hash']) for p, record in sources.items()), options], sort_keys = True)
+    return hashlib.sha1(data.encode()).hexdigest()[:16]
+
+def library_path(cache_dir, entry):
+    return os.path.join(cache_dir, entry['file'])
+
+def is_fresh(cache_dir, entry, options = None):
+    if options is not None and entry['options'] != options:
+        return False
+    if not file_exists(library_path(cache_dir, entry)):
+        return False
+    return not any(source_changed(p, record) for p, record in entry['sources'].items())
+
+def write_library(cache_dir, index, name, prefix, datablocks, sources, options = None, extra = None):
+    options = options or {}
+    file = '%s_%s.blend' % (prefix, sources_key(sources, options))
+    fp = os.path.join(cache_dir, file)
+    tmp_fp = os.path.join(cache_dir, '.' + file + '.tmp')
+    bpy.data.libraries.write(tmp_fp, set(datablocks), fake_user = True)
+    os.replace(tmp_fp, fp)
+
+    # Library of older sources
+    old = index['entries'].get(name)
+    if old is not None and old['file'] != file and os.path.exists(library_path(cache_dir, old)):
+        os.remove(library_path(cache_dir, old))
+
+    entry = {'file': file, 'sources': sources, 'options': options}
+    entry.update(extra or {})
+    index['entries'][name] = entry
+    return entry
+
+def append_library(cache_dir, entry, attr, names = None):
+    # Append data blocks of one type (like 'collections'), all of them without names
+    with bpy.data.libraries.load(library_path(cache_dir, entry), link = False) as (data_from, data_to):
+        setattr(data_to, attr, [n for n in getattr(data_from, attr) if names is None or n in names])
+    return [id for id in getattr(data_to, attr) if id is not None]
+
+@contextmanager
+def detached_instances(objects):
+    # Instanced collections are left out of hood and prop libraries, they'd pull a copy of every city model
+    # along. Objects keep the collection name to be pointed at the loaded city models again
+    detached = []
+    for obj in objects:
+        col = obj.instance_collection
+        if col is not None:
+            obj[INSTANCE_KEY] = col.name
+            obj.instance_collection = None
+            detached.append((obj, col))
+    try:
+        yield
+    finally:
+        for obj, col in detached:
+            obj.instance_collection = col
+
+def attach_instances(objects):
+    collections = bpy.data.collections
+    for obj in objects:
+        name = obj.get(INSTANCE_KEY)
+        if name is not None:
+            obj.instance_collection = collections.get(name)
@@ -0,0 +1,57 @@
+import os
+import json
+import hashlib
+
+# Source manifest of imported city models, stored as JSON in a scene custom property:
+# {'models': {model collection: {'cc': path, 'collections': [...], 'options': {...}, 'sources': {path: {size, mtime, hash}}}}}
+
+MANIFEST_KEY = 'mc2_manifest'
+
+def hash_file(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_record(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime': st.st_mtime_ns, 'hash': hash_file(path)}
+
+def source_changed(path, record):
+    # Cheap size/mtime check first, only hash files that look touched
+    try:
+        st = os.stat(path)
+    except OSError:
+        return True
+    if st.st_size == record['size'] and st.st_mtime_ns == record['mtime']:
+        return False
+    return hash_file(path) != record['hash']
+
+def load_manifest(scene):
+    data = scene.get(MANIFEST_KEY)
+    return json.loads(data) if data else {'models': {}}
+
+def save_manifest(scene, manifest):
+    scene[MANIFEST_KEY] = json.dumps(manifest)
+
+def record_model(manifest, model_name, cc_path, collections, sources, options):
+    manifest['models'][model_name] = {
+        'cc': cc_path,
+        'collections': list(collections),
+        'options': dict(options),
+        'sources': {p: file_record(p) for p in dict.fromkeys(sources) if os.path.exists(p)},
+    }
+
+def update_sources(entry):
+    # Record the current state of every source of a model that still exists
+    entry['sources'] = {p: file_record(p) for p in entry['sources'] if os.path.exists(p)}
+
+def changed_sources(entry):
+    return [p for p, record in entry['sources'].items() if source_changed(p, record)]
+
+def prune_manifest(manifest, collection_names):
+    # Drop models whose collection no longer exists
+    for model_name in list(manifest['models']):
+        if model_name not in collection_names:
+            del manifest['models'][model_name]
@@ -0,0 +1,200 @@
+import os
+import sys
+import tracemalloc
+
+# Memory high-water tracking at profiling stage boundaries. Process RSS is read at every stage boundary and
+# covers blender's own mesh and image data too, tracemalloc (only while tracking is on, it slows python
+# allocations down a lot) attributes the python side to source lines. A snapshot is kept of the stage
+# boundary where traced memory was highest, the report lists its largest lines and what grew since the start.
+# The budget is checked against RSS, it warns at the stage boundary that gets close to it, or has the
+# operator stop at its next pause point
+
+TOP_LINES = 20
+TOP_FILES = 10
+BUDGET_MARGIN = 0.9 # Share of the budget where it counts as about to be exceeded
+SNAPSHOT_STEP = 32 * 1024 * 1024 # Traced bytes a new high has to grow by before it's snapshotted again
+RESET_PEAK = hasattr(tracemalloc, 'reset_peak') # Python 3.9+, older ones only get memory at the boundaries
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB'):
+        if abs(size) < 1024:
+            return '%.1f %s' % (size, unit)
+        size /= 1024
+    return '%.2f GB' % size
+
+if sys.platform == 'win32':
+    import ctypes
+    from ctypes import wintypes
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                    ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+    _kernel32 = ctypes.WinDLL('kernel32')
+    _kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    _psapi = ctypes.WinDLL('psapi')
+    _psapi.GetProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS), wintypes.DWORD]
+    _psapi.GetProcessMemoryInfo.restype = wintypes.BOOL
+
+    def get_rss():
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        if not _psapi.GetProcessMemoryInfo(_kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            return None
+        return counters.WorkingSetSize
+
+elif os.path.exists('/proc/self/statm'):
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+    def get_rss():
+        try:
+            with open('/proc/self/statm', 'r') as file:
+                return int(file.read().split()[1]) * PAGE_SIZE
+        except (OSError, ValueError, IndexError):
+            return None
+
+else:
+    def get_rss():
+        # Peak RSS is all macOS offers without extra modules, it still catches a budget being passed
+        try:
+            import resource
+        except ImportError:
+            return None
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+class MemoryTracker:
+    def __init__(self, trace = True, budget = 0, action = 'WARN'):
+        self.trace = trace
+        self.budget = budget # Bytes, 0 for no budget
+        self.action = action # WARN or PAUSE
+        self.started_tracing = False
+        self.rss_start = get_rss()
+        self.rss_peak = self.rss_start or 0
+        self.rss_peak_stage = None
+        self.traced_start = 0
+        self.traced_peak = 0
+        self.stack = [] # [traced bytes at stage start, highest traced bytes seen since] of the open stages
+        self.stages = {} # Stage -> {'peak', 'retained', 'rss'}
+        self.files = {} # Stage -> file -> peak
+        self.warnings = []
+        self.warned = False
+        self.start_snapshot = None
+        self.peak_snapshot = None
+        self.peak_snapshot_stage = None
+        self.peak_snapshot_size = 0
+
+    def start(self):
+        if self.trace:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            self.traced_start = tracemalloc.get_traced_memory()[0]
+            self.start_snapshot = self.take_snapshot()
+
+    def stop(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def take_snapshot(self):
+        # Leave out the allocations of tracemalloc itself
+        return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+
+    def sample_traced(self):
+        current, peak = tracemalloc.get_traced_memory()
+        high = peak if RESET_PEAK else current
+        for entry in self.stack:
+            if high > entry[1]:
+                entry[1] = high
+        self.traced_peak = max(self.traced_peak, high)
+        return current
+
+    def sample_rss(self, name):
+        rss = get_rss()
+        if rss is None and self.trace:
+            rss = tracemalloc.get_traced_memory()[0] # Python allocations are better than no budget at all
+        if rss is not None and rss > self.rss_peak:
+            self.rss_peak = rss
+            self.rss_peak_stage = name
+        if rss is not None and self.budget and rss >= self.budget * BUDGET_MARGIN and not self.warned:
+            self.warned = True
+            self.warnings.append({'stage': name, 'rss': rss, 'budget': self.budget})
+            print('MC2 memory warning: %s at %s, the budget is %s' % (format_bytes(rss), name, format_bytes(self.budget)))
+        return rss
+
+    def enter(self, name):
+        self.sample_rss(name)
+        if self.trace:
+            current = self.sample_traced()
+            if RESET_PEAK:
+                tracemalloc.reset_peak()
+            self.stack.append([current, current])
+
+    def exit(self, name, file = None):
+        rss = self.sample_rss(name)
+        stage = self.stages.setdefault(name, {'peak': 0, 'retained': 0, 'rss': 0})
+        if rss is not None and rss > stage['rss']:
+            stage['rss'] = rss
+        if not self.trace:
+            return
+
+        current = self.sample_traced()
+        start, high = self.stack.pop()
+        peak = high - start
+        stage['peak'] = max(stage['peak'], peak)
+        stage['retained'] += current - start
+        if file is not None:
+            stage_files = self.files.setdefault(name, {})
+            stage_files[file] = max(stage_files.get(file, 0), peak)
+
+        # Keep a snapshot of the highest stage boundary for attributing memory to lines
+        if current > self.peak_snapshot_size + SNAPSHOT_STEP:
+            self.peak_snapshot = self.take_snapshot()
+            self.peak_snapshot_stage = name
+            self.peak_snapshot_size = current
+
+    def over_budget(self):
+        rss = get_rss()
+        if rss is None and self.trace:
+            rss = tracemalloc.get_traced_memory()[0]
+        return rss is not None and self.budget > 0 and rss >= self.budget * BUDGET_MARGIN, rss
+
+    def pause_message(self, name):
+        # Message when the operator should stop before the next item, else None
+        over, rss = self.over_budget()
+        if over and self.action == 'PAUSE':
+            return "memory is %s of the %s budget at %s" % (format_bytes(rss), format_bytes(self.budget), name)
+        return None
+
+    def report(self):
+        stages = {name: dict(stage) for name, stage in sorted(self.stages.items(), key = lambda item: -item[1]['peak'])}
+        top_files = {name: [[file, peak] for file, peak in sorted(files.items(), key = lambda item: -item[1])[:TOP_FILES]]
+                     for name, files in self.files.items()}
+        report = {
+            'rss_start': self.rss_start,
+            'rss_end': get_rss(),
+            'rss_peak': self.rss_peak,
+            'rss_peak_stage': self.rss_peak_stage,
+            'traced': self.trace,
+            'stages': stages,
+            'top_files': top_files,
+        }
+        if self.trace:
+            report['traced_peak'] = self.traced_peak - self.traced_start
+            report['peak_per_stage'] = RESET_PEAK # False: stage peaks are only sampled at stage boundaries
+
+        if self.peak_snapshot is not None:
+            report['peak_snapshot'] = {
+                'stage': self.peak_snapshot_stage,
+                'traced': self.peak_snapshot_size,
+                'top_lines': [[str(stat.traceback[0]), stat.size, stat.count] for stat in self.peak_snapshot.statistics('lineno')[:TOP_LINES]],
+                'growth_lines': [[str(stat.traceback[0]), stat.size_diff, stat.count_diff]
+                                 for stat in self.peak_snapshot.compare_to(self.start_snapshot, 'lineno')[:TOP_LINES]],
+            }
+        if self.budget:
+            report['budget'] = {'bytes': self.budget, 'action': self.action, 'warnings': self.warnings}
+        return report
@@ -0,0 +1,189 @@
+import bpy
+import os
+from .manifest import MANIFEST_KEY
+
+# Operators as blender registers them: names, labels, options, properties and polls. What they do is in the
+# class of the same name in operators.py, imported with everything it needs the first time an operator runs,
+# so enabling the add-on and drawing the panel don't load the importers and exporters.
+# Its methods are called with the registered operator as self, for its properties and report()
+
+def get_impl(name):
+    from . import operators
+    return getattr(operators, name)
+
+class LazyOperator:
+    def execute(self, context):
+        return get_impl(type(self).__name__).execute(self, context)
+
+class LazyBatchedOperator(LazyOperator):
+    # operators.BatchedOperator calls its own methods on self too
+    def invoke(self, context, event):
+        return get_impl(type(self).__name__).invoke(self, context, event)
+
+    def modal(self, context, event):
+        return get_impl(type(self).__name__).modal(self, context, event)
+
+    def cancel(self, context):
+        return get_impl(type(self).__name__).cancel(self, context)
+
+    def run(self, context):
+        return get_impl(type(self).__name__).run(self, context)
+
+    def end_run(self, context):
+        return get_impl(type(self).__name__).end_run(self, context)
+
+    def cancel_run(self, context):
+        return get_impl(type(self).__name__).cancel_run(self, context)
+
+class MC2_OT_SetupScene(LazyOperator, bpy.types.Operator):
+    bl_idname = "mc2.setup_scene"
+    bl_label = "Setup Scene"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    # @classmethod
+    # def poll(cls, context):
+    #     props = getattr(context.scene, "mc2_props", None)
+    #     if not props:
+    #         return False
+    #     valid, _ = validate_mc2_dir(props.mc2_dir)
+    #     return valid
+
+    @classmethod
+    def poll(cls, context):
+        map_name = context.scene.mc2_props.map_name
+        if map_name in bpy.data.collections:
+            return False
+        return True
+
+class MC2_OT_ClearScene(LazyOperator, bpy.types.Operator):
+    bl_idname = "mc2.clear_scene"
+    bl_label = "Clear Scene"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        map_name = context.scene.mc2_props.map_name
+        for col in bpy.data.collections:
+            if col.name.startswith(map_name):
+                return True
+        return False
+
+def get_snapshot_items(self, context):
+    return get_impl('get_snapshot_items')(self, context)
+
+class MC2_OT_RestoreBackup(LazyOperator, bpy.types.Operator):
+    bl_idname = "mc2.restore_backup"
+    bl_label = "Restore Backup"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    snapshot: bpy.props.EnumProperty(name="Snapshot", description="Restore the map files to how they were before this export", items=get_snapshot_items)
+
+    @classmethod
+    def poll(cls, context):
+        from .backup_store import BackupStore
+        mc2_dir = context.scene.mc2_props.mc2_dir
+        map_name = context.scene.mc2_props.map_name
+        return BackupStore(os.path.join(mc2_dir, 'city', map_name)).has_backups()
+
+    def invoke(self, context, event):
+        return get_impl(type(self).__name__).invoke(self, context, event)
+
+class MC2_OT_ImportCityModels(LazyBatchedOperator, bpy.types.Operator):
+    bl_idname = "mc2.import_city_models"
+    bl_label = "Import City Models"
+    #bl_options = {'REGISTER', 'UNDO'}
+
+class MC2_OT_UpgradeCityModels(LazyOperator, bpy.types.Operator):
+    bl_idname = "mc2.upgrade_city_models"
+    bl_label = "Upgrade to Full Detail"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        city_models_col = bpy.data.collections.get(context.scene.mc2_props.map_name + '_city_models')
+        if city_models_col is None:
+            return False
+        return any(c.get('mc2_preview') for c in city_models_col.children)
+
+class MC2_OT_SyncCityModels(LazyOperator, bpy.types.Operator):
+    bl_idname = "mc2.sync_city_models"
+    bl_label = "Sync City Models"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return MANIFEST_KEY in context.scene
+
+# Might not need this
+class MC2_OT_ImportProps_Old(LazyOperator, bpy.types.Operator):
+    bl_idname = "mc2.import_props_old"
+    bl_label = "Import Props Old"
+    bl_options = {'REGISTER', 'UNDO'}
+
+class MC2_OT_ImportProps(LazyBatchedOperator, bpy.types.Operator):
+    bl_idname = "mc2.import_props"
+    bl_label = "Import Props"
+    bl_options = {'REGISTER', 'UNDO'}
+
+class MC2_OT_SpawnCityModels(LazyBatchedOperator, bpy.types.Operator):
+    bl_idname = "mc2.spawn_city_models"
+    bl_label = "Spawn City Models"
+    bl_options = {'REGISTER', 'UNDO'}
+
+class MC2_OT_SpawnProps(LazyBatchedOperator, bpy.types.Operator):
+    bl_idname = "mc2.spawn_props"
+    bl_label = "Spawn Props"
+    bl_options = {'REGISTER', 'UNDO'}
+
+class MC2_OT_WriteCityCache(LazyOperator, bpy.types.Operator):
+    bl_idname = "mc2.write_city_cache"
+    bl_label = "Write City Cache"
+    bl_options = {'REGISTER'}
+
+    @classmethod
+    def poll(cls, context):
+        return context.scene.mc2_props.map_name + '_city_models' in bpy.data.collections
+
+class MC2_OT_LoadCityCache(LazyOperator, bpy.types.Operator):
+    bl_idname = "mc2.load_city_cache"
+    bl_label = "Load City From Cache"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return context.scene.mc2_props.map_name + '_hoods' in bpy.data.collections
+
+class MC2_OT_ExportHoods(LazyOperator, bpy.types.Operator):
+    bl_idname = "mc2.export_hoods"
+    bl_label = "Export Hoods"
+    bl_options = {'REGISTER', 'UNDO'}
+
+class MC2_OT_ExportProps(LazyOperator, bpy.types.Operator):
+    bl_idname = "mc2.export_props"
+    bl_label = "Export Props"
+    bl_options = {'REGISTER', 'UNDO'}
+
+classes = (
+    MC2_OT_SetupScene,
+    MC2_OT_ClearScene,
+    MC2_OT_RestoreBackup,
+    MC2_OT_ImportCityModels,
+    MC2_OT_UpgradeCityModels,
+    MC2_OT_SyncCityModels,
+    MC2_OT_ImportProps_Old,
+    MC2_OT_ImportProps,
+    MC2_OT_SpawnCityModels,
+    MC2_OT_SpawnProps,
+    MC2_OT_WriteCityCache,
+    MC2_OT_LoadCityCache,
+    MC2_OT_ExportHoods,
+    MC2_OT_ExportProps,
+)
+
+def register():
+    for cls in classes:
+        bpy.utils.register_class(cls)
+
+def unregister():
+    for cls in reversed(classes):
+        bpy.utils.unregister_class(cls)
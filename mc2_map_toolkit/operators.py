@@ -1,64 +1,135 @@
 import bpy
 import os
-import shutil
+import time
 import math, mathutils
-from bpy_extras.io_utils import axis_conversion
-from .utils import create_get_collection, link_col_to_col, set_active_collection, calc_emin_emax, to_matrix34, write_file, make_backup, round_vector3, translate_vector3, vector3_to_string
-from .import_xmod import import_xmod
-
-class MC2_OT_SetupScene(bpy.types.Operator):
-    bl_idname = "mc2.setup_scene"
-    bl_label = "Setup Scene"
-    bl_options = {'REGISTER', 'UNDO'}
-
-    # @classmethod
-    # def poll(cls, context):
-    #     props = getattr(context.scene, "mc2_props", None)
-    #     if not props:
-    #         return False
-    #     valid, _ = validate_mc2_dir(props.mc2_dir)
-    #     return valid
-
-    @classmethod
-    def poll(cls, context):
-        map_name = context.scene.mc2_props.map_name
-        if map_name in bpy.data.collections:
-            return False
-        return True
-
+from .utils import CollectionRegistry, calc_emin_emax, to_matrix34, write_file, round_vector3, translate_vector3, vector3_to_string, reload_texture, collect_map_ids, write_file_if_changed, matrix34_values, from_matrix34
+from .streaming import get_chunk_key, get_chunk_collection, invalidate_stream_cache
+from .region import get_region_contents
+from .writers import PROP_HEADER_TEMPLATE
+from .dirty import is_dirty, mark_clean, mark_dirty, mark_all_dirty, get_cached_block, save_dirty_state, restore_dirty_state, forget_saved_clean
+from .backup_store import BackupStore, BackupRun
+from .fileio import fsync_dirs
+from .catalog import find_file, file_exists, list_files, invalidate
+from .formats import Hood, UniqueComponent, InstanceComponent, PropTemplate, PropInstance, read_level, read_hood, read_prop_file, read_pdef, read_city_model_def, to_newline
+from .profiling import ProfileSession, profiled, stage, count, budget_pause
+from .manifest import MANIFEST_KEY, load_manifest, save_manifest, record_model, update_sources, changed_sources, prune_manifest, file_record
+from .library_cache import get_cache_dir, load_index, save_index, write_library, append_library, library_path, is_fresh, detached_instances, attach_instances
+from .texture_stream import pending_count
+from .texture_budget import restore_evicted_images
+
+# What the operators registered in operator_defs.py do, imported when the first one runs
+
+BATCH_SECONDS = 0.1 # Work done per modal tick before blender gets to redraw and handle events
+BATCH_TIMER = 0.001
+NAVIGATION_EVENTS = {'MOUSEMOVE', 'INBETWEEN_MOUSEMOVE', 'MIDDLEMOUSE', 'WHEELUPMOUSE', 'WHEELDOWNMOUSE',
+                     'TRACKPADPAN', 'TRACKPADZOOM', 'NDOF_MOTION'} # Passed on to the viewport while a batched operator runs
+ROLLBACK_DATA = ('objects', 'meshes', 'materials', 'images', 'node_groups', 'collections')
+
+class BatchedOperator:
+    # Base of operators that work through their run() generator in time slices from a modal timer, so blender
+    # keeps redrawing with a progress bar and the viewport can be navigated. run() yields (done, total) after
+    # every unit of work and returns the operator result. Esc cancels and removes every data block created
+    # since the start, run() only saves the manifest and instance store at its end so they stay as they were.
+    # execute() runs it in one go, for scripts and redo
+    @profiled
+    def execute(self, context):
+        steps = self.run(context)
+        while True:
+            try:
+                next(steps)
+            except StopIteration as stop:
+                invalidate_stream_cache()
+                return stop.value
+
+    def invoke(self, context, event):
+        self.session = ProfileSession(self, context)
+        self.before = {attr: set(getattr(bpy.data, attr)) for attr in ROLLBACK_DATA}
+        self.steps = self.run(context)
+        wm = context.window_manager
+        wm.progress_begin(0, 100)
+        self.timer = wm.event_timer_add(BATCH_TIMER, window = context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            return self.cancel_run(context)
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'} if event.type in NAVIGATION_EVENTS else {'RUNNING_MODAL'}
+
+        deadline = time.perf_counter() + BATCH_SECONDS
+        try:
+            with self.session:
+                done, total = next(self.steps)
+                while time.perf_counter() < deadline:
+                    done, total = next(self.steps)
+        except StopIteration as stop:
+            self.end_run(context)
+            return stop.value
+        except Exception:
+            self.cancel_run(context)
+            raise
+
+        context.window_manager.progress_update(int(100 * done / total) if total else 0)
+        context.workspace.status_text_set(f"{self.bl_label}: {int(done)} of {total}, Esc to cancel")
+        return {'RUNNING_MODAL'}
+
+    def end_run(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self.timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+        self.session.finish(context)
+        invalidate_stream_cache() # Streaming picks up the added objects, or forgets the ones a cancel removes
+
+    def cancel_run(self, context):
+        self.steps.close()
+        self.end_run(context)
+        created = [id_data for attr in ROLLBACK_DATA for id_data in getattr(bpy.data, attr) if id_data not in self.before[attr]]
+        bpy.data.batch_remove(created)
+        self.report({'WARNING'}, f"{self.bl_label} cancelled, removed the {len(created)} data blocks it created")
+        return {'CANCELLED'}
+
+    def cancel(self, context):
+        # Blender ending the operator, like when another file gets loaded
+        self.steps.close()
+        self.end_run(context)
+
+class MC2_OT_SetupScene:
     def execute(self, context):
         # scene = bpy.context.scene
         # bpy.data.scenes.new("Scene")
         # bpy.data.scenes.remove(scene, do_unlink=True)
 
         map_name = context.scene.mc2_props.map_name
-        city_col = create_get_collection(map_name)
+        registry = CollectionRegistry(context)
+        city_col = registry.create_get(map_name)
 
-        city_source_col = create_get_collection(map_name + '_source')
-        link_col_to_col(city_source_col, city_col)
+        city_source_col = registry.create_get(map_name + '_source')
+        registry.link(city_source_col, city_col)
         #city_source_col.hide_viewport = True
         #city_source_col.hide_render = True
 
-        city_hoods_col = create_get_collection(map_name + '_hoods')
-        link_col_to_col(city_hoods_col, city_col)
+        city_hoods_col = registry.create_get(map_name + '_hoods')
+        registry.link(city_hoods_col, city_col)
 
-        prop_templates_col = create_get_collection(map_name + '_prop_templates')
-        link_col_to_col(prop_templates_col, city_source_col)
+        prop_templates_col = registry.create_get(map_name + '_prop_templates')
+        registry.link(prop_templates_col, city_source_col)
 
-        city_models_col = create_get_collection(map_name + '_city_models')
-        link_col_to_col(city_models_col, city_source_col)
+        city_models_col = registry.create_get(map_name + '_city_models')
+        registry.link(city_models_col, city_source_col)
 
-        city_prop_col = create_get_collection(map_name + '.prop') # Parent prop collection
-        link_col_to_col(city_prop_col, city_col)
+        city_prop_col = registry.create_get(map_name + '.prop') # Parent prop collection
+        registry.link(city_prop_col, city_col)
 
-        city_props = create_get_collection(map_name + '_props') # Regular props collection (hitable/movable)
-        link_col_to_col(city_props, city_prop_col)
+        city_props = registry.create_get(map_name + '_props') # Regular props collection (hitable/movable)
+        registry.link(city_props, city_prop_col)
 
-        city_props_fixed = create_get_collection(map_name + '_props_fixed') # Fixed props collection (immovable)
-        link_col_to_col(city_props_fixed, city_prop_col)
+        city_props_fixed = registry.create_get(map_name + '_props_fixed') # Fixed props collection (immovable)
+        registry.link(city_props_fixed, city_prop_col)
 
-        city_props_gfx = create_get_collection(map_name + '_props_gfx') # Visual-only props collection
-        link_col_to_col(city_props_gfx, city_prop_col)
+        city_props_gfx = registry.create_get(map_name + '_props_gfx') # Visual-only props collection
+        registry.link(city_props_gfx, city_prop_col)
 
         # Setup camera settings
         context.space_data.lens = 70
@@ -68,309 +139,433 @@ class MC2_OT_SetupScene(bpy.types.Operator):
 
         return {'FINISHED'}
 
-class MC2_OT_ClearScene(bpy.types.Operator):
-    bl_idname = "mc2.clear_scene"
-    bl_label = "Clear Scene"
-    bl_options = {'REGISTER', 'UNDO'}
-
-    @classmethod
-    def poll(cls, context):
-        map_name = context.scene.mc2_props.map_name
-        for col in bpy.data.collections:
-            if col.name.startswith(map_name):
-                return True
-        return False
-
+class MC2_OT_ClearScene:
     def execute(self, context):
-        # TODO: Find a faster way for this
+        from .instance_store import remove_store
         map_name = context.scene.mc2_props.map_name
-        col = bpy.data.collections.get(map_name)
-
-        for col in bpy.data.collections:
-            if col.name.startswith(map_name):
-                objs = [o for o in col.objects if o.users == 1]
-                while objs:
-                    bpy.data.objects.remove(objs.pop())
-                bpy.data.collections.remove(col)
-                
-        # Clean up unused data blocks
-        bpy.ops.outliner.orphans_purge(do_local_ids=True, do_linked_ids=True, do_recursive=True)
+
+        # Remove everything the map owns in one go, leaving unrelated data alone
+        ids = collect_map_ids(map_name)
+        bpy.data.batch_remove(ids)
+        invalidate_stream_cache()
+        remove_store(map_name)
+        mark_all_dirty()
+
+        # Forget the sources of removed city models
+        if MANIFEST_KEY in context.scene:
+            manifest = load_manifest(context.scene)
+            prune_manifest(manifest, set(c.name for c in bpy.data.collections))
+            save_manifest(context.scene, manifest)
         
-        self.report({'INFO'}, "Scene cleared")
+        self.report({'INFO'}, f"Scene cleared, removed {len(ids)} data blocks")
 
         return {'FINISHED'}
 
-class MC2_OT_RestoreBackup(bpy.types.Operator):
-    bl_idname = "mc2.restore_backup"
-    bl_label = "Restore Backup"
-    bl_options = {'REGISTER', 'UNDO'}
+_snapshot_items = [] # Keeps the dynamic enum items alive, blender doesn't hold a reference
 
-    @classmethod
-    def poll(cls, context):
-        mc2_dir = context.scene.mc2_props.mc2_dir
-        map_name = context.scene.mc2_props.map_name
-        city_backup_path = os.path.join(mc2_dir, 'city', map_name, 'backup')
+def get_snapshot_items(self, context):
+    mc2_dir = context.scene.mc2_props.mc2_dir
+    map_name = context.scene.mc2_props.map_name
+    store = BackupStore(os.path.join(mc2_dir, 'city', map_name))
 
-        if os.path.exists(city_backup_path):
-            return True
-        return False
+    _snapshot_items.clear()
+    snapshots = store.list_snapshots()
+    for idx, snapshot_id in enumerate(snapshots):
+        snapshot = store.load_snapshot(snapshot_id)
+        label = "Original" if idx == 0 else "Before export " + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(snapshot['time']))
+        _snapshot_items.append((snapshot_id, label, f"{len(snapshot['files'])} files backed up"))
+    if store.legacy_files() and not snapshots:
+        _snapshot_items.append(('LEGACY', "Original", "Backup from an older version"))
+    return _snapshot_items
+
+class MC2_OT_RestoreBackup:
+    def invoke(self, context, event):
+        return context.window_manager.invoke_props_dialog(self)
 
     def execute(self, context):
         mc2_dir = context.scene.mc2_props.mc2_dir
         map_name = context.scene.mc2_props.map_name
         city_path = os.path.join(mc2_dir, 'city', map_name)
-        city_backup_path = os.path.join(city_path, 'backup')
-
-        for backup in os.listdir(city_backup_path):
-            backup_path = os.path.join(city_backup_path, backup)
-            file_path = os.path.join(city_path, backup)
-            shutil.copyfile(backup_path, file_path)
 
-        self.report({'INFO'}, "Restored backup")
+        store = BackupStore(city_path)
+        store.migrate_legacy()
+        snapshots = store.list_snapshots()
+        snapshot_id = self.snapshot if self.snapshot in snapshots else snapshots[0]
+
+        try:
+            restored = store.restore(snapshot_id)
+        except ValueError as ex:
+            self.report({'ERROR'}, f"Restoring backup failed, no files changed: {ex}")
+            return {'CANCELLED'}
+        mark_all_dirty() # Files on disk no longer match the last export
+        forget_saved_clean(map_name)
+        invalidate(city_path)
+
+        self.report({'INFO'}, f"Restored backup, {len(restored)} files changed")
         return {'FINISHED'}
 
-class MC2_OT_ImportCityModels(bpy.types.Operator):
-    bl_idname = "mc2.import_city_models"
-    bl_label = "Import City Models"
-    #bl_options = {'REGISTER', 'UNDO'}
-
-    def execute(self, context):
+def get_texture_paths(objs):
+    # Source .tex files of the images used by the materials of objects
+    paths = []
+    for obj in objs:
+        if obj.data is None:
+            continue
+        for mat in getattr(obj.data, 'materials', []):
+            if mat is None or mat.node_tree is None:
+                continue
+            for node in mat.node_tree.nodes:
+                if node.type == 'TEX_IMAGE' and node.image is not None and node.image.filepath_raw.lower().endswith('.tex'):
+                    paths.append(node.image.filepath_raw)
+    return paths
+
+def import_city_model(registry, cc_path, city_models_col, import_all_lods = False, preview = False, mip_level = 0, manifest = None):
+    from .import_xmod import import_xmod # Imported on first use, like every heavy module, keeps the add-on quick to load
+    city_models_path, file = os.path.split(cc_path)
+    basename = file.rsplit('.')[0]
+
+    # Create model collection
+    model_col = registry.create_get(basename) # (basename.rsplit('#')[0])
+    registry.link(model_col, city_models_col)
+
+    cc = read_city_model_def(cc_path)
+
+    # Highest detail lod that has models (lod 0, or lod 1 if there are no LOD0s)
+    levels = sorted(level for level, exts in cc.lods.items() if exts)
+    if preview:
+        levels = levels[-1:] # Lowest detail lod only
+    elif not import_all_lods:
+        levels = levels[:1]
+
+    lod_cols = []
+    sources = [cc_path] # Files this model was built from, for the source manifest
+    models = []
+    for level in levels:
+        if level == levels[0]:
+            lod_col = model_col
+        else:
+            # Lower lods get their own collection for instances to switch to
+            lod_col = registry.create_get(basename + '_lod' + str(level))
+            registry.link(lod_col, city_models_col)
+            lod_col['mc2_lod_base'] = model_col.name
+        lod_cols.append(lod_col.name)
+
+        # Import models
+        for ext in cc.lods[level]:
+            name = basename + '_' + str(level) + '_' + ext + '.xmod'
+            fp = find_file(os.path.join(city_models_path, name))
+            if fp is not None:
+                model = import_xmod(fp, has_xbcpv = cc.num_inst_cpv > 0, mip_level = mip_level, collection = lod_col)
+                model['mc2_source'] = name # Matches re-imported models to the ones they replace
+                models.append(model)
+                sources.append(fp)
+                xbcpv_fp = find_file(os.path.splitext(fp)[0] + '.xbcpv')
+                if xbcpv_fp is not None:
+                    sources.append(xbcpv_fp)
+                if preview:
+                    model['mc2_preview'] = True # Replaced by the full detail model on upgrade
+
+            else: print(os.path.join(city_models_path, name) + ' does not exist.')
+
+    # Store lod info on the model collection for distance based lod switching
+    model_col['mc2_bounding_sphere'] = list(cc.bounding_sphere)
+    model_col['mc2_preview'] = preview
+    if len(lod_cols) > 1:
+        model_col['mc2_lod_base'] = model_col.name
+        model_col['mc2_lods'] = lod_cols
+
+    if manifest is not None:
+        options = {'import_all_lods': import_all_lods, 'preview': preview, 'mip_level': mip_level}
+        record_model(manifest, model_col.name, cc_path, lod_cols, sources + get_texture_paths(models), options)
+
+    return model_col
+
+def remove_city_model(registry, collection_names):
+    # Remove a model's collections together with their objects and meshes
+    cols = [registry.get(n) for n in collection_names if registry.get(n) is not None]
+    objs = [o for c in cols for o in c.objects]
+    meshes = [o.data for o in objs if isinstance(o.data, bpy.types.Mesh) and o.data.users == 1]
+    bpy.data.batch_remove(cols + objs + meshes)
+    for n in collection_names:
+        registry.collections.pop(n, None)
+
+def reimport_city_model(registry, entry, city_models_col, manifest):
+    # Import a model again and swap the new mesh data into the existing objects,
+    # so collection instances and object references keep working
+    before = {}
+    for n in entry['collections']:
+        col = registry.get(n)
+        if col is not None:
+            before[n] = set(col.objects)
+
+    model_col = import_city_model(registry, entry['cc'], city_models_col, manifest = manifest, **entry['options'])
+    new_entry = manifest['models'][model_col.name]
+
+    garbage = []
+    for n in new_entry['collections']:
+        col = registry.get(n)
+        old_objs = before.pop(n, set())
+        old_by_source = {o.get('mc2_source', o.name): o for o in old_objs}
+
+        for new in [o for o in col.objects if o not in old_objs]:
+            old = old_by_source.pop(new.get('mc2_source'), None)
+            if old is None:
+                continue # Model part that didn't exist before, keep it
+            garbage.extend([new, old.data])
+            old.data = new.data
+            if 'CPV IDs' in new:
+                old['CPV IDs'] = new['CPV IDs']
+
+        # Model parts that are gone from the .cc file
+        for old in old_by_source.values():
+            garbage.append(old)
+            if old.data is not None and old.data.users == 1:
+                garbage.append(old.data)
+
+    bpy.data.batch_remove(garbage)
+
+    # Lod collections that aren't imported anymore
+    if before:
+        remove_city_model(registry, list(before))
+
+    for n in new_entry['collections']:
+        for obj in registry.get(n).objects:
+            if 'mc2_source' in obj and obj.data is not None:
+                obj.data.name = os.path.splitext(obj['mc2_source'])[0]
+
+class MC2_OT_ImportCityModels(BatchedOperator):
+    def run(self, context):
         #self.report({'INFO'}, "Importing city models...")
     
-        mc2_dir = context.scene.mc2_props.mc2_dir
-        map_name = context.scene.mc2_props.map_name
+        props = context.scene.mc2_props
+        mc2_dir = props.mc2_dir
+        map_name = props.map_name
         city_path = os.path.join(mc2_dir, 'city', map_name)
         city_models_path = os.path.join(city_path, 'models')
 
-        # Get collections
-        city_models_col = create_get_collection(map_name + '_city_models')
+        preview = props.import_profile == 'PREVIEW'
+        mip_level = props.preview_mip_level if preview else 0
 
-        # Parse .cc files
-        max_cc_search = 4
+        # City models needed by the hoods of the selected region
+        region = get_region_contents(context)
 
-        for file in os.listdir(city_models_path):
-            if file.endswith('.cc'):
-                cc_path = os.path.join(city_models_path, file)
-                basename = file.rsplit('.')[0]
+        # Get collections
+        registry = CollectionRegistry(context)
+        city_models_col = registry.create_get(map_name + '_city_models')
 
-                # Create model collection and set it as active
-                model_col = create_get_collection(basename) # (basename.rsplit('#')[0])
-                link_col_to_col(model_col, city_models_col)
-                set_active_collection(model_col.name)
-                
-                with open(cc_path, 'r') as f:
-                    lines = f.readlines()
-                    
-                    num_inst_cpv = int(lines[0].split()[1])
-                    bounding_sphere = [eval(s) for s in lines[1].split()[1:]]
-                    
-                    # Parse model extensions and format names            
-                    names = []            
-                    islod1 = False
-                    
-                    for i, line in enumerate(lines):
-                        if line.startswith('lod 0'):      
-                            # Check if LOD0s exist, if not, skip to LOD1 as the highest detail model
-                            if lines[i + 1].startswith('}'):
-                                islod1 = True
-                                break
-                            
-                            for j in range(1, max_cc_search):
-                                if not lines[i + j].startswith('}'):
-                                    ext = lines[i + j].strip()
-                                    names.append(basename + '_0_' + ext + '.xmod')
-                                else: break
-                        
-                        if line.startswith('lod 1') and islod1:
-                            for j in range(1, max_cc_search):
-                                if not lines[i + j].startswith('}'):
-                                    ext = lines[i + j].strip()
-                                    names.append(basename + '_1_' + ext + '.xmod')
-                                else: break
-                    
-                    # Import models
-                    for name in names:
-                        fp = os.path.join(city_models_path, name)
-                        if os.path.exists(fp):
-                            if num_inst_cpv > 0:
-                                model = import_xmod(fp, has_xbcpv = True)
-                            elif num_inst_cpv == 0:
-                                model = import_xmod(fp, has_xbcpv = False)
-                            
-                        else: print(fp + ' does not exist.')
+        manifest = load_manifest(context.scene)
+        paused = None
+
+        # Parse .cc files
+        cc_files = [file for file in list_files(city_models_path, '.cc')
+                    if region is None or file.rsplit('.')[0].lower() in region.models]
+        for idx, file in enumerate(cc_files):
+            # Imported by an earlier run, one that was paused by the memory budget picks up from here
+            model_name = file.rsplit('.')[0]
+            if model_name in manifest['models'] and registry.get(model_name) is not None:
+                continue
+            paused = budget_pause('import.city_model')
+            if paused is not None:
+                break
+            cc_path = os.path.join(city_models_path, file)
+            with stage('import.city_model', cc_path):
+                import_city_model(registry, cc_path, city_models_col, props.import_all_lods, preview, mip_level, manifest)
+            yield idx + 1, len(cc_files)
+
+        save_manifest(context.scene, manifest)
+
+        if paused is not None:
+            self.report({'WARNING'}, f"Paused importing {map_name} city models, {paused}. Save and reopen the file, then import again to continue")
+            return {'FINISHED'}
         
         self.report({'INFO'}, f"Imported {map_name} city models")
         return {'FINISHED'}
 
-# Might not need this
-class PropDef:
-    def __init__(self):
-        self.name = None
-        self.numlods = 0
-        self.lods = None # List of LOD levels (0, 2), etc.
-        self.sphere = None
-        # self.numlights = 0
-        # self.lights
-        # Prop template stuff
-        self.animation = None
-        self.numparts = 0
-        self.parts = [] # List of dictionaries (name/offset)
-        self.fixedobject = 0
-        self.obstacle = 0
-        self.gfxonly = 0
-        self.drivable = 0
-        self.far = 0
-
-class MC2_OT_ImportProps_Old(bpy.types.Operator):
-    bl_idname = "mc2.import_props_old"
-    bl_label = "Import Props Old"
-    bl_options = {'REGISTER', 'UNDO'}
+class MC2_OT_UpgradeCityModels:
+    @profiled
+    def execute(self, context):
+        props = context.scene.mc2_props
+        mc2_dir = props.mc2_dir
+        map_name = props.map_name
+        city_models_path = os.path.join(mc2_dir, 'city', map_name, 'models')
+
+        registry = CollectionRegistry(context)
+        city_models_col = registry.create_get(map_name + '_city_models')
+        manifest = load_manifest(context.scene)
+
+        # Replace the preview models inside their collections, so spawned instances keep pointing at them
+        for model_col in list(city_models_col.children):
+            if not model_col.get('mc2_preview'):
+                continue
+
+            preview_objs = [o for o in model_col.objects if o.get('mc2_preview')]
+            preview_meshes = [o.data for o in preview_objs if o.data is not None]
+            bpy.data.batch_remove(preview_objs + preview_meshes)
+
+            cc_path = find_file(os.path.join(city_models_path, model_col.name + '.cc'))
+            if cc_path is not None:
+                with stage('import.city_model', cc_path):
+                    import_city_model(registry, cc_path, city_models_col, props.import_all_lods, manifest = manifest)
+            else: print(model_col.name + '.cc does not exist.')
+
+        save_manifest(context.scene, manifest)
+        invalidate_stream_cache() # Lods of re-imported models may have changed
+
+        # Decode preview textures again at full resolution
+        texture_path = os.path.join(mc2_dir, 'texture_x')
+        for image in bpy.data.images:
+            if image.get('mc2_mip_level', 0) > 0:
+                tex_fp = find_file(os.path.join(texture_path, image.name + '.tex')) # Looked up case insensitively, texture_x mixes cases
+                if tex_fp is not None:
+                    reload_texture(image, tex_fp)
+                else: print(image.name + '.tex does not exist.')
+
+        self.report({'INFO'}, f"Upgraded {map_name} city models to full detail")
+        return {'FINISHED'}
+
+class MC2_OT_SyncCityModels:
+    @profiled
+    def execute(self, context):
+        map_name = context.scene.mc2_props.map_name
+
+        registry = CollectionRegistry(context)
+        city_models_col = registry.create_get(map_name + '_city_models')
+
+        manifest = load_manifest(context.scene)
+        prune_manifest(manifest, registry.collections)
+
+        reimported = removed = 0
+        reloaded_textures = set()
+
+        for model_name, entry in list(manifest['models'].items()):
+            # Source .cc is gone, remove the model
+            if not file_exists(entry['cc']):
+                remove_city_model(registry, entry['collections'])
+                del manifest['models'][model_name]
+                removed += 1
+                continue
+
+            changed = changed_sources(entry)
+            if not changed:
+                continue
+
+            # Textures get decoded into their existing images, everything else needs the model imported again
+            if any(not p.lower().endswith('.tex') for p in changed):
+                with stage('import.city_model', entry['cc']):
+                    reimport_city_model(registry, entry, city_models_col, manifest)
+                reimported += 1
+
+            for p in changed:
+                if p.lower().endswith('.tex') and p not in reloaded_textures and file_exists(p):
+                    for image in bpy.data.images:
+                        if image.filepath_raw == p:
+                            reload_texture(image, p)
+                    reloaded_textures.add(p)
 
+            if model_name in manifest['models']:
+                update_sources(manifest['models'][model_name])
+
+        save_manifest(context.scene, manifest)
+        invalidate_stream_cache() # Lods of re-imported models may have changed
+
+        self.report({'INFO'}, f"Synced {map_name} city models: {reimported} re-imported, {removed} removed, {len(reloaded_textures)} textures reloaded")
+        return {'FINISHED'}
+
+# Might not need this
+class MC2_OT_ImportProps_Old:
     def execute(self, context):
+        from .import_xmod import import_xmod
         mc2_dir = context.scene.mc2_props.mc2_dir
         map_name = context.scene.mc2_props.map_name
         city_path = os.path.join(mc2_dir, 'city', map_name)
         city_models_path = os.path.join(city_path, 'models')
 
         # Get collections
-        prop_templates_col = create_get_collection(map_name + '_prop_templates')
-        set_active_collection(prop_templates_col.name)
+        registry = CollectionRegistry(context)
+        prop_templates_col = registry.create_get(map_name + '_prop_templates')
 
         # Parse .pdef files
         pdefs = []
-        for file in os.listdir(city_path):
-            if file.endswith('.pdef'):
-                basename = file.rsplit('.')[0]
-                pdef = PropDef()
-                pdef.name = basename.lower()
-
-                pdef_fp = os.path.join(city_path, file)
-                with open(pdef_fp, 'r') as file:                
-                    lines = file.read().splitlines()
-                    for l in lines:
-                        if l.startswith('lods:'):
-                            tok = l.split()
-                            pdef.numlods = int(tok[1])
-                            pdef.lods = tok[-pdef.numlods:] # [0, 2], etc
-                        if l.startswith('sphere:'):
-                            tok = l.split()
-                            pdef.sphere = (float(tok[1]), float(tok[2]), float(tok[3]), float(tok[4]))
-                        # TODO: Parse lightdata here
-                pdefs.append(pdef)
+        for file in list_files(city_path, '.pdef'):
+            pdef = read_pdef(os.path.join(city_path, file))
+            pdef.name = pdef.name.lower()
+            pdefs.append(pdef)
         
         # Parse .prop file
-        num_prop_types = 0
-
-        city_props_fp = os.path.join(city_path, map_name + '.prop')
-        if os.path.exists(city_props_fp):
-            with open(city_props_fp, 'r') as file:
-                lines = file.read().splitlines()
-
-                #prop_count = int(lines[0].split()[1])
-                #fixed_prop_count = int(lines[1].split()[1])
-                #gfx_prop_count = int(lines[2].split()[1])
-                num_prop_types = int(lines[3].split()[1])
-
-                prop_type_ctr = 1
-
-                # Parse prop templates
-                for l_idx, l in enumerate(lines):
-                    if prop_type_ctr <= num_prop_types:
-                        if l.startswith('prop_template '):
-                            prop_idx = num_prop_types - prop_type_ctr # Reverse idx
-                            prop_template_name = l.split()[1].lower()
-
-                            if prop_template_name != pdefs[prop_idx].name:
-                                # TODO: Create safer name matching, it's not always in reverse-alphabetical order! See paris.prop
-                                print('Prop pdef mismatch:', prop_template_name, pdefs[prop_idx].name)
-                                break
-                            
-                            # Read prop template block                        
-                            for i in range(64): # Max amount of lines for a prop template
-                                idx = l_idx + i
-                                line_tok = lines[idx].split()
-
-                                if line_tok[0] == '}': break # # If closing bracket is found, stop the loop
-                                if line_tok[0].startswith('animation:'): pdefs[prop_idx].animation = int(line_tok[1])
-
-                                if line_tok[0].startswith('numparts:'):
-                                    numparts = int(line_tok[1])
-                                    pdefs[prop_idx].numparts = numparts
-                                    for i in range(0, numparts * 4, 4):
-                                        name = lines[idx + i + 2].split()[1].lower()
-                                        offset = lines[idx + i + 3].split()[1:]
-                                        offset = [float(x) for x in offset]
-                                        pdefs[prop_idx].parts.append([name, offset]) # Use dict instead? {name: offset}
-
-                                if line_tok[0].startswith('FixedObject:'): pdefs[prop_idx].fixedobject = int(line_tok[1])
-                                if line_tok[0].startswith('Obstacle:'): pdefs[prop_idx].obstacle = int(line_tok[1])
-                                if line_tok[0].startswith('GfxOnly:'): pdefs[prop_idx].gfxonly = int(line_tok[1])
-                                if line_tok[0].startswith('Drivable:'): pdefs[prop_idx].drivable = int(line_tok[1])
-                                if line_tok[0].startswith('Far:'): pdefs[prop_idx].far = int(line_tok[1])
-                            
-                            prop_type_ctr += 1
-                    else: break
+        city_props_fp = find_file(os.path.join(city_path, map_name + '.prop'))
+        if city_props_fp is not None:
+            prop_file = read_prop_file(city_props_fp)
+            num_prop_types = prop_file.parsed_header[3]
+            parts = {} # Pdef name -> template parts
+
+            # Parse prop templates
+            for prop_type_ctr, template in enumerate(prop_file.templates[:num_prop_types], 1):
+                prop_idx = num_prop_types - prop_type_ctr # Reverse idx
+                prop_template_name = template.name.lower()
+
+                if prop_template_name != pdefs[prop_idx].name:
+                    # TODO: Create safer name matching, it's not always in reverse-alphabetical order! See paris.prop
+                    print('Prop pdef mismatch:', prop_template_name, pdefs[prop_idx].name)
+                    break
+
+                parts[pdefs[prop_idx].name] = [[name.lower(), list(offset)] for name, offset in template.parts]
+            
+            # Import props using pdef and prop template data
+            prop_ext = '_0.xmod' # Highest LOD extension
+            for pdef in pdefs:
+                prop_col = registry.create_get(pdef.name)
+                registry.link(prop_col, prop_templates_col)
+
+                prop_fp = find_file(os.path.join(city_models_path, pdef.name + prop_ext))
+
+                # Try-excepts below are because TEX importing seems to fail on some textures, resolve later.
+                # l_prop_breakglass_04x_glass_0, p_prop_ferris_box_x_0, etc. -> Don't seem to exist?
+
+                if prop_fp is not None:
+                    try:
+                        import_xmod(prop_fp, collection = prop_col)
+                    except:
+                        print('Could not import prop model, creating empty:', pdef.name)
+                        prop_empty = bpy.data.objects.new(pdef.name, None)
+                        prop_col.objects.link(prop_empty)
                 
-                # Import props using pdef and prop template data
-                prop_ext = '_0.xmod' # Highest LOD extension
-                for pdef in pdefs:
-                    prop_col = create_get_collection(pdef.name)
-                    link_col_to_col(prop_col, prop_templates_col)
-                    set_active_collection(prop_col.name)
-
-                    prop_fp = os.path.join(city_models_path, pdef.name + prop_ext)
-
-                    # Try-excepts below are because TEX importing seems to fail on some textures, resolve later.
-                    # l_prop_breakglass_04x_glass_0, p_prop_ferris_box_x_0, etc. -> Don't seem to exist?
-
-                    if os.path.exists(prop_fp):
-                        try:
-                            import_xmod(prop_fp)
-                        except:
-                            print('Could not import prop model, creating empty:', pdef.name)
-                            prop_empty = bpy.data.objects.new(pdef.name, None)
-                            prop_col.objects.link(prop_empty)
-                    
-                    # Import parts from the prop template
-                    for part in pdef.parts:
-                        if part[0] == pdef.name + '_glass': # Try importing glass props
-                            prop_glass_fp = os.path.join(city_models_path, pdef.name + '_glass' + prop_ext)
-                            if os.path.exists(prop_glass_fp):
-                                try:
-                                    part_obj = import_xmod(prop_glass_fp)
-                                except:
-                                    print('Could not import glass model, creating empty:', part[0])
-                                    part_obj = bpy.data.objects.new(part[0], None)
-                                    prop_col.objects.link(part_obj)
-                            else:
+                # Import parts from the prop template
+                for part in parts.get(pdef.name, []):
+                    if part[0] == pdef.name + '_glass': # Try importing glass props
+                        prop_glass_fp = find_file(os.path.join(city_models_path, pdef.name + '_glass' + prop_ext))
+                        if prop_glass_fp is not None:
+                            try:
+                                part_obj = import_xmod(prop_glass_fp, collection = prop_col)
+                            except:
+                                print('Could not import glass model, creating empty:', part[0])
                                 part_obj = bpy.data.objects.new(part[0], None)
                                 prop_col.objects.link(part_obj)
                         else:
                             part_obj = bpy.data.objects.new(part[0], None)
                             prop_col.objects.link(part_obj)
-                        
-                        # TODO: Add offset to part_obj
-        
+                    else:
+                        part_obj = bpy.data.objects.new(part[0], None)
+                        prop_col.objects.link(part_obj)
+                    
+                    # TODO: Add offset to part_obj
+    
         self.report({'INFO'}, f"Imported {map_name} props")
         return {'FINISHED'}
 
-class MC2_OT_ImportProps(bpy.types.Operator):
-    bl_idname = "mc2.import_props"
-    bl_label = "Import Props"
-    bl_options = {'REGISTER', 'UNDO'}
-
-    def execute(self, context):
-
-        os.system('cls') ### TEMP ###
+class MC2_OT_ImportProps(BatchedOperator):
+    def run(self, context):
+        from .import_xmod import import_xmod
 
         mc2_dir = context.scene.mc2_props.mc2_dir
         map_name = context.scene.mc2_props.map_name
         city_path = os.path.join(mc2_dir, 'city', map_name)
         city_models_path = os.path.join(city_path, 'models')
 
+        # Prop templates used by props inside the selected region
+        region = get_region_contents(context)
+
         # Get collections
-        prop_templates_col = create_get_collection(map_name + '_prop_templates')
-        set_active_collection(prop_templates_col.name)
+        registry = CollectionRegistry(context)
+        prop_templates_col = registry.create_get(map_name + '_prop_templates')
 
         # Don't need to parse pdefs for now
         # # Parse .pdef files
@@ -385,134 +580,94 @@ class MC2_OT_ImportProps(bpy.types.Operator):
         #             for l in lines:
 
         # Parse .prop file
-        num_prop_types = 0
-
-        city_props_fp = os.path.join(city_path, map_name + '.prop')
-        if os.path.exists(city_props_fp):
-            with open(city_props_fp, 'r') as file:
-                lines = file.read().splitlines()
-
-                #prop_count = int(lines[0].split()[1])
-                #fixed_prop_count = int(lines[1].split()[1])
-                #gfx_prop_count = int(lines[2].split()[1])
-                num_prop_types = int(lines[3].split()[1])
-
-                # Parse prop templates
-                prop_type_ctr = 1
-
-                for l_idx, l in enumerate(lines):
-                    if prop_type_ctr <= num_prop_types:
-                        if l.startswith('prop_template '):
-                            prop_template_name = l.split()[1].lower()
-
-                            animation = 0
-                            numparts = 0
-                            fixedobject = 0
-                            obstacle = 0
-                            gfxonly = 0
-                            drivable = 0
-                            far = 0
-                            parts = []
-
-                            pdef_fp = os.path.join(city_path, prop_template_name + '.pdef')
-                            if not os.path.exists(pdef_fp):
-                                print('Prop pdef missing:', prop_template_name)
-                                break
-                            
-                            # Read prop template block
-                            for i in range(64): # Max amount of lines for a prop template
-                                t_idx = l_idx + i
-                                line_tok = lines[t_idx].split()
-
-                                if line_tok[0] == '}': break # If closing bracket is found, stop the loop
-                                if line_tok[0].startswith('animation'): animation = int(line_tok[1])
-                                if line_tok[0].startswith('numparts'):
-                                    numparts = int(line_tok[1])
-                                    for i in range(0, numparts * 4, 4):
-                                        name = lines[t_idx + i + 2].split()[1].lower()
-                                        offset = lines[t_idx + i + 3].split()[1:]
-                                        offset = [float(x) for x in offset]
-                                        parts.append([name, offset])
-                                
-                                if line_tok[0].startswith('FixedObject:'): fixedobject = int(line_tok[1])
-                                if line_tok[0].startswith('Obstacle:'): obstacle = int(line_tok[1])
-                                if line_tok[0].startswith('GfxOnly:'): gfxonly = int(line_tok[1])
-                                if line_tok[0].startswith('Drivable:'): drivable = int(line_tok[1])
-                                if line_tok[0].startswith('Far:'): far = int(line_tok[1])
-                            
-                            prop_type_ctr += 1
-                                                    
-                            # Import prop
-                            lod_ext = '_0.xmod' # Highest LOD extension
-                            prop_col = create_get_collection(prop_template_name)
-                            link_col_to_col(prop_col, prop_templates_col)
-                            set_active_collection(prop_col.name)
-
-                            prop_fp = os.path.join(city_models_path, prop_template_name + lod_ext)
-
-                            # Try-excepts below are because TEX importing seems to fail on some textures, resolve later.
-                            # l_prop_breakglass_04x_glass_0, p_prop_ferris_box_x_0, etc. -> Don't seem to exist?
-
-                            if os.path.exists(prop_fp):
-                                prop = None
-                                try:
-                                    prop = import_xmod(prop_fp)
-                                except:
-                                    print('Prop was found but could not import, creating empty:', prop_template_name)
-                                    prop = bpy.data.objects.new(prop_template_name, None)
-                                    prop_col.objects.link(prop)
-                                
-                                # Assign template variables as custom properties
-                                prop['animation'] = animation
-                                prop['fixedobject'] = fixedobject
-                                prop['obstacle'] = obstacle
-                                prop['gfxonly'] = gfxonly
-                                prop['drivable'] = drivable
-                                prop['far'] = far
-
-                            else:
-                                print('Prop xmod was not found:', prop_template_name + lod_ext)
-
-                            # Import prop parts
-                            for part in parts:
-                                part_fp = os.path.join(city_models_path, part[0] + lod_ext)
-                                if os.path.exists(part_fp):
-                                    part_xmod = import_xmod(part_fp)
-                                    part_xmod.name = part[0]
-                                    part_xmod.location = translate_vector3(part[1])
-
-                                    if 'particle' or 'breakpart' in part[0]: # Hide particles and breakparts
-                                        part_xmod.hide_viewport = True
-                                        part_xmod.hide_render = True
-                                else:
-                                    part_empty = bpy.data.objects.new(part[0], None) # Add part as empty if xmod was not found
-                                    prop_col.objects.link(part_empty)
-                                    part_empty.location = translate_vector3(part[1])
-
-                    else: break
+        city_props_fp = find_file(os.path.join(city_path, map_name + '.prop'))
+        if city_props_fp is not None:
+            prop_file = read_prop_file(city_props_fp)
+            num_prop_types = prop_file.parsed_header[3]
+
+            templates = prop_file.templates[:num_prop_types]
+            for idx, template in enumerate(templates):
+                prop_template_name = template.name.lower()
+
+                if not file_exists(os.path.join(city_path, prop_template_name + '.pdef')):
+                    print('Prop pdef missing:', prop_template_name)
+                    break
+
+                if region is not None and prop_template_name not in region.prop_templates:
+                    continue
+                                        
+                # Import prop
+                lod_ext = '_0.xmod' # Highest LOD extension
+                prop_col = registry.create_get(prop_template_name)
+                registry.link(prop_col, prop_templates_col)
+
+                prop_fp = find_file(os.path.join(city_models_path, prop_template_name + lod_ext))
+
+                # Try-excepts below are because TEX importing seems to fail on some textures, resolve later.
+                # l_prop_breakglass_04x_glass_0, p_prop_ferris_box_x_0, etc. -> Don't seem to exist?
+
+                if prop_fp is not None:
+                    prop = None
+                    try:
+                        prop = import_xmod(prop_fp, collection = prop_col)
+                    except:
+                        print('Prop was found but could not import, creating empty:', prop_template_name)
+                        prop = bpy.data.objects.new(prop_template_name, None)
+                        prop_col.objects.link(prop)
+                    
+                    # Assign template variables as custom properties
+                    prop['animation'] = template.animation
+                    prop['fixedobject'] = template.fixedobject
+                    prop['obstacle'] = template.obstacle
+                    prop['gfxonly'] = template.gfxonly
+                    prop['drivable'] = template.drivable
+                    prop['far'] = template.far
+
+                else:
+                    print('Prop xmod was not found:', prop_template_name + lod_ext)
+
+                # Import prop parts
+                for name, offset in template.parts:
+                    name = name.lower()
+                    part_fp = find_file(os.path.join(city_models_path, name + lod_ext))
+                    if part_fp is not None:
+                        part_xmod = import_xmod(part_fp, collection = prop_col)
+                        part_xmod.name = name
+                        part_xmod.location = translate_vector3(offset)
+
+                        if 'particle' in name or 'breakpart' in name: # Hide particles and breakparts
+                            part_xmod.hide_viewport = True
+                            part_xmod.hide_render = True
+                    else:
+                        part_empty = bpy.data.objects.new(name, None) # Add part as empty if xmod was not found
+                        prop_col.objects.link(part_empty)
+                        part_empty.location = translate_vector3(offset)
+
+                yield idx + 1, len(templates)
 
         #Try to contain needed info directly in the prop collections, custom properties etc. straight away, instead of messing with PropDef
 
         self.report({'INFO'}, f"Imported {map_name} props")
         return {'FINISHED'}
 
-class MC2_OT_SpawnCityModels(bpy.types.Operator):
-    bl_idname = "mc2.spawn_city_models"
-    bl_label = "Spawn City Models"
-    bl_options = {'REGISTER', 'UNDO'}
-
-    def execute(self, context):
+class MC2_OT_SpawnCityModels(BatchedOperator):
+    def run(self, context):
+        from .instance_store import get_store
         mc2_dir = context.scene.mc2_props.mc2_dir
         map_name = context.scene.mc2_props.map_name
         city_path = os.path.join(mc2_dir, 'city', map_name)
 
+        # Hoods inside the selected region
+        region = get_region_contents(context)
+
         # Get collections
-        city_models_col = create_get_collection(map_name + '_city_models')
-        city_hoods_col = create_get_collection(map_name + '_hoods')
+        registry = CollectionRegistry(context)
+        city_models_col = registry.create_get(map_name + '_city_models')
+        city_hoods_col = registry.create_get(map_name + '_hoods')
 
         # Read lvl file
-        lvl_fp = os.path.join(city_path, map_name + '.lvl')
-        if os.path.exists(lvl_fp):
+        lvl_fp = find_file(os.path.join(city_path, map_name + '.lvl'))
+        if lvl_fp is not None:
             hoods = []
             uniques = {}
 
@@ -521,454 +676,623 @@ class MC2_OT_SpawnCityModels(bpy.types.Operator):
             temp_obj = bpy.context.object
             temp_obj.name = 'temp_obj'
 
-            with open(lvl_fp, 'r') as file:
-                lines = file.read().splitlines()
-                numhoods = int(lines[0].split()[1])
-
-                fails = 0
-
-                for l_idx, l in enumerate(lines):
-                    if l.startswith('extents_min '):
-                        extents_min = [float(x) for x in lines[l_idx+1].split()]
-                    if l.startswith('extents_max '):
-                        extents_max = [float(x) for x in lines[l_idx+1].split()]
-                    if l.startswith('hood '):
-                        hoods.append(lines[l_idx+1].split()[1])
-                
-                # Read hood file(s)
-                for hood in hoods:
-                    hood_fp = os.path.join(city_path, hood + '.hood')
-                    if os.path.exists(hood_fp):
-                        # Set up hood collection
-                        hood_col = create_get_collection(hood)
-                        link_col_to_col(hood_col, city_hoods_col)
-
-                        hood_unique_col = create_get_collection(hood + '_unique')
-                        link_col_to_col(hood_unique_col, hood_col)
-
-                        hood_inst_col = create_get_collection(hood + '_inst')
-                        link_col_to_col(hood_inst_col, hood_col)
+            level = read_level(lvl_fp)
+            hoods = list(level.hoods)
+            spawned = {} # Hood name -> formats.Hood, for the instance store
+            store = get_store(map_name)
+            paused = None
+            owners = [] # Owner of every spawned instance, checked against the uniques when done
+
+            if region is not None:
+                hoods = [h for h in hoods if h in region.hoods]
+
+            # Chunk grid origin from the level extents, in blender space
+            chunk_size = context.scene.mc2_props.chunk_size
+            lvl_min = translate_vector3(level.extents_min)
+            lvl_max = translate_vector3(level.extents_max)
+            chunk_origin = (min(lvl_min[0], lvl_max[0]), min(lvl_min[1], lvl_max[1]))
+            city_hoods_col['mc2_chunk_origin'] = chunk_origin
+            city_hoods_col['mc2_chunk_size'] = chunk_size
+
+            def component_chunk_key(emin, emax):
+                center = translate_vector3([(a + b) / 2 for a, b in zip(emin, emax)])
+                return get_chunk_key(center, chunk_origin, chunk_size)
+            
+            # Read hood file(s)
+            for idx, hood in enumerate(hoods):
+                # Spawned already, by an earlier run that was paused by the memory budget or from the library cache
+                if registry.get(hood) is not None:
+                    continue
+                paused = budget_pause('spawn.hood')
+                if paused is not None:
+                    break
+                hood_fp = find_file(os.path.join(city_path, hood + '.hood'))
+                if hood_fp is not None:
+                    # Set up hood collection
+                    hood_col = registry.create_get(hood)
+                    registry.link(hood_col, city_hoods_col)
+
+                    hood_unique_col = registry.create_get(hood + '_unique')
+                    registry.link(hood_unique_col, hood_col)
+
+                    hood_inst_col = registry.create_get(hood + '_inst')
+                    registry.link(hood_inst_col, hood_col)
+
+                    # Tag hood data so edits mark the hood dirty for export
+                    hood_tags = {'mc2_hood': hood}
+                    for col in (hood_col, hood_unique_col, hood_inst_col):
+                        col['mc2_hood'] = hood
+
+                    # Spatial chunk collections of this hood, keyed by grid cell
+                    unique_chunks = {}
+                    inst_chunks = {}
+
+                    with stage('spawn.read_hood', hood_fp):
+                        hood_data = read_hood(hood_fp)
+                    spawned[hood] = hood_data
+                    hood_col['mc2_newline'] = hood_data.newline # Exports write the line endings the file had
+
+                    with stage('spawn.hood_objects', hood):
+                        # Spawn unique models
+                        for component_idx, unique in enumerate(hood_data.uniques):
+                            name = unique.name.lower() #.rsplit('#')[0]
                         
-                        with open(hood_fp, 'r') as file:
-                            lines = file.read().splitlines()
-
-                            num_unique_components = lines[1].split()[1]
-                            num_instance_components = lines[2].split()[1]
-
-                            for l_idx, l in enumerate(lines):
-                                # Spawn unique models
-                                if l.startswith('unique_component '):
-                                    name = lines[l_idx+1].split()[1].lower() #.rsplit('#')[0]
-                                    emin = [float(x) for x in lines[l_idx+2].split()[1:]]
-                                    emax = [float(x) for x in lines[l_idx+3].split()[1:]]
-                                    
-                                    # Spawn collection instance using temp object
-                                    model = temp_obj.copy()
-                                    hood_unique_col.objects.link(model)
-                                    model.instance_collection = bpy.data.collections[name]
-                                    model.name = name
-                                    uniques[name] = model
-                                
-                                # Spawn inst models
-                                if l.startswith('instance_component '):
-                                    inst_type = lines[l_idx+1].split()[1].lower()
-                                    owner = lines[l_idx+2].split()[1].lower()
-                                    extension = lines[l_idx+3].split()[1]
-
-                                    # TODO: Put this in a function?
-                                    # Read Matrix34
-                                    row1 = [float(x) for x in lines[l_idx+4].split()]
-                                    row2 = [float(x) for x in lines[l_idx+5].split()]
-                                    row3 = [float(x) for x in lines[l_idx+6].split()]
-                                    translation = [float(x) for x in lines[l_idx+7].split()]
-
-                                    col1 = [row1[0], row2[0], row3[0], translation[0]]
-                                    col2 = [row1[1], row2[1], row3[1], translation[1]]
-                                    col3 = [row1[2], row2[2], row3[2], translation[2]]
-
-                                    mtx = mathutils.Matrix((col1, col2, col3)).to_4x4()
-
-                                    mtx_convert = axis_conversion(from_forward='-Z',
-                                                                    from_up='Y',
-                                                                    to_forward='-Y',
-                                                                    to_up='Z').to_4x4()
-                                    
-                                    mtx = mtx_convert @ mtx
-                                    mat_rot = mathutils.Matrix.Rotation(math.radians(90), 4, 'X') @ mathutils.Matrix.Rotation(math.radians(180), 4, 'Y')
-                                    mtx @= mat_rot
-                                    mtx.to_4x4()
-
-                                    emin = [float(x) for x in lines[l_idx+8].split()[1:]]
-                                    emax = [float(x) for x in lines[l_idx+9].split()[1:]]
-
-                                    # Spawn collection instance using temp object
-                                    model = temp_obj.copy()
-                                    hood_inst_col.objects.link(model)
-                                    model.instance_collection = bpy.data.collections[inst_type]
-                                    model.name = inst_type + '.' + extension
-                                    model.matrix_world = mtx
-
-                                    #model.parent = uniques[owner + '#geom'] # fails on l_santamonica_int_02x#geom ? Doesn't seem to exist
-
-                                    # TODO: Figure out / fix parenting, some parent / owner names don't seem to exist
-                                    # try:
-                                    #     model.parent = uniques[owner + '#geom']
-                                    #     print('Owner:', owner, 'Child:', model.name, 'SUCCESS')
-
-                                    # except Exception as e:
-                                    #     #print(e)
-                                    #     fails += 1
-                                    #     print('Owner:', owner, 'Child:', model.name, 'FAILED')
-
-                                    # Add owner and extensions as custom properties for now
-                                    model['owner'] = owner
-                                    model['extension'] = extension
+                            # Spawn collection instance using temp object
+                            model = temp_obj.copy()
+                            chunk_col = get_chunk_collection(hood_unique_col, component_chunk_key(unique.emin, unique.emax), unique_chunks, hood_tags)
+                            chunk_col.objects.link(model)
+                            model.instance_collection = bpy.data.collections[name]
+                            model.name = name
+                            model['mc2_hood'] = hood
+                            model['mc2_index'] = component_idx # Position in the .hood file, exports keep the order
+                            uniques[name] = model
+                    
+                        # Spawn inst models
+                        for component_idx, inst in enumerate(hood_data.instances):
+                            inst_type = inst.type.lower()
+                            owner = inst.owner.lower()
+                            extension = inst.extension
+
+                            # Spawn collection instance using temp object
+                            model = temp_obj.copy()
+                            chunk_col = get_chunk_collection(hood_inst_col, component_chunk_key(inst.emin, inst.emax), inst_chunks, hood_tags)
+                            chunk_col.objects.link(model)
+                            model.instance_collection = bpy.data.collections[inst_type]
+                            model.name = inst_type + '.' + extension
+                            model.matrix_world = from_matrix34(inst.matrix)
+                            owners.append(owner)
+
+                            #model.parent = uniques[owner + '#geom'] # fails on l_santamonica_int_02x#geom ? Doesn't seem to exist
+
+                            # TODO: Figure out / fix parenting, some parent / owner names don't seem to exist
+                            # try:
+                            #     model.parent = uniques[owner + '#geom']
+                            #     print('Owner:', owner, 'Child:', model.name, 'SUCCESS')
+
+                            # except Exception as e:
+                            #     #print(e)
+                            #     fails += 1
+                            #     print('Owner:', owner, 'Child:', model.name, 'FAILED')
+
+                            # Add owner and extensions as custom properties for now
+                            model['owner'] = owner
+                            model['extension'] = extension
+                            model['mc2_hood'] = hood
+                            model['mc2_index'] = component_idx
+
+                    count('spawn.uniques', len(hood_data.uniques))
+                    count('spawn.instances', len(hood_data.instances))
+                    yield idx + 1, len(hoods)
 
             # Remove temp obj
             bpy.data.objects.remove(temp_obj)
-            print('FAILS:', fails)
+            # Parenting is not done yet, some owners don't exist, see the TODO above
+            fails = sum(1 for owner in owners if owner + '#geom' not in uniques)
+
+            store.set_hoods(spawned)
+            for hood in spawned:
+                mark_dirty(('hood', hood)) # New objects, the file wasn't exported from them
+
+            if paused is not None:
+                self.report({'WARNING'}, f"Paused spawning {map_name} city models, {paused}. Save and reopen the file, then spawn again to continue")
+                return {'FINISHED'}
+
+            if fails:
+                self.report({'WARNING'}, f"Spawned {map_name} city models, {fails} instances have an owner that isn't a spawned unique")
+                return {'FINISHED'}
 
         self.report({'INFO'}, f"Spawned {map_name} city models")
         return {'FINISHED'}
 
-class MC2_OT_SpawnProps(bpy.types.Operator):
-    bl_idname = "mc2.spawn_props"
-    bl_label = "Spawn Props"
-    bl_options = {'REGISTER', 'UNDO'}
+PROP_BATCH = 256 # Props spawned between progress updates
 
-    def execute(self, context):
+class MC2_OT_SpawnProps(BatchedOperator):
+    def run(self, context):
+        from .instance_store import get_store
         mc2_dir = context.scene.mc2_props.mc2_dir
         map_name = context.scene.mc2_props.map_name
         city_path = os.path.join(mc2_dir, 'city', map_name)
 
+        # Props inside the selected region
+        region = get_region_contents(context)
+
         # Get collections
-        prop_templates_col = create_get_collection(map_name + '_prop_templates')
-        props_col = create_get_collection(map_name + '_props')
-        props_fixed_col = create_get_collection(map_name + '_props_fixed')
-        props_gfx_col = create_get_collection(map_name + '_props_gfx')
+        registry = CollectionRegistry(context)
+        prop_templates_col = registry.create_get(map_name + '_prop_templates')
+        props_col = registry.create_get(map_name + '_props')
+        props_fixed_col = registry.create_get(map_name + '_props_fixed')
+        props_gfx_col = registry.create_get(map_name + '_props_gfx')
+
+        # The .prop file holds every prop of the map, remember when only part of it was spawned
+        city_prop_col = registry.create_get(map_name + '.prop')
+        city_prop_col['mc2_region_only'] = region is not None
+
+        # Tag prop classes so edits mark them dirty for export
+        prop_templates_col['mc2_prop_class'] = 'templates'
+        props_col['mc2_prop_class'] = 'props'
+        props_fixed_col['mc2_prop_class'] = 'props_fixed'
+        props_gfx_col['mc2_prop_class'] = 'props_gfx'
 
         # Read prop file
-        city_props_fp = os.path.join(city_path, map_name + '.prop')
-        if os.path.exists(city_props_fp):
+        city_props_fp = find_file(os.path.join(city_path, map_name + '.prop'))
+        if city_props_fp is not None:
             # Temp object to be copied to not have to use bpy too much
             bpy.ops.object.collection_instance_add(collection=prop_templates_col.children[0].name)
             temp_obj = bpy.context.object
 
-            with open(city_props_fp, 'r') as file:
-                lines = file.read().splitlines()            
-
-                prop_count = int(lines[0].split()[1])
-                prop_fixed_count = int(lines[1].split()[1])
-                prop_gfx_count = int(lines[2].split()[1])
-
-                prop_ctr = 0
-                prop_fixed_ctr = 0
-                prop_gfx_ctr = 0
-
-                for l_idx, l in enumerate(lines):
-                    if l.startswith('prop '):
-                        prop_id = l.split()[1]
-                        if lines[l_idx+1].startswith('\tmatrix {'):
-                            # Read Matrix34
-                            row1 = [float(x) for x in lines[l_idx+2].split()]
-                            row2 = [float(x) for x in lines[l_idx+3].split()]
-                            row3 = [float(x) for x in lines[l_idx+4].split()]
-                            translation = [float(x) for x in lines[l_idx+5].split()]
-
-                            col1 = [row1[0], row2[0], row3[0], translation[0]]
-                            col2 = [row1[1], row2[1], row3[1], translation[1]]
-                            col3 = [row1[2], row2[2], row3[2], translation[2]]
-
-                            mtx = mathutils.Matrix((col1, col2, col3)).to_4x4()
-
-                            mtx_convert = axis_conversion(from_forward='-Z',
-                                                            from_up='Y',
-                                                            to_forward='-Y',
-                                                            to_up='Z').to_4x4()
-                            
-                            mtx = mtx_convert @ mtx
-                            mat_rot = mathutils.Matrix.Rotation(math.radians(90), 4, 'X') @ mathutils.Matrix.Rotation(math.radians(180), 4, 'Y')
-                            mtx @= mat_rot
-                            mtx.to_4x4()
-
-                        if lines[l_idx+7].startswith('\tprop_template:'):
-                            prop_name = lines[l_idx+7].split()[1].lower()
+            with stage('spawn.read_props', city_props_fp):
+                prop_file = read_prop_file(city_props_fp)
+            city_prop_col['mc2_newline'] = prop_file.newline
+
+            store = get_store(map_name)
+            prop_classes = []
+            for prop_class, class_props in prop_file.prop_classes():
+                if region is not None:
+                    class_props = [p for p in class_props if p.id in region.prop_ids]
+                prop_classes.append((prop_class, class_props))
+            total = sum(len(class_props) for prop_class, class_props in prop_classes)
+            done = 0
+
+            # Find appropriate collection (prop/fixed/gfx) from the class lists of the file
+            for (prop_class, class_props), target_col in zip(prop_classes, (props_col, props_fixed_col, props_gfx_col)):
+                for start in range(0, len(class_props), PROP_BATCH):
+                    with stage('spawn.props', prop_class):
+                        for prop_data in class_props[start:start + PROP_BATCH]:
+
+                            prop_name = prop_data.template.lower()
 
                             # Spawn collection instance using temp object
                             prop = temp_obj.copy()
-
-                            # Add it to appropriate collection (prop/fixed/gfx) using the ctr variables
-                            if prop_ctr < prop_count:
-                                props_col.objects.link(prop)
-                                prop_ctr += 1
-                            elif prop_fixed_ctr < prop_fixed_count:
-                                props_fixed_col.objects.link(prop)
-                                prop_fixed_ctr += 1
-                            elif prop_gfx_ctr < prop_gfx_count:
-                                props_gfx_col.objects.link(prop)
-                                prop_gfx_ctr += 1
+                            target_col.objects.link(prop)
+                            prop['mc2_prop_class'] = prop_class
 
                             prop.instance_collection = bpy.data.collections[prop_name]
-                            prop.name = prop_name + '.' + prop_id
-                            prop.matrix_world = mtx
-                    
+                            prop.name = prop_name + '.' + prop_data.id
+                            prop.matrix_world = from_matrix34(prop_data.matrix)
+                    done += len(class_props[start:start + PROP_BATCH])
+                    yield done, total
+                count('spawn.props', len(class_props))
+
             # Remove temp obj
             bpy.data.objects.remove(temp_obj)
+
+            # Only stored once everything is spawned, a cancelled run leaves the store as it was
+            for prop_class, class_props in prop_classes:
+                store.set_props(prop_class, class_props)
+                mark_dirty(('prop', prop_class))
         
         # Disable source collection at the end, needs a better spot
-        city_source_col = create_get_collection(map_name + '_source')
+        city_source_col = registry.create_get(map_name + '_source')
         city_source_col.hide_viewport = True
         city_source_col.hide_render = True
 
         self.report({'INFO'}, f"Spawned {map_name} props")
         return {'FINISHED'}
 
-class MC2_OT_ExportHoods(bpy.types.Operator):
-    bl_idname = "mc2.export_hoods"
-    bl_label = "Export Hoods"
-    bl_options = {'REGISTER', 'UNDO'}
-
+class MC2_OT_WriteCityCache:
+    @profiled
     def execute(self, context):
+        if pending_count():
+            self.report({'ERROR'}, "Textures are still loading, write the cache once they're done")
+            return {'CANCELLED'}
+
         mc2_dir = context.scene.mc2_props.mc2_dir
         map_name = context.scene.mc2_props.map_name
         city_path = os.path.join(mc2_dir, 'city', map_name)
+        city_models_path = os.path.join(city_path, 'models')
+        cache_dir = get_cache_dir(city_path)
+        os.makedirs(cache_dir, exist_ok = True)
 
         # Get collections
-        city_hoods_col = create_get_collection(map_name + '_hoods')
+        registry = CollectionRegistry(context)
+        city_models_col = registry.create_get(map_name + '_city_models')
+        prop_templates_col = registry.create_get(map_name + '_prop_templates')
+        city_hoods_col = registry.create_get(map_name + '_hoods')
+        city_prop_col = registry.create_get(map_name + '.prop')
+        prop_class_cols = [registry.create_get(map_name + suffix) for suffix in ('_props', '_props_fixed', '_props_gfx')]
+
+        index = load_index(cache_dir)
+        clean_state = save_dirty_state()
+        written = []
+
+        # City models, keyed by the sources the import manifest recorded
+        model_cols = list(city_models_col.children)
+        if model_cols:
+            manifest = load_manifest(context.scene)
+            sources = {}
+            for entry in manifest['models'].values():
+                sources.update(entry['sources'])
+            with stage('cache.write', 'models'):
+                write_library(cache_dir, index, 'models', 'models', model_cols, sources,
+                              extra = {'collections': [c.name for c in model_cols], 'manifest': manifest['models']})
+            written.append('models')
+
+        # Prop templates, keyed by the .prop file and the models and textures they were imported from
+        prop_fp = find_file(os.path.join(city_path, map_name + '.prop'))
+        template_cols = list(prop_templates_col.children)
+        if template_cols and prop_fp is not None:
+            template_objs = [o for c in template_cols for o in c.objects]
+            paths = [prop_fp] + [os.path.join(city_models_path, o.name.lower() + '_0.xmod') for o in template_objs] + get_texture_paths(template_objs)
+            sources = {p: file_record(p) for p in dict.fromkeys(find_file(p) for p in paths) if p is not None}
+            with stage('cache.write', 'templates'):
+                write_library(cache_dir, index, 'templates', 'templates', template_cols, sources,
+                              extra = {'collections': [c.name for c in template_cols]})
+            written.append('templates')
+
+        # Every hood in a library of its own
+        lvl_fp = find_file(os.path.join(city_path, map_name + '.lvl'))
+        for hood_col in city_hoods_col.children:
+            hood_fp = find_file(os.path.join(city_path, hood_col.name + '.hood'))
+            if hood_fp is None or 'mc2_chunk_origin' not in city_hoods_col:
+                continue
+            sources = {p: file_record(p) for p in (hood_fp, lvl_fp) if p is not None}
+            with stage('cache.write', hood_col.name), detached_instances(hood_col.all_objects):
+                write_library(cache_dir, index, 'hood/' + hood_col.name, 'hood_' + hood_col.name, [hood_col], sources,
+                              {'chunk_size': city_hoods_col['mc2_chunk_size']}, {'chunk_origin': list(city_hoods_col['mc2_chunk_origin'])})
+            written.append(hood_col.name)
+
+        # Spawned props, only when every prop of the .prop file was spawned
+        prop_objs = [o for c in prop_class_cols for o in c.objects]
+        if prop_objs and not city_prop_col.get('mc2_region_only') and prop_fp is not None:
+            with stage('cache.write', 'props'), detached_instances(prop_objs):
+                write_library(cache_dir, index, 'props', 'props', prop_objs, {prop_fp: file_record(prop_fp)})
+            written.append('props')
+
+        save_index(cache_dir, index)
+        invalidate(cache_dir)
+
+        # Detaching instances counts as an edit, let the dirty tracking see it now and forget about it
+        context.view_layer.update()
+        restore_dirty_state(clean_state)
+
+        self.report({'INFO'}, f"Wrote {len(written)} {map_name} cache libraries")
+        return {'FINISHED'}
 
-        n = '\n'
-        t = '\t'
-        e = '}' + n
-        
-        for hood in city_hoods_col.children:
-            lines = []
-            
-            # bpy.data.collections[''] ?, so that they don't get created if they don't exist?
-            hood_unique_col = create_get_collection(hood.name + '_unique')
-            hood_inst_col = create_get_collection(hood.name + '_inst')
-
-            # Write header
-            name = 'name: ' + hood.name + n
-            num_unique_components = 'num_unique_components: ' + str(len(hood_unique_col.objects)) + n
-            num_instance_components = 'num_instance_components: ' + str(len(hood_inst_col.objects)) + n
-
-            lines.append(name)
-            lines.append(num_unique_components)
-            lines.append(num_instance_components)
-            
-            # Write unique components
-            ctr = 0 # Ctr as an extension might be dangerous
-            for unique in hood_unique_col.all_objects:
-                title = 'unique_component ' + str(ctr) + ' {' + n
-                name = t + 'name: ' + unique.name + n
-                
-                emin, emax = calc_emin_emax(unique)
-                emin = t + 'emin ' + ('%.6f %.6f %.6f' % emin[:]) + n # TODO: Better way to print a Vector?
-                emax = t + 'emax ' + ('%.6f %.6f %.6f' % emax[:]) + n + e
-                
-                lines.append(title)
-                lines.append(name)
-                lines.append(emin)
-                lines.append(emax)
-                ctr += 1
-            
-            # Write instance components
-            ctr = 0
-            for inst in hood_inst_col.all_objects:
-                title = 'instance_component ' + str(ctr) + ' {' + n
-                type, ext = inst.name.rsplit('.')
-                type = t + 'type: ' + type + n
-                owner = t + 'owner: ' + inst['owner'] + n #'TEST_OWNER' + n # Read owner from a custom property for now
-                extension = t + 'extension: ' + ext + n #str(ctr) + n # extension + n
+class MC2_OT_LoadCityCache:
+    @profiled
+    def execute(self, context):
+        props = context.scene.mc2_props
+        mc2_dir = props.mc2_dir
+        map_name = props.map_name
+        city_path = os.path.join(mc2_dir, 'city', map_name)
+        cache_dir = get_cache_dir(city_path)
+        entries = load_index(cache_dir)['entries']
 
-                # Convert world matrix to Matrix34
-                matrix = to_matrix34(inst.matrix_world)
+        # Hoods and props inside the selected region
+        region = get_region_contents(context)
 
-                row1 = (matrix[0][0], matrix[1][0], matrix[2][0])
-                row2 = (matrix[0][1], matrix[1][1], matrix[2][1])
-                row3 = (matrix[0][2], matrix[1][2], matrix[2][2])
-                row4 = (matrix[0][3], matrix[1][3], matrix[2][3])
+        # Get collections
+        registry = CollectionRegistry(context)
+        city_models_col = registry.create_get(map_name + '_city_models')
+        prop_templates_col = registry.create_get(map_name + '_prop_templates')
+        city_hoods_col = registry.create_get(map_name + '_hoods')
+        city_prop_col = registry.create_get(map_name + '.prop')
+        prop_class_cols = {name: registry.create_get(map_name + '_' + name) for name in ('props', 'props_fixed', 'props_gfx')}
+
+        def append_collections(entry, parent_col, names):
+            cols = append_library(cache_dir, entry, 'collections', names)
+            for col in cols:
+                registry.collections[col.name] = col
+                registry.link(col, parent_col)
+            return cols
+
+        loaded = []
+        fallbacks = []
+
+        # City models, the ones whose sources changed since get imported again by a sync
+        entry = entries.get('models')
+        if not city_models_col.children and entry is not None and file_exists(library_path(cache_dir, entry)):
+            with stage('cache.load', 'models'):
+                append_collections(entry, city_models_col, entry['collections'])
+            manifest = load_manifest(context.scene)
+            manifest['models'].update(entry['manifest'])
+            save_manifest(context.scene, manifest)
+            restore_evicted_images()
+            bpy.ops.mc2.sync_city_models()
+            loaded.append('models')
+        elif not city_models_col.children:
+            bpy.ops.mc2.import_city_models()
+            fallbacks.append('models')
+
+        # Prop templates
+        entry = entries.get('templates')
+        if not prop_templates_col.children and entry is not None and is_fresh(cache_dir, entry):
+            with stage('cache.load', 'templates'):
+                append_collections(entry, prop_templates_col, entry['collections'])
+            restore_evicted_images()
+            loaded.append('templates')
+        elif not prop_templates_col.children:
+            bpy.ops.mc2.import_props()
+            fallbacks.append('templates')
+
+        # Hoods, the ones without a fresh library get spawned from their .hood file
+        lvl_fp = find_file(os.path.join(city_path, map_name + '.lvl'))
+        if lvl_fp is not None:
+            hoods = list(read_level(lvl_fp).hoods)
+            if region is not None:
+                hoods = [h for h in hoods if h in region.hoods]
+            options = {'chunk_size': props.chunk_size}
+
+            stale = 0
+            for hood in hoods:
+                if registry.get(hood) is not None:
+                    continue
+                entry = entries.get('hood/' + hood)
+                if entry is None or not is_fresh(cache_dir, entry, options):
+                    stale += 1
+                    continue
+                with stage('cache.load', hood):
+                    for col in append_collections(entry, city_hoods_col, [hood]):
+                        attach_instances(col.all_objects)
+                city_hoods_col['mc2_chunk_origin'] = entry['chunk_origin']
+                city_hoods_col['mc2_chunk_size'] = props.chunk_size
+                loaded.append(hood)
+
+            if stale and city_models_col.children:
+                bpy.ops.mc2.spawn_city_models() # Skips the hoods that are there already
+                fallbacks.append('%d hoods' % stale)
+
+        # Props, cached for the whole map only
+        entry = entries.get('props')
+        if not any(c.objects for c in prop_class_cols.values()) and prop_templates_col.children:
+            if region is None and entry is not None and is_fresh(cache_dir, entry):
+                with stage('cache.load', 'props'):
+                    prop_objs = append_library(cache_dir, entry, 'objects')
+                for obj in prop_objs:
+                    prop_class_cols[obj['mc2_prop_class']].objects.link(obj)
+                attach_instances(prop_objs)
+                for name, col in prop_class_cols.items():
+                    col['mc2_prop_class'] = name
+                prop_templates_col['mc2_prop_class'] = 'templates'
+                city_prop_col['mc2_region_only'] = False
+                loaded.append('props')
+            else:
+                bpy.ops.mc2.spawn_props()
+                fallbacks.append('props')
+
+        invalidate_stream_cache()
+
+        if fallbacks:
+            self.report({'INFO'}, f"Loaded {len(loaded)} {map_name} cache libraries, rebuilt from source: {', '.join(fallbacks)}")
+        else:
+            self.report({'INFO'}, f"Loaded {len(loaded)} {map_name} cache libraries")
+        return {'FINISHED'}
 
-                row1 = t + vector3_to_string(round_vector3(row1), '\t') + n
-                row2 = t + vector3_to_string(round_vector3(row2), '\t') + n
-                row3 = t + vector3_to_string(round_vector3(row3), '\t') + n
-                row4 = t + vector3_to_string(round_vector3(row4), '\t') + n
+def component_order(obj):
+    # Spawned components by their index in the .hood file, added ones after them by name
+    index = obj.get('mc2_index')
+    return (index is None, index if index is not None else 0, obj.name)
+
+def snapshot_hood(registry, hood, verts_cache):
+    # Plain formats.Hood of a hood collection, holds no blender data
+
+    # bpy.data.collections[''] ?, so that they don't get created if they don't exist?
+    hood_unique_col = registry.create_get(hood.name + '_unique')
+    hood_inst_col = registry.create_get(hood.name + '_inst')
+
+    hood_data = Hood(hood.name)
+
+    # Gather unique components, all_objects includes chunk collections. Chunks don't follow the file order,
+    # components are put back in it so an unedited hood exports unchanged
+    for unique in sorted(hood_unique_col.all_objects, key = component_order):
+        emin, emax = calc_emin_emax(unique, verts_cache)
+        hood_data.uniques.append(UniqueComponent(unique.name, emin, emax))
+
+    # Gather instance components
+    for inst in sorted(hood_inst_col.all_objects, key = component_order):
+        type, ext = inst.name.rsplit('.')
+        owner = inst['owner'] # Read owner from a custom property for now
+
+        # Convert world matrix to Matrix34
+        values = matrix34_values(to_matrix34(inst.matrix_world))
+
+        emin, emax = calc_emin_emax(inst, verts_cache)
+        hood_data.instances.append(InstanceComponent(type, owner, ext, values, emin, emax))
+
+    return hood_data
+
+def write_hood_job(job, backup, sync_dirs):
+    fp, hood_data = job
+    return write_file_if_changed(fp, [hood_data.serialize()], backup, sync_dirs)
+
+def write_hood_files(jobs, backup = None, sync_dirs = None, max_workers = None):
+    # Format, back up and write hood snapshots concurrently, hood files are independent.
+    # Returns hood name -> whether the file changed, or the exception that stopped it
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    results = {}
+    if not jobs:
+        return results
+
+    with ThreadPoolExecutor(max_workers = max_workers or min(len(jobs), os.cpu_count() or 1)) as pool:
+        futures = {pool.submit(write_hood_job, job, backup, sync_dirs): job[1].name for job in jobs}
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as ex:
+                results[futures[future]] = ex
+    return results
+
+class MC2_OT_ExportHoods:
+    @profiled
+    def execute(self, context):
+        from .instance_store import get_store
+        mc2_dir = context.scene.mc2_props.mc2_dir
+        map_name = context.scene.mc2_props.map_name
+        city_path = os.path.join(mc2_dir, 'city', map_name)
 
-                emin, emax = calc_emin_emax(inst)
-                emin = t + 'emin ' + vector3_to_string(round_vector3(emin), ' ') + n
-                emax = t + 'emax ' + vector3_to_string(round_vector3(emax), ' ')+ n + e
+        changed_only = context.scene.mc2_props.export_changed_only
 
-                lines.append(title)
-                lines.append(type)
-                lines.append(owner)
-                lines.append(extension)
+        # Get collections
+        registry = CollectionRegistry(context)
+        city_hoods_col = registry.create_get(map_name + '_hoods')
 
-                lines.append(row1)
-                lines.append(row2)
-                lines.append(row3)
-                lines.append(row4)
+        store = get_store(map_name)
+        verts_cache = {} # Instanced collection -> verts, shared by every hood
+        jobs = []
+        snapshots = {}
+        errors = {}
 
-                lines.append(emin)
-                lines.append(emax)
-                ctr += 1
+        # Snapshot every hood into a formats.Hood on the main thread, blender data isn't safe to read from the pool
+        for hood in city_hoods_col.children:
+            # Hoods whose objects didn't change since the last export are up to date on disk
+            clean = not is_dirty(('hood', hood.name))
+            if changed_only and clean:
+                continue
+
+            try:
+                with stage('export.snapshot', hood.name):
+                    if clean and store.has_hood(hood.name):
+                        hood_data = store.to_hood(hood.name) # Unchanged since it was stored, skip walking its objects
+                    else:
+                        hood_data = snapshots[hood.name] = snapshot_hood(registry, hood, verts_cache)
+            except Exception as ex:
+                errors[hood.name] = ex
+                continue
+            hood_data.newline = hood.get('mc2_newline', os.linesep) # Hoods spawned before it was recorded get the platform's, like text mode wrote
 
             fp = os.path.join(city_path, hood.name + '.hood')
-            make_backup(fp)
-            write_file(fp, lines)
-
-        self.report({'INFO'}, f"Exported {map_name} hoods")
+            jobs.append((fp, hood_data))
+
+        backup = BackupRun(BackupStore(city_path))
+        sync_dirs = set() # Directories are fsynced once per export instead of after every hood
+        written = 0
+        with stage('export.write'): # The writer threads aren't timed per file
+            results = write_hood_files(jobs, backup, sync_dirs)
+        for name, result in results.items():
+            if isinstance(result, Exception):
+                errors[name] = result
+                continue
+            if result:
+                written += 1
+            mark_clean(('hood', name))
+        with stage('export.backup'):
+            backup.commit()
+            fsync_dirs(sync_dirs)
+        invalidate(city_path) # New files and backups show up in the catalog right away
+        if written:
+            forget_saved_clean(map_name)
+
+        with stage('export.store'):
+            store.set_hoods({name: hood_data for name, hood_data in snapshots.items() if name not in errors})
+
+        for name, ex in errors.items():
+            print("Exporting hood failed:", name, ex)
+        if errors:
+            self.report({'WARNING'}, f"Exported {map_name} hoods, {written} files changed, {len(errors)} failed: {', '.join(sorted(errors))}")
+            return {'FINISHED'}
+
+        self.report({'INFO'}, f"Exported {map_name} hoods, {written} files changed")
         return {'FINISHED'}
 
-class MC2_OT_ExportProps(bpy.types.Operator):
-    bl_idname = "mc2.export_props"
-    bl_label = "Export Props"
-    bl_options = {'REGISTER', 'UNDO'}
-
+class MC2_OT_ExportProps:
+    @profiled
     def execute(self, context):
+        from .instance_store import get_store
         mc2_dir = context.scene.mc2_props.mc2_dir
         map_name = context.scene.mc2_props.map_name
         city_path = os.path.join(mc2_dir, 'city', map_name)
 
-        # Get collections
-        prop_templates_col = create_get_collection(map_name + '_prop_templates')
-        props_col = create_get_collection(map_name + '_props')
-        props_fixed_col = create_get_collection(map_name + '_props_fixed')
-        props_gfx_col = create_get_collection(map_name + '_props_gfx')
+        # Writing a region would drop every prop outside of it from the .prop file
+        city_prop_col = bpy.data.collections.get(map_name + '.prop')
+        if city_prop_col is not None and city_prop_col.get('mc2_region_only'):
+            self.report({'ERROR'}, "Props were spawned for a region only, spawn the whole map to export props")
+            return {'CANCELLED'}
 
-        n = '\n'
-        t = '\t'
-        e = '}' + n
+        # Get collections
+        registry = CollectionRegistry(context)
+        prop_templates_col = registry.create_get(map_name + '_prop_templates')
+        props_col = registry.create_get(map_name + '_props')
+        props_fixed_col = registry.create_get(map_name + '_props_fixed')
+        props_gfx_col = registry.create_get(map_name + '_props_gfx')
 
-        lines = []
+        # Line endings of the spawned .prop file
+        newline = city_prop_col.get('mc2_newline', os.linesep) if city_prop_col is not None else os.linesep
 
         # Write header
-        prop_count = 'prop_count: ' + str(len(props_col.objects)) + n
-        fixed_prop_count = 'fixed_prop_count: ' + str(len(props_fixed_col.objects)) + n
-        gfx_prop_count = 'gfx_prop_count: ' + str(len(props_gfx_col.objects)) + n
-        num_prop_types = 'num_prop_types: ' + str(len(prop_templates_col.children)) + n
-
-        lines.append(prop_count)
-        lines.append(fixed_prop_count)
-        lines.append(gfx_prop_count)
-        lines.append(num_prop_types)
-
-        # Write prop templates
-        for template in prop_templates_col.children:
-            prop_template = 'prop_template ' + template.name + ' {' + n
-            # Defaults
-            animation = t + 'animation: 0' + n
-            parts = ''
-            fixedobject = t + 'FixedObject: 0' + n
-            obstacle = t + 'Obstacle: 0' + n
-            gfxonly = t + 'GfxOnly: 0' + n
-            drivable = t + 'Drivable: 0' + n
-            far = t + 'Far: 0' + n + e
-
-            part_ctr = 0
-            objs = template.objects
-            for o in objs:
-                part = ''
-                if not o.hide_viewport: # TODO: Probably need a more reliable way to distinguish the actual prop from its parts
-                    # Main object
-                    try:
-                        animation = t + 'animation: ' + str(o['animation']) + n
-                        fixedobject = t + 'FixedObject: ' + str(o['fixedobject']) + n
-                        obstacle = t + 'Obstacle: ' + str(o['obstacle']) + n
-                        gfxonly = t + 'GfxOnly: ' + str(o['gfxonly']) + n
-                        drivable = t + 'Drivable: ' + str(o['drivable']) + n
-                        far = t + 'Far: ' + str(o['far']) + n + e
-                    except:
-                        print("Writing template failed:", o.name) # TODO: Fix this, some issue with l_prop_alpha_tree_02x_breakpart01 for example
-                elif o.hide_viewport:
-                    # Part
-                    part_ctr += 1
-                    part = t + 'part ' + str(part_ctr) + ' {' + n
-                    part += t + t + 'name: ' + o.name + n
-                    offset = translate_vector3(o.location)
-                    offset = f"{t.join(f'{v:.6f}' for v in offset)}"
-                    part += t + t + 'offset: ' + offset + ' ' + n
-                    part += t + '}' + n
-                    parts += part
-            
-            numparts = t + 'numparts: ' + str(part_ctr) + n
-            
-            lines.append(prop_template)
-            lines.append(animation)
-            lines.append(numparts)
-            lines.append(parts)
-            lines.append(fixedobject)
-            lines.append(obstacle)
-            lines.append(gfxonly)
-            lines.append(drivable)
-            lines.append(far)
+        lines = [to_newline(PROP_HEADER_TEMPLATE % (len(props_col.objects), len(props_fixed_col.objects), len(props_gfx_col.objects), len(prop_templates_col.children)), newline)]
+
+        changed_only = context.scene.mc2_props.export_changed_only
+
+        # Write prop templates, reusing the text of the last export if they didn't change
+        templates_block = get_cached_block(('prop', 'templates')) if changed_only else None
+        with stage('export.templates'):
+            if templates_block is None:
+                templates = []
+                for template in prop_templates_col.children:
+                    template_data = PropTemplate(template.name)
+
+                    for o in template.objects:
+                        if not o.hide_viewport: # TODO: Probably need a more reliable way to distinguish the actual prop from its parts
+                            # Main object
+                            try:
+                                for key in ('animation', 'fixedobject', 'obstacle', 'gfxonly', 'drivable', 'far'):
+                                    setattr(template_data, key, o[key])
+                            except:
+                                print("Writing template failed:", o.name) # TODO: Fix this, some issue with l_prop_alpha_tree_02x_breakpart01 for example
+                        elif o.hide_viewport:
+                            # Part
+                            template_data.parts.append((o.name, translate_vector3(o.location)))
+
+                    templates.append(template_data)
+
+                templates_block = ''.join(template.serialize(idx, newline) for idx, template in enumerate(templates))
+                mark_clean(('prop', 'templates'), templates_block)
+        lines.append(templates_block)
         
-        # Write props
-        def write_props(objects):
+        # Gather props
+        def gather_props(objects):
+            props = []
             for prop in objects:
                 name, ext = prop.name.rsplit('.')
-                template = prop.instance_collection.name
-
-                title = 'prop ' + str(ext) + ' {' + n
-                matrix_start = t + 'matrix {' + n
-
                 # Convert world matrix to Matrix34
-                matrix = to_matrix34(prop.matrix_world)
-
-                row1 = (matrix[0][0], matrix[1][0], matrix[2][0])
-                row2 = (matrix[0][1], matrix[1][1], matrix[2][1])
-                row3 = (matrix[0][2], matrix[1][2], matrix[2][2])
-                row4 = (matrix[0][3], matrix[1][3], matrix[2][3])
-
-                row1 = t + t + vector3_to_string(round_vector3(row1), '\t') + ' ' + n
-                row2 = t + t + vector3_to_string(round_vector3(row2), '\t') + ' ' + n
-                row3 = t + t + vector3_to_string(round_vector3(row3), '\t') + ' ' + n
-                row4 = t + t + vector3_to_string(round_vector3(row4), '\t') + ' ' + n
-
-                matrix_end = t + t + e
-
-                template = t + t + 'prop_template: ' + template + n + e
-
-                lines.append(title)
-                lines.append(matrix_start)
-
-                lines.append(row1)
-                lines.append(row2)
-                lines.append(row3)
-                lines.append(row4)
-
-                lines.append(matrix_end)
-                lines.append(template)
-
-        write_props(props_col.all_objects)
-        write_props(props_fixed_col.all_objects)
-        write_props(props_gfx_col.all_objects)
+                values = matrix34_values(to_matrix34(prop.matrix_world))
+                props.append(PropInstance(ext, values, prop.instance_collection.name))
+            return props
+
+        # Classes whose props didn't change since the last export are read from the store
+        store = get_store(map_name)
+        for prop_class, class_col in (('props', props_col), ('props_fixed', props_fixed_col), ('props_gfx', props_gfx_col)):
+            if not is_dirty(('prop', prop_class)) and store.has_props(prop_class):
+                with stage('export.store', prop_class):
+                    class_props = store.to_props(prop_class)
+            else:
+                with stage('export.gather', prop_class):
+                    class_props = gather_props(class_col.all_objects)
+                store.set_props(prop_class, class_props)
+                mark_clean(('prop', prop_class))
+            lines.append(''.join(prop.serialize(newline = newline) for prop in class_props))
 
         # TODO: Check why prop files don't match still
 
         fp = os.path.join(city_path, map_name + '.prop')
-        make_backup(fp)
-        write_file(fp, lines)
-
-        self.report({'INFO'}, f"Exported {map_name} props")
+        with stage('export.write', fp):
+            backup = BackupRun(BackupStore(city_path))
+            changed = write_file_if_changed(fp, lines, backup)
+            backup.commit()
+        invalidate(city_path)
+        if changed:
+            forget_saved_clean(map_name)
+            self.report({'INFO'}, f"Exported {map_name} props")
+        else:
+            self.report({'INFO'}, f"{map_name} props unchanged")
         return {'FINISHED'}
-
-classes = (
-    MC2_OT_SetupScene,
-    MC2_OT_ClearScene,
-    MC2_OT_RestoreBackup,
-    MC2_OT_ImportCityModels,
-    MC2_OT_ImportProps_Old,
-    MC2_OT_ImportProps,
-    MC2_OT_SpawnCityModels,
-    MC2_OT_SpawnProps,
-    MC2_OT_ExportHoods,
-    MC2_OT_ExportProps,
-)
-
-def register():
-    for cls in classes:
-        bpy.utils.register_class(cls)
-
-def unregister():
-    for cls in reversed(classes):
-        bpy.utils.unregister_class(cls)
@@ -0,0 +1,49 @@
+import bpy
+import os
+import json
+from .fileio import atomic_write
+
+# Settings kept between blender sessions, like the last MC2 directory and map. A small JSON file in blender's
+# config directory, read once when the panel properties are defined and written only when a value changes.
+# Values of globals.py, where older versions kept them, are carried over the first time
+
+PREFS_FILE = 'mc2_map_toolkit.json'
+LEGACY_PATH = os.path.join(os.path.dirname(__file__), 'globals.py')
+
+_prefs = None
+
+def get_prefs_path():
+    return os.path.join(bpy.utils.user_resource('CONFIG'), PREFS_FILE)
+
+def read_legacy():
+    # globals.py lines look like: name = "value"
+    values = {}
+    if os.path.exists(LEGACY_PATH):
+        with open(LEGACY_PATH, 'r') as file:
+            for line in file.read().splitlines():
+                name, sep, value = line.partition('=')
+                if sep:
+                    values[name.strip()] = value.strip()[1:-1]
+    return values
+
+def load_prefs():
+    global _prefs
+    if _prefs is None:
+        try:
+            with open(get_prefs_path(), 'r') as file:
+                _prefs = json.load(file)
+        except (OSError, ValueError):
+            _prefs = read_legacy()
+    return _prefs
+
+def get_pref(name, default = ''):
+    return load_prefs().get(name, default)
+
+def set_pref(name, value):
+    prefs = load_prefs()
+    if prefs.get(name) == value:
+        return
+    prefs[name] = value
+    fp = get_prefs_path()
+    os.makedirs(os.path.dirname(fp), exist_ok = True)
+    atomic_write(fp, json.dumps(prefs, indent = 1))
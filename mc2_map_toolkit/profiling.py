@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import tempfile
+import functools
+from .fileio import atomic_write
+from .memory import MemoryTracker, format_bytes
+
+# Named stage timers and counters for finding where operator time goes. Stages are only timed while an
+# operator runs with profiling turned on in the panel, otherwise stage() returns a shared do-nothing context
+# and count() returns right away. Every profiled run writes a JSON report of stage totals, the slowest
+# files per stage and the counters, and with cProfile turned on a .prof file next to it. Memory tracking and
+# the memory budget hook into the same stages, see memory.py
+
+TOP_FILES = 10
+
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_STAGE = NullStage()
+
+class Stage:
+    __slots__ = ('run', 'name', 'file', 'start')
+
+    def __init__(self, run, name, file):
+        self.run = run
+        self.name = name
+        self.file = file
+
+    def __enter__(self):
+        if self.run.memory is not None:
+            self.run.memory.enter(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.run.add_time(self.name, time.perf_counter() - self.start, self.file)
+        if self.run.memory is not None:
+            self.run.memory.exit(self.name, self.file)
+        return False
+
+class ProfileRun:
+    def __init__(self, name, memory = None):
+        self.name = name
+        self.memory = memory # MemoryTracker while memory is tracked or budgeted
+        self.start = time.perf_counter()
+        self.totals = {} # Stage -> seconds, nested stages count towards their parents too
+        self.calls = {}
+        self.files = {} # Stage -> file -> seconds
+        self.counters = {}
+
+    def add_time(self, name, seconds, file = None):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if file is not None:
+            stage_files = self.files.setdefault(name, {})
+            stage_files[file] = stage_files.get(file, 0.0) + seconds
+
+    def report(self):
+        total = time.perf_counter() - self.start
+        stages = {name: {'seconds': round(seconds, 6), 'calls': self.calls[name],
+                         'share': round(seconds / total, 4) if total > 0.0 else 0.0}
+                  for name, seconds in sorted(self.totals.items(), key = lambda item: -item[1])}
+        top_files = {name: [[file, round(seconds, 6)] for file, seconds in sorted(files.items(), key = lambda item: -item[1])[:TOP_FILES]]
+                     for name, files in self.files.items()}
+        report = {'operator': self.name, 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'seconds': round(total, 6),
+                  'stages': stages, 'top_files': top_files, 'counters': dict(sorted(self.counters.items()))}
+        if self.memory is not None:
+            report['memory'] = self.memory.report()
+        return report
+
+_run = None # ProfileRun of the operator being profiled
+
+def stage(name, file = None):
+    if _run is None:
+        return NULL_STAGE
+    return Stage(_run, name, file)
+
+def count(name, amount = 1):
+    if _run is not None:
+        _run.counters[name] = _run.counters.get(name, 0) + amount
+
+def budget_pause(name):
+    # Point between items an operator can stop at and pick up from on its next run. Returns why to stop
+    # when the memory budget is about to be exceeded and set to pause, else None
+    if _run is not None and _run.memory is not None:
+        return _run.memory.pause_message(name)
+    return None
+
+def get_report_dir(context):
+    # Profile directory of the panel, else next to the .blend or in the temp directory while it's unsaved
+    props = context.scene.mc2_props
+    if props.profile_dir:
+        import bpy # Stages are timed without blender too, only operator runs need it
+        return bpy.path.abspath(props.profile_dir)
+    blend_fp = context.blend_data.filepath
+    return os.path.join(os.path.dirname(blend_fp) if blend_fp else tempfile.gettempdir(), 'mc2_profiles')
+
+class ProfileSession:
+    # Profiling of one operator run under the mode set in the panel. Modal operators enter it on every tick,
+    # so their run is profiled across ticks without counting what happens in between
+    def __init__(self, op, context):
+        props = context.scene.mc2_props
+        self.op = op
+        self.budget = int(props.memory_budget * 1024 ** 3)
+        self.write_report = props.profile_mode != 'OFF' or props.memory_tracking
+        self.run = None
+        self.profiler = None
+        self.previous = None
+        if (not self.write_report and not self.budget) or _run is not None: # Operators called by a profiled operator are part of its run
+            return
+
+        memory = None
+        if props.memory_tracking or self.budget:
+            memory = MemoryTracker(props.memory_tracking, self.budget, props.memory_budget_action)
+            memory.start()
+        self.run = ProfileRun(op.bl_idname, memory)
+        if props.profile_mode == 'CPROFILE':
+            import cProfile
+            self.profiler = cProfile.Profile()
+
+    def __enter__(self):
+        global _run
+        if self.run is not None:
+            self.previous, _run = _run, self.run
+            if self.profiler is not None:
+                self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        global _run
+        if self.run is not None:
+            if self.profiler is not None:
+                self.profiler.disable()
+            _run = self.previous
+        return False
+
+    def finish(self, context):
+        run = self.run
+        if run is None:
+            return
+        self.run = None
+
+        memory = run.memory
+        if memory is not None:
+            memory.stop()
+            if memory.warnings:
+                warning = memory.warnings[0]
+                self.op.report({'WARNING'}, "Memory reached %s at %s, the budget is %s" %
+                               (format_bytes(warning['rss']), warning['stage'], format_bytes(self.budget)))
+        if self.write_report:
+            report_dir = get_report_dir(context)
+            os.makedirs(report_dir, exist_ok = True)
+            base = os.path.join(report_dir, '%s_%s' % (run.name.replace('.', '_'), time.strftime('%Y%m%d_%H%M%S')))
+            atomic_write(base + '.json', json.dumps(run.report(), indent = 1))
+            if self.profiler is not None:
+                self.profiler.dump_stats(base + '.prof')
+            print('MC2 profile written to', base + '.json')
+
+def profiled(execute):
+    # Decorator for operator execute methods, runs them under the profiling mode set in the panel
+    @functools.wraps(execute)
+    def wrapper(self, context):
+        session = ProfileSession(self, context)
+        try:
+            with session:
+                return execute(self, context)
+        finally:
+            session.finish(context)
+    return wrapper
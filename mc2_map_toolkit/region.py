@@ -0,0 +1,164 @@
+import os
+import math
+from fnmatch import fnmatch
+from .formats import read_level, read_hood, read_prop_file, translate_vector3
+from .catalog import find_file, get_dir
+
+REGION_CACHE_SIZE = 8 # Resolved regions kept, the cursor region changes whenever the cursor moves
+
+class MapRegion:
+    # Part of a map to import and spawn, bounds are in blender space
+    def __init__(self, mode, box_min = None, box_max = None, hood_filter = '', center = None, radius = None):
+        self.mode = mode
+        self.box_min = box_min
+        self.box_max = box_max
+        self.hood_patterns = [p.strip().lower() for p in hood_filter.split(',') if p.strip()]
+        self.center = center # CURSOR: x, y of a vertical cylinder
+        self.radius = radius
+
+    def key(self):
+        return (self.mode, self.box_min, self.box_max, tuple(self.hood_patterns), self.center, self.radius)
+
+    def overlaps_box(self, emin, emax):
+        if self.mode == 'CURSOR':
+            # Distance from the center to the closest point of the box
+            x, y = (min(max(self.center[i], emin[i]), emax[i]) for i in range(2))
+            return (x - self.center[0]) ** 2 + (y - self.center[1]) ** 2 <= self.radius * self.radius
+        return all(emin[i] <= self.box_max[i] and emax[i] >= self.box_min[i] for i in range(3))
+
+    def contains_point(self, point):
+        if self.mode == 'CURSOR':
+            return (point[0] - self.center[0]) ** 2 + (point[1] - self.center[1]) ** 2 <= self.radius * self.radius
+        return all(self.box_min[i] <= point[i] <= self.box_max[i] for i in range(3))
+
+    def matches_hood(self, name, emin, emax):
+        if self.mode == 'HOODS':
+            return any(fnmatch(name.lower(), p) for p in self.hood_patterns)
+        return self.overlaps_box(emin, emax)
+
+class RegionContents:
+    def __init__(self):
+        self.hoods = set()
+        self.models = set() # Lowercase city model names (unique component names and instance types)
+        self.prop_ids = set()
+        self.prop_templates = set()
+
+def get_map_region(context):
+    # Region set up in the panel, None if the whole map should be used
+    props = context.scene.mc2_props
+
+    if props.region_mode == 'HOODS':
+        return MapRegion('HOODS', hood_filter = props.region_hoods)
+
+    if props.region_mode == 'BOX':
+        box_min = tuple(min(a, b) for a, b in zip(props.region_min, props.region_max))
+        box_max = tuple(max(a, b) for a, b in zip(props.region_min, props.region_max))
+        return MapRegion('BOX', box_min, box_max)
+
+    if props.region_mode == 'CURSOR':
+        x, y, z = context.scene.cursor.location
+        r = props.region_radius
+        return MapRegion('CURSOR', (x - r, y - r, -math.inf), (x + r, y + r, math.inf), center = (x, y), radius = r)
+
+    return None
+
+def read_lvl_hoods(lvl_fp):
+    return list(read_level(lvl_fp).hoods)
+
+def scan_hood_file(hood_fp):
+    # City models used by a hood and the blender space bounds of its component extents, without spawning anything
+    models = set()
+    bounds_min = [math.inf] * 3
+    bounds_max = [-math.inf] * 3
+
+    hood = read_hood(hood_fp)
+    components = [(u.name, u.emin, u.emax) for u in hood.uniques] + [(i.type, i.emin, i.emax) for i in hood.instances]
+    for name, emin, emax in components:
+        models.add(name.lower())
+        for e in (emin, emax):
+            p = translate_vector3(e)
+            for i in range(3):
+                bounds_min[i] = min(bounds_min[i], p[i])
+                bounds_max[i] = max(bounds_max[i], p[i])
+
+    return models, bounds_min, bounds_max
+
+def scan_prop_file(prop_fp):
+    # (prop id, blender space location, template name) of every prop in a .prop file
+    return [(prop.id, translate_vector3(prop.matrix[9:12]), prop.template.lower())
+            for prop in read_prop_file(prop_fp).all_props()]
+
+# (city path, map name, region key) -> (city directory mtime, {file path: mtime}, RegionContents)
+_resolved = {}
+
+def get_mtime(fp):
+    try:
+        return os.stat(fp).st_mtime_ns
+    except OSError:
+        return None
+
+def resolve_region(city_path, map_name, region):
+    # Memoized, the files are read again when the catalog sees the city directory change or one of them changed.
+    # The returned contents are shared, don't change them
+    key = (os.path.normcase(os.path.normpath(city_path)), map_name, region.key())
+    dir_mtime = get_dir(city_path).mtime
+    cached = _resolved.get(key)
+    if cached is not None and cached[0] == dir_mtime and all(get_mtime(fp) == mtime for fp, mtime in cached[1].items()):
+        return cached[2]
+
+    mtimes = {}
+    contents = read_region(city_path, map_name, region, mtimes)
+    _resolved.pop(key, None)
+    _resolved[key] = (dir_mtime, mtimes, contents)
+    while len(_resolved) > REGION_CACHE_SIZE:
+        del _resolved[next(iter(_resolved))] # Oldest first
+    return contents
+
+def read_region(city_path, map_name, region, mtimes):
+    # Find the hoods, city models and props a region needs from the .lvl, .hood and .prop files.
+    # Hoods are always taken whole, so exporting them doesn't drop components.
+    # mtimes gets the modification time of every file read
+    contents = RegionContents()
+    prop_box_min = [math.inf] * 3
+    prop_box_max = [-math.inf] * 3
+
+    lvl_fp = find_file(os.path.join(city_path, map_name + '.lvl'))
+    if lvl_fp is not None:
+        mtimes[lvl_fp] = get_mtime(lvl_fp)
+        for hood in read_lvl_hoods(lvl_fp):
+            hood_fp = find_file(os.path.join(city_path, hood + '.hood'))
+            if hood_fp is None:
+                continue
+
+            mtimes[hood_fp] = get_mtime(hood_fp)
+            models, emin, emax = scan_hood_file(hood_fp)
+            if region.matches_hood(hood, emin, emax):
+                contents.hoods.add(hood)
+                contents.models |= models
+                for i in range(3):
+                    prop_box_min[i] = min(prop_box_min[i], emin[i])
+                    prop_box_max[i] = max(prop_box_max[i], emax[i])
+
+    # Props have no hood, picked hoods define the prop area when filtering by name
+    if region.mode == 'HOODS':
+        region = MapRegion('BOX', prop_box_min, prop_box_max)
+
+    prop_fp = find_file(os.path.join(city_path, map_name + '.prop'))
+    if prop_fp is not None:
+        mtimes[prop_fp] = get_mtime(prop_fp)
+        for prop_id, location, template in scan_prop_file(prop_fp):
+            if region.contains_point(location):
+                contents.prop_ids.add(prop_id)
+                contents.prop_templates.add(template)
+
+    return contents
+
+def get_region_contents(context):
+    # Resolve the panel region for the current map, None if the whole map should be used
+    props = context.scene.mc2_props
+    region = get_map_region(context)
+    if region is None:
+        return None
+
+    city_path = os.path.join(props.mc2_dir, 'city', props.map_name)
+    return resolve_region(city_path, props.map_name, region)
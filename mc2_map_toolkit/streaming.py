@@ -0,0 +1,230 @@
+import bpy
+import math, mathutils
+from bpy.app.handlers import persistent
+from .formats import translate_vector3
+from .dirty import ignore_update
+
+STREAM_INTERVAL = 0.25 # Seconds between streaming updates
+STREAM_MIN_MOVE = 5.0 # Distance the focus point has to move before chunks get re-evaluated
+
+_last_focus = None
+_chunk_near = {} # Chunk collection name -> near state from the last update
+_instance_band = {} # Instance object name -> lod band from the last update
+_chunks = None # (map name, view layer name, [(chunk collection, layer collection, center)]), see invalidate_stream_cache
+_lod_instances = None # (map name, [(instance, lod collection names, sphere center, radius)]), see invalidate_stream_cache
+
+# Chunks
+
+def get_chunk_key(location, origin, chunk_size):
+    # Grid cell (x, y) of a blender space location, relative to the .lvl extents origin
+    return (int((location[0] - origin[0]) // chunk_size), int((location[1] - origin[1]) // chunk_size))
+
+def get_chunk_center(key, origin, chunk_size):
+    return (origin[0] + (key[0] + 0.5) * chunk_size, origin[1] + (key[1] + 0.5) * chunk_size)
+
+def get_chunk_collection(parent_col, key, chunks, tags = None):
+    # Get or create the chunk collection for a grid cell below a hood's _unique or _inst collection
+    chunk_col = chunks.get(key)
+    if chunk_col is None:
+        chunk_col = bpy.data.collections.new(parent_col.name + '_' + str(key[0]) + '_' + str(key[1]))
+        parent_col.children.link(chunk_col)
+        chunk_col['mc2_chunk'] = key
+        for tag, value in (tags or {}).items():
+            chunk_col[tag] = value
+        chunks[key] = chunk_col
+    return chunk_col
+
+def map_layer_collections(layer_col, layer_cols):
+    # Collect the whole layer collection tree into a name -> layer collection dict in one walk
+    layer_cols[layer_col.name] = layer_col
+    for child in layer_col.children:
+        map_layer_collections(child, layer_cols)
+    return layer_cols
+
+def get_chunk_collections(city_hoods_col):
+    return [c for c in city_hoods_col.children_recursive if 'mc2_chunk' in c]
+
+def get_chunks(context, city_hoods_col):
+    # Chunk collections with their layer collection and center, collected once until the map's collections change
+    global _chunks
+    view_layer = context.view_layer
+    if _chunks is not None and _chunks[0] == city_hoods_col.name and _chunks[1] == view_layer.name:
+        return _chunks[2]
+
+    origin = city_hoods_col['mc2_chunk_origin']
+    chunk_size = city_hoods_col['mc2_chunk_size']
+    layer_cols = map_layer_collections(view_layer.layer_collection, {})
+    chunks = [(chunk_col, layer_cols.get(chunk_col.name), get_chunk_center(chunk_col['mc2_chunk'], origin, chunk_size))
+              for chunk_col in get_chunk_collections(city_hoods_col)]
+    _chunks = (city_hoods_col.name, view_layer.name, chunks)
+    return chunks
+
+# Streaming
+
+def get_focus_location(context):
+    props = context.scene.mc2_props
+
+    if props.stream_source == 'CAMERA' and context.scene.camera is not None:
+        return context.scene.camera.matrix_world.translation.copy()
+
+    if props.stream_source == 'VIEW':
+        for window in context.window_manager.windows:
+            for area in window.screen.areas:
+                if area.type == 'VIEW_3D':
+                    return area.spaces.active.region_3d.view_matrix.inverted().translation
+
+    return context.scene.cursor.location.copy()
+
+def set_chunk_state(chunk_col, layer_col, mode, near):
+    # Display changes only, they don't make the hood dirty for export
+    if mode == 'HIDE':
+        if layer_col is not None:
+            layer_col.hide_viewport = not near
+            ignore_update(chunk_col)
+    elif mode == 'BOUNDS':
+        display_type = 'TEXTURED' if near else 'BOUNDS'
+        for obj in chunk_col.objects:
+            obj.display_type = display_type
+            ignore_update(obj)
+
+def update_chunks(context, focus):
+    props = context.scene.mc2_props
+    city_hoods_col = bpy.data.collections.get(props.map_name + '_hoods')
+    if city_hoods_col is None or 'mc2_chunk_size' not in city_hoods_col:
+        return
+
+    half_diagonal = city_hoods_col['mc2_chunk_size'] * math.sqrt(0.5)
+
+    for chunk_col, layer_col, center in get_chunks(context, city_hoods_col):
+        dist = math.hypot(focus[0] - center[0], focus[1] - center[1]) - half_diagonal
+        near = dist <= props.stream_distance
+
+        # Only touch chunks whose state changed since the last update
+        if _chunk_near.get(chunk_col.name) != near:
+            set_chunk_state(chunk_col, layer_col, props.stream_mode, near)
+            _chunk_near[chunk_col.name] = near
+
+# LOD switching
+
+def get_lod_band(distance, radius, lod_distance, lod_count):
+    # Switch to the next lod every lod_distance bounding sphere radii
+    return min(int(distance / (max(radius, 1.0) * lod_distance)), lod_count - 1)
+
+def set_instance_lod(obj, lod_col_name):
+    lod_col = bpy.data.collections.get(lod_col_name)
+    if lod_col is not None and obj.instance_collection != lod_col:
+        obj.instance_collection = lod_col
+        ignore_update(obj)
+
+def get_lod_instances(city_hoods_col):
+    # Instances of city models that were imported with lower lods, with their lods and world space bounding
+    # sphere. Walked once and kept until the map's collections change, ticks only test distances
+    global _lod_instances
+    if _lod_instances is not None and _lod_instances[0] == city_hoods_col.name:
+        return _lod_instances[1]
+
+    instances = []
+    for obj in city_hoods_col.all_objects:
+        col = obj.instance_collection
+        if col is not None and 'mc2_lod_base' in col:
+            base_col = bpy.data.collections.get(col['mc2_lod_base'])
+            if base_col is None:
+                continue
+            sphere = base_col.get('mc2_bounding_sphere')
+            if sphere is None or len(sphere) < 4:
+                continue
+            center = obj.matrix_world @ mathutils.Vector(translate_vector3(sphere[:3]))
+            instances.append((obj, list(base_col['mc2_lods']), center, sphere[3]))
+    _lod_instances = (city_hoods_col.name, instances)
+    return instances
+
+def update_lods(context, focus):
+    props = context.scene.mc2_props
+    city_hoods_col = bpy.data.collections.get(props.map_name + '_hoods')
+    if city_hoods_col is None:
+        return
+
+    for obj, lods, center, radius in get_lod_instances(city_hoods_col):
+        band = get_lod_band((center - focus).length, radius, props.lod_distance, len(lods))
+
+        # Only swap the instance collection of instances whose band changed
+        if _instance_band.get(obj.name) != band:
+            set_instance_lod(obj, lods[band])
+            _instance_band[obj.name] = band
+
+def is_streaming(props):
+    return props.stream_mode != 'OFF' or props.use_lod_switching
+
+def stream_update():
+    global _last_focus
+    context = bpy.context
+    props = getattr(context.scene, 'mc2_props', None)
+    if props is None or not is_streaming(props):
+        return None # Stops the timer
+
+    focus = get_focus_location(context)
+    if _last_focus is not None and (focus - _last_focus).length < STREAM_MIN_MOVE:
+        return STREAM_INTERVAL # Throttle, focus barely moved
+
+    _last_focus = focus
+    if props.stream_mode != 'OFF':
+        update_chunks(context, focus)
+    if props.use_lod_switching:
+        update_lods(context, focus)
+    return STREAM_INTERVAL
+
+def invalidate_stream_cache(*args):
+    # For operators that add or remove hoods, instances or city models, and after undo and file loads
+    # where the kept objects aren't valid anymore. Rebuilt on the next tick
+    global _chunks, _lod_instances, _last_focus
+    _chunks = None
+    _lod_instances = None
+    _last_focus = None
+
+def reset_streaming(context):
+    # Show all chunks again and restart the timer if a streaming mode is active
+    invalidate_stream_cache()
+    _chunk_near.clear()
+    _instance_band.clear()
+
+    props = context.scene.mc2_props
+    city_hoods_col = bpy.data.collections.get(props.map_name + '_hoods')
+    if city_hoods_col is not None:
+        if 'mc2_chunk_size' in city_hoods_col:
+            for chunk_col, layer_col, center in get_chunks(context, city_hoods_col):
+                set_chunk_state(chunk_col, layer_col, 'HIDE', True)
+                set_chunk_state(chunk_col, None, 'BOUNDS', True)
+
+        if not props.use_lod_switching:
+            for obj, lods, center, radius in get_lod_instances(city_hoods_col):
+                set_instance_lod(obj, lods[0])
+
+    if is_streaming(props) and not bpy.app.timers.is_registered(stream_update):
+        bpy.app.timers.register(stream_update, first_interval=STREAM_INTERVAL, persistent=True)
+
+@persistent
+def stream_load_post(dummy):
+    invalidate_stream_cache()
+    _chunk_near.clear()
+    _instance_band.clear()
+    props = getattr(bpy.context.scene, 'mc2_props', None)
+    if props is not None and is_streaming(props):
+        reset_streaming(bpy.context)
+
+@persistent
+def stream_undo_post(*args):
+    invalidate_stream_cache()
+
+def register():
+    bpy.app.handlers.load_post.append(stream_load_post)
+    for handlers in (bpy.app.handlers.undo_post, bpy.app.handlers.redo_post):
+        handlers.append(stream_undo_post)
+
+def unregister():
+    if stream_load_post in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(stream_load_post)
+    for handlers in (bpy.app.handlers.undo_post, bpy.app.handlers.redo_post):
+        if stream_undo_post in handlers:
+            handlers.remove(stream_undo_post)
+    if bpy.app.timers.is_registered(stream_update):
+        bpy.app.timers.unregister(stream_update)
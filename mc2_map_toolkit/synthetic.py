@@ -0,0 +1,161 @@
+import os
+import random
+import struct
+from .tex_file import TEXFile, TEXType
+from .formats import Hood, UniqueComponent, InstanceComponent, PropFile, PropTemplate, PropInstance
+from .fileio import atomic_write
+
+# Deterministic generator of a fake MC2 directory for benchmarks: a map with a .lvl, hoods, a .prop with
+# templates and .pdef files, .cc city models with .xmod lods and .xbcpv colors, and .tex textures in every
+# format the toolkit decodes. The same seed and scale always give the same files
+
+SCALES = {
+    # hoods, components per hood, city models, prop templates, props, model grid size, texture size
+    'small': {'hoods': 4, 'components': 16, 'models': 8, 'templates': 4, 'props': 64, 'grid': 8, 'texture_size': 32},
+    'medium': {'hoods': 16, 'components': 64, 'models': 32, 'templates': 16, 'props': 512, 'grid': 16, 'texture_size': 64},
+    'large': {'hoods': 64, 'components': 256, 'models': 128, 'templates': 48, 'props': 4096, 'grid': 32, 'texture_size': 128},
+}
+
+TEXTURE_FORMATS = (TEXType.P8, TEXType.P8A8, TEXType.A1R5G5B5, TEXType.I8, TEXType.A4I4, TEXType.A8I8, TEXType.A8,
+                   TEXType.PA8, TEXType.P4, TEXType.PA4, TEXType.RGB888, TEXType.RGB8888,
+                   TEXType.DXT1, TEXType.DXT3, TEXType.DXT5)
+
+ASSET_FOLDERS = ('anim', 'bound', 'fonts', 'geometry', 'model', 'tune') # What validate_mc2_dir looks for
+
+def random_matrix(rng, extent):
+    # Rotation around the up axis and a translation, 4 Matrix34 rows flattened
+    angle = rng.uniform(-1.0, 1.0)
+    c, s = 1.0 - angle * angle / 2, angle # Close enough to a rotation for fake data
+    pos = (rng.uniform(-extent, extent), rng.uniform(0.0, 20.0), rng.uniform(-extent, extent))
+    return (c, 0.0, -s, 0.0, 1.0, 0.0, s, 0.0, c) + pos
+
+def write_texture(filepath, fmt, size, rng):
+    tf = TEXFile()
+    tf.width = tf.height = size
+    tf.format = fmt
+    if tf.is_paletted_format():
+        tf.palette = [(rng.random(), rng.random(), rng.random(), rng.random()) for i in range(16 if fmt in (TEXType.P4, TEXType.PA4) else 256)]
+
+    # Compressed mips stop at one 4x4 block, the DXT decoder needs whole blocks
+    min_size = 4 if tf.is_compressed_format() else 1
+    mip = 0
+    while tf.calculate_mip_size(mip)[0] >= min_size and tf.calculate_mip_array_size(mip) > 0:
+        tf.mipmaps.append(bytes(rng.getrandbits(8) for i in range(tf.calculate_mip_array_size(mip))))
+        mip += 1
+    tf.write(filepath)
+
+def make_xmod(rng, grid, textures):
+    # Grid of quads, every row one packet with a triangle strip, rows spread over 3 materials. The first
+    # material has no texture, so the importer reorders it like real files
+    size = grid + 1
+    lines = ['version: 1.10\n']
+    lines.extend('v %.6f %.6f %.6f\n' % (x - grid / 2, rng.uniform(-0.5, 0.5), y - grid / 2) for y in range(size) for x in range(size))
+    lines.extend('n %.6f %.6f %.6f\n' % (0.0, 1.0, 0.0) for i in range(size * size))
+    lines.extend('c %.6f %.6f %.6f %.6f\n' % (rng.random(), rng.random(), rng.random(), 1.0) for i in range(size * size))
+    lines.extend('t1 %.6f %.6f\n' % (x / grid, y / grid) for y in range(size) for x in range(size))
+
+    mat_rows = [[row for row in range(grid) if row % 3 == m] for m in range(3)]
+    mat_rows = [rows for rows in mat_rows if rows]
+    adj_counts = []
+    for m, rows in enumerate(mat_rows):
+        texture_lines = '' if m == 0 else '\ttextures: 1\n\ttexture: 0 "%s"\n' % rng.choice(textures)
+        lines.append('mtl material_%d {\n\tpackets: %d\n\tprimitives: %d\n%s}\n' %
+                     (m, len(rows), len(rows), texture_lines or '\ttextures: 0\n'))
+        adj_counts.append(len(rows) * size * 2)
+
+    for rows in mat_rows:
+        for row in rows:
+            lines.append('packet %d 1 {\n' % (size * 2))
+            for x in range(size):
+                for y in (row, row + 1):
+                    v_idx = y * size + x
+                    lines.append('\tadj %d %d %d %d 0 0\n' % (v_idx, v_idx, v_idx, v_idx))
+            prim = 'str' if row % 2 == 0 else 'stp'
+            lines.append('\t%s %d %s\n}\n' % (prim, size * 2, ' '.join(str(i) for i in range(size * 2))))
+    return ''.join(lines), adj_counts
+
+def make_xbcpv(rng, adj_counts):
+    parts = [b'CPV0', struct.pack('<I', len(adj_counts))]
+    for count in adj_counts:
+        parts.append(struct.pack('<I', count))
+        parts.append(bytes(rng.getrandbits(8) for i in range(count * 4)))
+    return b''.join(parts)
+
+def generate_city(mc2_dir, scale = 'small', seed = 0, map_name = 'synth'):
+    # Returns the file counts by extension
+    config = SCALES[scale] if isinstance(scale, str) else scale
+    rng = random.Random(seed)
+    counts = {}
+
+    def write(filepath, data):
+        atomic_write(filepath, data, 'wb' if isinstance(data, bytes) else 'w', set())
+        ext = os.path.splitext(filepath)[1]
+        counts[ext] = counts.get(ext, 0) + 1
+
+    city_path = os.path.join(mc2_dir, 'city', map_name)
+    models_path = os.path.join(city_path, 'models')
+    texture_path = os.path.join(mc2_dir, 'texture_x')
+    for path in [models_path, texture_path] + [os.path.join(mc2_dir, folder) for folder in ASSET_FOLDERS]:
+        os.makedirs(path, exist_ok = True)
+
+    # Textures, every format in turn
+    textures = []
+    for idx in range(max(len(TEXTURE_FORMATS), config['models'] // 2)):
+        fmt = TEXTURE_FORMATS[idx % len(TEXTURE_FORMATS)]
+        name = 'tex_%03d_%s' % (idx, fmt.name.lower())
+        write_texture(os.path.join(texture_path, name + '.tex'), fmt, config['texture_size'], rng)
+        counts['.tex'] = counts.get('.tex', 0) + 1
+        textures.append(name)
+
+    # City models, a full and a half resolution lod each
+    grid = config['grid']
+    models = ['model_%03d' % idx for idx in range(config['models'])]
+    for name in models:
+        write(os.path.join(models_path, name + '.cc'),
+              'num_inst_cpv: 1\nsphere: 0.000000 0.000000 0.000000 %.6f\nlod 0 {\n\th\n}\nlod 1 {\n\th\n}\n' % grid)
+        for level, level_grid in ((0, grid), (1, max(1, grid // 2))):
+            xmod_text, adj_counts = make_xmod(rng, level_grid, textures)
+            model_fp = os.path.join(models_path, '%s_%d_h' % (name, level))
+            write(model_fp + '.xmod', xmod_text)
+            write(model_fp + '.xbcpv', make_xbcpv(rng, adj_counts))
+
+    # Hoods laid out in a square, half unique and half instance components
+    extent = 200.0 * config['hoods']
+    hoods = ['hood_%03d' % idx for idx in range(config['hoods'])]
+    for hood_name in hoods:
+        hood = Hood(hood_name)
+        for idx in range(config['components']):
+            model = rng.choice(models)
+            matrix = random_matrix(rng, extent)
+            emin = tuple(v - grid for v in matrix[9:12])
+            emax = tuple(v + grid for v in matrix[9:12])
+            if idx % 2 == 0:
+                hood.uniques.append(UniqueComponent(model, emin, emax))
+            else:
+                hood.instances.append(InstanceComponent(model, hood_name, str(idx), matrix, emin, emax))
+        write(os.path.join(city_path, hood_name + '.hood'), hood.serialize())
+
+    write(os.path.join(city_path, map_name + '.lvl'),
+          'extents_min\n\t%.6f 0.000000 %.6f\nextents_max\n\t%.6f 100.000000 %.6f\n' % (-extent, -extent, extent, extent) +
+          ''.join('hood {\n\tname: %s\n}\n' % hood_name for hood_name in hoods))
+
+    # Prop templates with a .pdef and model each, props split over the 3 classes
+    prop_file = PropFile()
+    for idx in range(config['templates']):
+        template = PropTemplate('prop_%03d' % idx)
+        template.parts = [('prop_%03d_part' % idx, (0.0, 1.0, 0.0))] if idx % 4 == 0 else []
+        template.fixedobject = idx % 2
+        template.gfxonly = int(idx % 5 == 0)
+        prop_file.templates.append(template)
+        write(os.path.join(city_path, template.name + '.pdef'), 'lods: 1 0\nsphere: 0.000000 1.000000 0.000000 2.000000\n')
+        xmod_text, adj_counts = make_xmod(rng, 2, textures)
+        write(os.path.join(models_path, template.name + '_0.xmod'), xmod_text)
+        for name, offset in template.parts:
+            write(os.path.join(models_path, name + '_0.xmod'), xmod_text)
+
+    for idx in range(config['props']):
+        prop = PropInstance(str(idx), random_matrix(rng, extent), rng.choice(prop_file.templates).name)
+        (prop_file.props, prop_file.fixed_props, prop_file.gfx_props)[idx % 3].append(prop)
+    write(os.path.join(city_path, map_name + '.prop'), prop_file.serialize())
+
+    return counts
@@ -2,7 +2,7 @@
 
 from enum import IntEnum
 import struct, io
-import bpy
+from .fileio import atomic_open
 
 class TEXType(IntEnum):
     P8 = 1
@@ -26,8 +26,26 @@ class TEXType(IntEnum):
     
 class TEXFile:
     def to_blender_image(self, name= 'tex_image', pack = True):
+        import bpy # Only here, the command line converter reads textures without blender
         im = bpy.data.images.new(name=name, width=self.width, height=self.height, alpha=self.is_alpha_format())
-        pixels = list(im.pixels)
+        self.fill_blender_image(im, pack)
+        return im
+
+    def fill_blender_image(self, im, pack = True, pixels = None):
+        # Write the top mip into an existing image, resizing it if needed. Pixels decoded ahead of time
+        # (by get_pixels in a worker thread) can be passed in
+        if tuple(im.size) != (self.width, self.height):
+            im.scale(self.width, self.height)
+
+        im.pixels = pixels if pixels is not None else self.get_pixels()
+        im.update()
+        
+        if pack:
+            im.pack()
+
+    def get_pixels(self):
+        # Flat RGBA float list of the top mip, bottom row first like blender expects
+        pixels = [0.0] * (self.width * self.height * 4)
         
         for y in range(self.height):
             for x in range(self.width):
@@ -39,14 +57,35 @@ class TEXFile:
                 pixels[b_pixel_index+1] = pixel_color[1]
                 pixels[b_pixel_index+2] = pixel_color[2]
                 pixels[b_pixel_index+3] = pixel_color[3]
-    
-        im.pixels = pixels[:]
-        im.update()
-        
-        if pack:
-            im.pack()
-            
-        return im
+
+        return pixels
+
+    def get_rgba_bytes(self):
+        # RGBA bytes of the top mip, top row first like image files store them
+        rgba = bytearray(self.width * self.height * 4)
+        idx = 0
+        for y in range(self.height):
+            for x in range(self.width):
+                for channel in self.get_pixel(x, y):
+                    rgba[idx] = max(0, min(255, round(channel * 255)))
+                    idx += 1
+        return rgba
+
+    def strip_mips(self, mip_level):
+        # Make a smaller mip the top level one, dropping the larger mips. Returns the mip level that was used
+        mip_level = max(0, min(mip_level, len(self.mipmaps) - 1))
+        min_size = 4 if self.is_compressed_format() else 1 # DXT decoding needs whole blocks
+
+        while mip_level > 0:
+            width, height = self.calculate_mip_size(mip_level)
+            if width >= min_size and height >= min_size:
+                break
+            mip_level -= 1
+
+        if mip_level > 0:
+            self.width, self.height = self.calculate_mip_size(mip_level)
+            self.mipmaps = self.mipmaps[mip_level:]
+        return mip_level
         
     def __read_palette(self, file, color_count):
         for x in range(color_count):
@@ -158,7 +197,7 @@ class TEXFile:
         return (mip_data[data_index] / 255, mip_data[data_index + 1] / 255, mip_data[data_index + 2] / 255, mip_data[data_index + 3] / 255)
         
     def __get_pixel_a1r5g5b5(self, x, y, stride, mip_data, mip_size, data_index):
-        color_short = struct.unpack('<H', (mip_data[data_index], mip_data[data_index + 1]))[0]
+        color_short = struct.unpack_from('<H', mip_data, data_index)[0]
         maskA = 32768 
         maskR = 0x7C00
         maskG = 0x3E0
@@ -239,7 +278,7 @@ class TEXFile:
 
 
     def write(self, filepath):
-        with open(filepath, 'wb') as file:
+        with atomic_open(filepath, 'wb') as file:
             file.write(struct.pack('<HHH', self.width, self.height, self.format))
             file.write(struct.pack('<HHL', len(self.mipmaps), 1, self.flags))
             
@@ -0,0 +1,148 @@
+import bpy
+import os
+import time
+from bpy.app.handlers import persistent
+from .texture_stream import queue_texture, is_pending
+from .catalog import file_exists
+
+# Texture memory budget: every image loaded from a .tex file (they carry 'mc2_mip_level') counts with its
+# decoded and packed size. A timer notes which images the viewport shows, through the materials of visible
+# objects and of the collections visible instances use. Over the budget, the images not seen for the longest
+# get downscaled a mip level per pass, or shrunk to a stub right away, until memory is back under the budget.
+# Evicted images that come into view again are decoded from their .tex file in the background
+
+BUDGET_INTERVAL = 2.0 # Seconds between budget checks
+BUDGET_TARGET = 0.9 # Share of the budget evicting brings memory down to, so it doesn't run every check
+EVICT_MIN_SIZE = 16
+EVICTED_KEY = 'mc2_evicted'
+
+_last_seen = {} # Image name -> time it was last in view
+_total_bytes = 0 # Texture memory at the last check, for the panel
+
+def image_bytes(image):
+    if not image.has_data:
+        return 0
+    width, height = image.size
+    size = width * height * (16 if image.is_float else 4)
+    if image.packed_file is not None:
+        size += image.packed_file.size
+    return size
+
+def get_texture_images():
+    return [image for image in bpy.data.images if 'mc2_mip_level' in image]
+
+def get_total_bytes():
+    return _total_bytes
+
+def add_material_images(material_slots, materials):
+    for slot in material_slots:
+        if slot.material is not None:
+            materials.add(slot.material)
+
+def get_viewed_images(context):
+    # Names of the images used by materials the viewport draws textured
+    materials = set()
+    instanced = set()
+    for obj in context.view_layer.objects:
+        if obj.display_type == 'BOUNDS' or not obj.visible_get():
+            continue
+        col = obj.instance_collection
+        if obj.instance_type == 'COLLECTION' and col is not None:
+            if col.name not in instanced: # Many instances share a city model, walk it once
+                instanced.add(col.name)
+                for inst_obj in col.all_objects:
+                    add_material_images(inst_obj.material_slots, materials)
+        else:
+            add_material_images(obj.material_slots, materials)
+
+    images = set()
+    for material in materials:
+        if material.node_tree is not None:
+            for node in material.node_tree.nodes:
+                if node.type == 'TEX_IMAGE' and node.image is not None:
+                    images.add(node.image.name)
+    return images
+
+def evict_image(image, mode):
+    # Returns if the image got smaller
+    width, height = image.size
+    if mode == 'UNLOAD':
+        size = (min(width, EVICT_MIN_SIZE), min(height, EVICT_MIN_SIZE))
+    else:
+        size = (max(min(width, EVICT_MIN_SIZE), width // 2), max(min(height, EVICT_MIN_SIZE), height // 2))
+    if size == (width, height):
+        return False
+
+    image.scale(*size)
+    if image.packed_file is not None:
+        image.pack() # Packed data of the full size image would keep it in memory
+    image[EVICTED_KEY] = True
+    return True
+
+def restore_image(image):
+    del image[EVICTED_KEY]
+    queue_texture(image, image.filepath_raw, image.get('mc2_mip_level', 0))
+
+def restore_evicted_images():
+    # Images that were evicted when they got saved, like in library cache files
+    for image in get_texture_images():
+        if image.get(EVICTED_KEY) and not is_pending(image.name) and file_exists(image.filepath_raw):
+            restore_image(image)
+
+def enforce_budget(context, budget, mode):
+    global _total_bytes
+    now = time.monotonic()
+    viewed = get_viewed_images(context)
+    images = [image for image in get_texture_images() if not is_pending(image.name)]
+
+    for image in images:
+        if image.name in viewed:
+            _last_seen[image.name] = now
+            if image.get(EVICTED_KEY) and file_exists(image.filepath_raw):
+                restore_image(image)
+
+    _total_bytes = total = sum(image_bytes(image) for image in images)
+    if total <= budget:
+        return
+
+    # Least recently viewed first, images never seen since loading before all others
+    candidates = [image for image in images if image.name not in viewed and image.has_data and file_exists(image.filepath_raw)]
+    candidates.sort(key = lambda image: _last_seen.get(image.name, 0.0))
+    target = budget * BUDGET_TARGET
+    for image in candidates:
+        if total <= target:
+            break
+        before = image_bytes(image)
+        if evict_image(image, mode):
+            total -= before - image_bytes(image)
+    _total_bytes = total
+
+def budget_update():
+    context = bpy.context
+    props = getattr(context.scene, 'mc2_props', None)
+    if props is None or props.texture_budget <= 0.0:
+        return None # Stops the timer
+
+    enforce_budget(context, int(props.texture_budget * 1024 ** 3), props.texture_evict_mode)
+    return BUDGET_INTERVAL
+
+def reset_budget(context):
+    props = context.scene.mc2_props
+    if props.texture_budget > 0.0 and not bpy.app.timers.is_registered(budget_update):
+        bpy.app.timers.register(budget_update, first_interval = BUDGET_INTERVAL, persistent = True)
+
+@persistent
+def budget_load_post(dummy):
+    _last_seen.clear()
+    props = getattr(bpy.context.scene, 'mc2_props', None)
+    if props is not None:
+        reset_budget(bpy.context)
+
+def register():
+    bpy.app.handlers.load_post.append(budget_load_post)
+
+def unregister():
+    if budget_load_post in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(budget_load_post)
+    if bpy.app.timers.is_registered(budget_update):
+        bpy.app.timers.unregister(budget_update)
@@ -0,0 +1,119 @@
+import bpy
+import os
+from bpy.app.handlers import persistent
+from .catalog import file_exists
+
+# Textures decoded in the background: importers get a small placeholder image right away and the .tex file
+# is decoded in a worker thread. A timer swaps the decoded pixels into the placeholders a few images per tick,
+# so the city can be looked around in while textures fill in. Placeholders keep the .tex path they're waiting
+# for, so a file saved before they were filled in picks them up again on load
+
+DECODE_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+SWAP_INTERVAL = 0.1 # Seconds between swaps
+SWAPS_PER_TICK = 4 # Images filled in per tick, keeps every tick short
+PLACEHOLDER_SIZE = 4
+PLACEHOLDER_COLOR = (0.5, 0.5, 0.5, 1.0)
+STREAM_SOURCE_KEY = 'mc2_stream_source'
+
+_executor = None
+_pending = {} # Image name -> (.tex path, mip level, future)
+
+def decode_texture(file_path, mip_level):
+    # Everything of loading a texture that doesn't need blender, runs in the worker threads
+    from .tex_file import TEXFile
+    tf = TEXFile(file_path)
+    if not tf.is_valid():
+        raise ValueError("Invalid TEX file: " + file_path)
+    mip_level = tf.strip_mips(mip_level)
+    if tf.is_compressed_format():
+        tf.decompress()
+    return tf, tf.get_pixels(), mip_level
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _executor = ThreadPoolExecutor(DECODE_WORKERS, thread_name_prefix = 'mc2_texture')
+    return _executor
+
+def create_placeholder(name, file_path, mip_level = 0):
+    # Placeholder image the texture gets decoded into later
+    image = bpy.data.images.new(name, PLACEHOLDER_SIZE, PLACEHOLDER_SIZE, alpha = True)
+    image.generated_color = PLACEHOLDER_COLOR
+    image.filepath_raw = file_path
+    image.alpha_mode = 'CHANNEL_PACKED'
+    image['mc2_mip_level'] = mip_level
+    queue_texture(image, file_path, mip_level)
+    return image
+
+def queue_texture(image, file_path, mip_level = 0):
+    image[STREAM_SOURCE_KEY] = file_path
+    _pending[image.name] = (file_path, mip_level, get_executor().submit(decode_texture, file_path, mip_level))
+    if not bpy.app.timers.is_registered(swap_textures):
+        bpy.app.timers.register(swap_textures, first_interval = SWAP_INTERVAL, persistent = True)
+
+def discard_texture(image):
+    # For images decoded right away by something else, like upgrading to full detail
+    _pending.pop(image.name, None)
+    if STREAM_SOURCE_KEY in image:
+        del image[STREAM_SOURCE_KEY]
+
+def is_pending(name):
+    return name in _pending
+
+def pending_count():
+    return len(_pending)
+
+def fill_image(image, file_path, decoded):
+    tf, pixels, mip_level = decoded
+    tf.fill_blender_image(image, pixels = pixels)
+    image.filepath_raw = file_path
+    image.alpha_mode = 'CHANNEL_PACKED'
+    image['mc2_mip_level'] = mip_level
+
+def swap_textures():
+    swapped = 0
+    for name, (file_path, mip_level, future) in list(_pending.items()):
+        if swapped >= SWAPS_PER_TICK:
+            break
+        if not future.done():
+            continue
+
+        del _pending[name]
+        image = bpy.data.images.get(name)
+        if image is None or image.get(STREAM_SOURCE_KEY) != file_path:
+            continue # Removed, or decoded by something else in the meantime
+
+        try:
+            fill_image(image, file_path, future.result())
+        except Exception as ex:
+            print('Tex file load failed, keeping placeholder:', file_path, ex)
+        del image[STREAM_SOURCE_KEY]
+        swapped += 1
+
+    if not _pending:
+        return None # Stops the timer
+    return SWAP_INTERVAL
+
+@persistent
+def texture_stream_load_post(dummy):
+    # Decodes of the previous file are of no use anymore, placeholders saved in this one get queued again
+    _pending.clear()
+    for image in bpy.data.images:
+        file_path = image.get(STREAM_SOURCE_KEY)
+        if file_path and file_exists(file_path):
+            queue_texture(image, file_path, image.get('mc2_mip_level', 0))
+
+def register():
+    bpy.app.handlers.load_post.append(texture_stream_load_post)
+
+def unregister():
+    global _executor
+    if texture_stream_load_post in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(texture_stream_load_post)
+    if bpy.app.timers.is_registered(swap_textures):
+        bpy.app.timers.unregister(swap_textures)
+    _pending.clear()
+    if _executor is not None:
+        _executor.shutdown(wait = False)
+        _executor = None
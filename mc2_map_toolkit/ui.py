@@ -0,0 +1,358 @@
+import bpy
+import sys
+from . import operator_defs
+from . import streaming
+from . import dirty
+from . import texture_stream
+from . import texture_budget
+from .memory import format_bytes
+from .prefs import get_pref, set_pref
+
+from .catalog import validate_mc2_dir
+
+# Properties
+
+def update_dir(self, context): # Update function for when mc2 directory is refreshed
+    set_pref('mc2_dir', self.mc2_dir) # Kept in the prefs file so it stays persistent
+    dirty.mark_all_dirty() # Clean hoods and prop classes were exported to the other directory
+
+def update_map_name(self, context):
+    set_pref('map_name', self.map_name)
+    dirty.mark_all_dirty()
+
+def update_stream(self, context):
+    streaming.reset_streaming(context)
+
+def update_texture_budget(self, context):
+    texture_budget.reset_budget(context)
+
+
+class MC2Properties(bpy.types.PropertyGroup):
+    map_name: bpy.props.StringProperty(
+        name="Map",
+        description="Enter a map name or string",
+        default=get_pref('map_name'),
+        update=update_map_name
+    )
+
+    mc2_dir: bpy.props.StringProperty(
+        name="MC2 Dir",
+        subtype='DIR_PATH',
+        description="Directory path to Midnight Club 2 folder",
+        default=get_pref('mc2_dir'), # Read last used path from the prefs file
+        update=update_dir
+    )
+
+    region_mode: bpy.props.EnumProperty(
+        name="Region",
+        description="Part of the map to import and spawn",
+        items=[
+            ('ALL', "Whole Map", "Import and spawn every hood and prop"),
+            ('HOODS', "Hoods", "Hoods matching the name filter"),
+            ('BOX', "Bounding Box", "Hoods overlapping a bounding box"),
+            ('CURSOR', "Around 3D Cursor", "Hoods within a radius of the 3D cursor"),
+        ],
+        default='ALL'
+    )
+
+    region_hoods: bpy.props.StringProperty(
+        name="Hoods",
+        description="Comma separated hood names, wildcards are allowed",
+        default=""
+    )
+
+    region_min: bpy.props.FloatVectorProperty(
+        name="Min",
+        description="Bounding box corner",
+        subtype='XYZ'
+    )
+
+    region_max: bpy.props.FloatVectorProperty(
+        name="Max",
+        description="Opposite bounding box corner",
+        subtype='XYZ'
+    )
+
+    region_radius: bpy.props.FloatProperty(
+        name="Radius",
+        description="Distance around the 3D cursor to import and spawn",
+        default=500.0,
+        min=0.0,
+        subtype='DISTANCE'
+    )
+
+    export_changed_only: bpy.props.BoolProperty(
+        name="Changed Only",
+        description="Only export hoods and prop classes whose objects changed since the last export",
+        default=True
+    )
+
+    chunk_size: bpy.props.FloatProperty(
+        name="Chunk Size",
+        description="Size of the spatial chunks spawned hood models get grouped into",
+        default=250.0,
+        min=10.0,
+        subtype='DISTANCE'
+    )
+
+    stream_mode: bpy.props.EnumProperty(
+        name="Streaming",
+        description="How chunks outside of the streaming distance are displayed in the viewport",
+        items=[
+            ('OFF', "Off", "Show all chunks"),
+            ('HIDE', "Hide", "Hide chunks outside of the streaming distance"),
+            ('BOUNDS', "Bounds", "Display chunks outside of the streaming distance as bounding boxes"),
+        ],
+        default='OFF',
+        update=update_stream
+    )
+
+    stream_source: bpy.props.EnumProperty(
+        name="Stream Around",
+        description="Point the streaming distance is measured from",
+        items=[
+            ('CAMERA', "Camera", "Active scene camera"),
+            ('VIEW', "View", "3D viewport view location"),
+            ('CURSOR', "3D Cursor", "3D cursor location"),
+        ],
+        default='VIEW',
+        update=update_stream
+    )
+
+    import_profile: bpy.props.EnumProperty(
+        name="Import Profile",
+        description="Level of detail city models are imported at",
+        items=[
+            ('FULL', "Full Detail", "Highest detail lod and full resolution textures"),
+            ('PREVIEW', "Preview", "Lowest detail lod and smaller textures, for fast layout work"),
+        ],
+        default='FULL'
+    )
+
+    preview_mip_level: bpy.props.IntProperty(
+        name="Preview Mip",
+        description="Texture mip level decoded by preview imports, each level halves the resolution",
+        default=2,
+        min=0,
+        max=8
+    )
+
+    background_textures: bpy.props.BoolProperty(
+        name="Background Textures",
+        description="Create materials with placeholder textures and decode the textures in the background, they fill in while the city can already be looked around in",
+        default=True
+    )
+
+    texture_budget: bpy.props.FloatProperty(
+        name="Texture Budget (GB)",
+        description="Memory imported textures may use, the least recently viewed ones are evicted above it. 0 for no budget",
+        default=0.0,
+        min=0.0,
+        update=update_texture_budget
+    )
+
+    texture_evict_mode: bpy.props.EnumProperty(
+        name="Evict",
+        description="How textures over the budget are evicted, both load again from their .tex file when they come into view",
+        items=[
+            ('DOWNSCALE', "Downscale", "Halve the resolution of the least recently viewed textures a step at a time"),
+            ('UNLOAD', "Unload", "Shrink the least recently viewed textures to a small stub"),
+        ],
+        default='DOWNSCALE'
+    )
+
+    import_all_lods: bpy.props.BoolProperty(
+        name="Import All LODs",
+        description="Import every lod listed in the .cc files instead of only the highest detail one",
+        default=False
+    )
+
+    use_lod_switching: bpy.props.BoolProperty(
+        name="LOD Switching",
+        description="Switch city model instances between their imported lods by distance",
+        default=False,
+        update=update_stream
+    )
+
+    lod_distance: bpy.props.FloatProperty(
+        name="LOD Distance",
+        description="Distance between lod switches, in bounding sphere radii of the model",
+        default=20.0,
+        min=1.0,
+        update=update_stream
+    )
+
+    stream_distance: bpy.props.FloatProperty(
+        name="Stream Distance",
+        description="Chunks within this distance of the streaming point are fully displayed",
+        default=1000.0,
+        min=0.0,
+        subtype='DISTANCE',
+        update=update_stream
+    )
+
+    profile_mode: bpy.props.EnumProperty(
+        name="Profiling",
+        description="Time the stages of import, spawn and export runs and write a report per run",
+        items=[
+            ('OFF', "Off", "No profiling"),
+            ('TIMERS', "Timers", "Stage timers, the slowest files and counters written to a JSON report"),
+            ('CPROFILE', "cProfile", "Stage timers and a cProfile .prof file of the whole run"),
+        ],
+        default='OFF'
+    )
+
+    profile_dir: bpy.props.StringProperty(
+        name="Profile Directory",
+        description="Directory profile reports are written to, next to the .blend file when empty",
+        default="",
+        subtype='DIR_PATH'
+    )
+
+    memory_tracking: bpy.props.BoolProperty(
+        name="Track Memory",
+        description="Record memory at stage boundaries and attribute python allocations to source lines in the profile report. Slows runs down",
+        default=False
+    )
+
+    memory_budget: bpy.props.FloatProperty(
+        name="Memory Budget (GB)",
+        description="Process memory limit checked at stage boundaries, 0 for none",
+        default=0.0,
+        min=0.0
+    )
+
+    memory_budget_action: bpy.props.EnumProperty(
+        name="Over Budget",
+        description="What to do when memory gets close to the budget",
+        items=[
+            ('WARN', "Warn", "Keep going and report a warning"),
+            ('PAUSE', "Pause", "Stop importing or spawning before the next model or hood, running the operator again continues"),
+        ],
+        default='WARN'
+    )
+
+# UI Panel
+
+class MC2_PT_MainPanel(bpy.types.Panel):
+    bl_label = "MC2 Map Editor"
+    bl_idname = "MC2_PT_main_panel"
+    bl_space_type = "VIEW_3D"
+    bl_region_type = "UI"
+    bl_category = "MC2"
+
+    def draw(self, context):
+        layout = self.layout
+        props = context.scene.mc2_props
+
+        layout.prop(props, "mc2_dir")
+
+        valid, msg = validate_mc2_dir(props.mc2_dir)
+        if not valid:
+            row = layout.row()
+            row.alert = True
+            row.label(text=f"{msg}", icon="ERROR")
+
+        layout.prop(props, "map_name")
+
+        layout.separator()
+
+        row = layout.column()
+        #row.enabled = valid
+        row.operator("mc2.setup_scene")
+        row.operator("mc2.clear_scene")
+        row.operator("mc2.restore_backup")
+        row.separator()
+
+        row.prop(props, "region_mode")
+        if props.region_mode == 'HOODS':
+            row.prop(props, "region_hoods")
+        elif props.region_mode == 'BOX':
+            row.prop(props, "region_min")
+            row.prop(props, "region_max")
+        elif props.region_mode == 'CURSOR':
+            row.prop(props, "region_radius")
+        row.separator()
+
+        row.prop(props, "import_profile")
+        if props.import_profile == 'PREVIEW':
+            row.prop(props, "preview_mip_level")
+        else:
+            row.prop(props, "import_all_lods")
+        row.prop(props, "background_textures")
+        row.prop(props, "texture_budget")
+        sub = row.column()
+        sub.enabled = props.texture_budget > 0.0
+        sub.prop(props, "texture_evict_mode")
+        if props.texture_budget > 0.0:
+            sub.label(text=f"Textures: {format_bytes(texture_budget.get_total_bytes())}")
+        row.operator("mc2.import_city_models")
+        row.operator("mc2.upgrade_city_models")
+        row.operator("mc2.sync_city_models")
+        row.operator("mc2.import_props")
+        row.separator()
+
+        row.prop(props, "chunk_size")
+        row.operator("mc2.spawn_city_models")
+        row.operator("mc2.spawn_props")
+        row.operator("mc2.write_city_cache")
+        row.operator("mc2.load_city_cache")
+        row.separator()
+
+        row.prop(props, "stream_mode")
+        sub = row.column()
+        sub.enabled = props.stream_mode != 'OFF'
+        sub.prop(props, "stream_source")
+        sub.prop(props, "stream_distance")
+        row.prop(props, "use_lod_switching")
+        sub = row.column()
+        sub.enabled = props.use_lod_switching
+        sub.prop(props, "lod_distance")
+        row.separator()
+
+        # Some kind of validate operator here?
+
+        row.prop(props, "export_changed_only")
+        row.operator("mc2.export_hoods")
+        row.operator("mc2.export_props")
+        row.separator()
+
+        row.prop(props, "profile_mode")
+        sub = row.column()
+        sub.enabled = props.profile_mode != 'OFF' or props.memory_tracking
+        sub.prop(props, "profile_dir")
+        row.prop(props, "memory_tracking")
+        row.prop(props, "memory_budget")
+        sub = row.column()
+        sub.enabled = props.memory_budget > 0.0
+        sub.prop(props, "memory_budget_action")
+
+# Registration
+
+classes = (
+    MC2Properties,
+    MC2_PT_MainPanel,
+)
+
+def register():
+    for cls in classes:
+        bpy.utils.register_class(cls)
+    bpy.types.Scene.mc2_props = bpy.props.PointerProperty(type=MC2Properties)
+    operator_defs.register()
+    streaming.register()
+    dirty.register()
+    texture_stream.register()
+    texture_budget.register()
+
+def unregister():
+    texture_budget.unregister()
+    texture_stream.unregister()
+    instance_store = sys.modules.get(__package__ + '.instance_store')
+    if instance_store is not None: # Imported on first use, registers its handlers then
+        instance_store.unregister()
+    dirty.unregister()
+    streaming.unregister()
+    operator_defs.unregister()
+    del bpy.types.Scene.mc2_props
+    for cls in reversed(classes):
+        bpy.utils.unregister_class(cls)
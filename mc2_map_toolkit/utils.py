@@ -1,19 +1,73 @@
 import bpy
 import math, mathutils
 import os
-import shutil
+import hashlib
 from bpy_extras.io_utils import axis_conversion
+from .fileio import atomic_write
+from .formats import translate_vector3 # Lives with the bpy-free code, region resolution uses it outside of blender
+from .profiling import stage, count
+from .catalog import find_file, file_exists
+
+class CollectionRegistry:
+    # Name -> collection and layer collection lookups, built once per operator run and kept up to date
+    # on create and link, so importers don't have to scan bpy.data.collections or the layer tree
+    def __init__(self, context = None):
+        context = context or bpy.context
+        self.scene_col = context.scene.collection
+        self.root_layer_col = context.view_layer.layer_collection
+        self.collections = {c.name: c for c in bpy.data.collections}
+        self.layer_collections = {}
+        self.__map_layer_collections(self.root_layer_col)
+
+    def __map_layer_collections(self, layer_col):
+        self.layer_collections.setdefault(layer_col.name, layer_col)
+        for child in layer_col.children:
+            self.__map_layer_collections(child)
+
+    def get(self, col_name):
+        return self.collections.get(col_name)
+
+    def get_layer_collection(self, col_name):
+        return self.layer_collections.get(col_name)
+
+    def create_get(self, col_name):
+        # Same as create_get_collection, new collections are linked to the scene collection
+        c = self.collections.get(col_name)
+        count('collections.lookups')
+        if c is None:
+            c = bpy.data.collections.new(col_name)
+            self.collections[c.name] = c
+            self.link(c, self.scene_col)
+            count('collections.created')
+        return c
+
+    def link(self, col_from, col_to):
+        # Same as link_col_to_col, also used to link new collections to the scene collection
+        if col_to != self.scene_col and col_from.name in self.scene_col.children:
+            self.scene_col.children.unlink(col_from)
+            for c in [col_from] + list(col_from.children_recursive):
+                self.layer_collections.pop(c.name, None)
+        if col_from.name not in col_to.children:
+            col_to.children.link(col_from)
+
+        parent_layer = self.root_layer_col if col_to == self.scene_col else self.layer_collections.get(col_to.name)
+        if parent_layer is not None and col_from.name not in self.layer_collections:
+            self.__map_layer_collections(parent_layer.children[col_from.name])
+
+    def set_active(self, col_name):
+        layer_col = self.layer_collections.get(col_name)
+        if layer_col:
+            bpy.context.view_layer.active_layer_collection = layer_col
+        else:
+            print ('Collection ' + col_name + ' not found')
+            return False
 
 def create_get_collection(col_name):
-    found = False
-    for c in bpy.data.collections:
-        if c.name == col_name:
-            found = True
-            return c
-    if not found:
+    c = bpy.data.collections.get(col_name)
+    if c is None:
         c = bpy.data.collections.new(col_name)
         bpy.context.scene.collection.children.link(c)
-        return c
+    return c
 
 def recur_layer_collection(layer_col, col_name):
     found = None
@@ -33,8 +87,42 @@ def set_active_collection(col_name):
         return False
 
 def link_col_to_col(col_from, col_to):
-    bpy.context.scene.collection.children.unlink(col_from)
-    col_to.children.link(col_from)
+    if col_from.name in bpy.context.scene.collection.children:
+        bpy.context.scene.collection.children.unlink(col_from)
+    if col_from.name not in col_to.children:
+        col_to.children.link(col_from)
+
+def collect_map_ids(map_name):
+    # Gather every ID a map's collections own: collections, objects, and the meshes, materials and
+    # images that aren't used by anything outside of the map
+    cols = set(c for c in bpy.data.collections if c.name.startswith(map_name))
+    root_col = bpy.data.collections.get(map_name)
+    if root_col is not None:
+        cols.update(root_col.children_recursive) # City model and prop template collections aren't prefixed
+
+    objs = set()
+    for col in cols:
+        objs.update(col.all_objects)
+
+    owned = cols | objs
+
+    def add_unshared(candidates):
+        # Add candidates whose users are all owned by the map already
+        candidates = set(candidates)
+        if not candidates:
+            return set()
+        user_map = bpy.data.user_map(subset=candidates)
+        found = set(c for c in candidates if user_map[c] <= owned)
+        owned.update(found)
+        return found
+
+    meshes = add_unshared(o.data for o in objs if isinstance(o.data, bpy.types.Mesh))
+    materials = add_unshared(m for me in meshes for m in me.materials if m is not None)
+    owned.update(m.node_tree for m in materials if m.node_tree is not None) # Embedded, counts as a user of images
+    add_unshared(n.image for m in materials if m.node_tree is not None
+                 for n in m.node_tree.nodes if n.type == 'TEX_IMAGE' and n.image is not None)
+
+    return set(i for i in owned if not isinstance(i, bpy.types.NodeTree))
 
 def select_obj(o):
     o.select_set(True)
@@ -47,10 +135,6 @@ def round_vector3(vector3):
     x, y, z = vector3
     return (round_float(x), round_float(y), round_float(z))
 
-def translate_vector3(vector3):
-    x, y, z = vector3
-    return (-x, z, y)
-
 def vector3_to_string(vector3, separator):
     x, y, z = vector3
     return '%.6f' % x + separator + '%.6f' % y + separator + '%.6f' % z
@@ -61,25 +145,58 @@ def translate_uv(uv):
 def bytes_to_int(bytes) -> int:
     return int.from_bytes(bytes, byteorder='little')
 
-def write_file(filepath, content):
-    with open (filepath, 'w') as file:
-        for l in content:
-            file.write("%s" % l)
-
-def calc_emin_emax(col_inst):
+def write_file(filepath, content, sync_dirs = None):
+    # One buffered write per file, renamed into place. Written untranslated, exported text has the line endings of its source
+    atomic_write(filepath, ''.join(content), sync_dirs = sync_dirs, newline = '')
+
+_written_hashes = {} # File path -> (size, mtime, hash) of the last exported text
+
+def write_file_if_changed(filepath, content, backup = None, sync_dirs = None):
+    # Skip writing, and backing up, files whose exported text is the same as what's on disk.
+    # backup is the backup_store.BackupRun of the export, the file is backed up before it's overwritten
+    text = ''.join(content)
+    digest = hashlib.sha1(text.encode()).hexdigest()
+
+    if os.path.exists(filepath):
+        st = os.stat(filepath)
+        if _written_hashes.get(filepath) == (st.st_size, st.st_mtime_ns, digest):
+            return False
+        with open(filepath, 'r', errors='replace', newline='') as file:
+            if hashlib.sha1(file.read().encode()).hexdigest() == digest:
+                _written_hashes[filepath] = (st.st_size, st.st_mtime_ns, digest)
+                return False
+        if backup is not None:
+            backup.add(filepath)
+
+    write_file(filepath, [text], sync_dirs)
+    st = os.stat(filepath)
+    _written_hashes[filepath] = (st.st_size, st.st_mtime_ns, digest)
+    return True
+
+def calc_emin_emax(col_inst, verts_cache = None):
     # Calculate extents bounding box of a collection instance,
     # returns emin = upper left bottom corner, emax = lower right top corner,
     # assuming blender orientation x - left, y - bottom, z - top.
+    # verts_cache (collection name -> verts) lets an export evaluate every instanced collection only once
+
+    # Always measure the highest detail model, instances may currently show a lower lod
+    instance_col = col_inst.instance_collection
+    if 'mc2_lod_base' in instance_col:
+        instance_col = bpy.data.collections.get(instance_col['mc2_lod_base'], instance_col)
+
+    verts = verts_cache.get(instance_col.name) if verts_cache is not None else None
+    if verts is None:
+        verts = []
+        depsgraph = bpy.context.evaluated_depsgraph_get()
 
-    inst = bpy.context.active_object
-    verts = []
-    depsgraph = bpy.context.evaluated_depsgraph_get() # Can this be reused?
+        for obj in instance_col.all_objects:
+            eval_obj = obj.evaluated_get(depsgraph)
+            mesh = eval_obj.to_mesh()
+            verts.extend([eval_obj.matrix_world @ v.co for v in mesh.vertices])
+            eval_obj.to_mesh_clear() # ?
 
-    for obj in col_inst.instance_collection.all_objects:
-        eval_obj = obj.evaluated_get(depsgraph)
-        mesh = eval_obj.to_mesh()
-        verts.extend([eval_obj.matrix_world @ v.co for v in mesh.vertices])
-        eval_obj.to_mesh_clear() # ?
+        if verts_cache is not None:
+            verts_cache[instance_col.name] = verts
 
     verts_world = ([col_inst.matrix_world @ v for v in verts])
     try:
@@ -95,86 +212,67 @@ def calc_emin_emax(col_inst):
         print(col_inst.name)
         return (0, 0, 0), (0, 0, 0) # Janky shi
 
+# Coordinate space conversion to Matrix34, built once instead of per exported object
+MATRIX34_ROT = mathutils.Matrix.Rotation(math.radians(-180.0), 4, 'Y') @ mathutils.Matrix.Rotation(math.radians(-90.0), 4, 'X')
+MATRIX34_CONVERT = axis_conversion(from_forward='-Y', 
+    from_up='Z',
+    to_forward='-Z',
+    to_up='Y').to_4x4()
+
 def to_matrix34(matrix): # convert_to_matrix34?
     matrix = matrix.copy()
 
     # Convert coordinate space
-    mat_rot = mathutils.Matrix.Rotation(math.radians(-180.0), 4, 'Y') @ mathutils.Matrix.Rotation(math.radians(-90.0), 4, 'X')
-    matrix @= mat_rot
-
-    mtx_convert = axis_conversion(from_forward='-Y', 
-        from_up='Z',
-        to_forward='-Z',
-        to_up='Y').to_4x4()
-    matrix = mtx_convert @ matrix
+    matrix @= MATRIX34_ROT
+    matrix = MATRIX34_CONVERT @ matrix
     # Shuffle elements into correct spots here?
     return matrix
 
-def get_last_dir():
-    parent_dir = os.path.dirname(__file__)
-    globals_path = os.path.join(parent_dir, 'globals.py')
-    last_dir = ''
-
-    if os.path.exists(globals_path):
-        with open(globals_path, 'r') as file:
-            lines = file.read().splitlines()
-            for l_idx, l in enumerate(lines):
-                 if l.startswith('mc2_dir'):
-                     last_dir = l.rsplit("=")[1].strip()[1:-1]
-                     return last_dir
-    else: return ''
-
-def get_last_map_name():
-    parent_dir = os.path.dirname(__file__)
-    globals_path = os.path.join(parent_dir, 'globals.py')
-    map_name = ''
-
-    if os.path.exists(globals_path):
-        with open(globals_path, 'r') as file:
-            lines = file.read().splitlines()
-            for l_idx, l in enumerate(lines):
-                 if l.startswith('map_name'):
-                     map_name = l.rsplit("=")[1].strip()[1:-1]
-                     return map_name
-    else: return ''
-
-def validate_mc2_dir(path: str) -> (bool, str):
-    if not path:
-        return False, 'No path set'
-    if not os.path.isdir(path):
-        return False, 'Directory does not exist'
-
-    unique_folders = ['anim', 'bound', 'fonts', 'geometry', 'model', 'tune'] # Folders unique to assets_p
-    for f in unique_folders:
-        if f not in os.listdir(path):
-            return False, 'Assets not extracted'
-    return True, ''
-
-def make_backup(fp):
-    dir, file = os.path.split(fp)
-    backup_dest = os.path.join(dir, 'backup')
-    backup_file_dest = os.path.join(backup_dest, file)
-
-    if not os.path.exists(backup_file_dest): # Don't create a backup if it already exists
-        # Create directory if it doesn't exist yet
-        if not os.path.exists(backup_dest):
-            os.makedirs(backup_dest)
-        
-        shutil.copyfile(fp, backup_file_dest)
-
-def load_texture_from_path(file_path):
+# Coordinate space conversion from Matrix34
+MATRIX34_INV_CONVERT = axis_conversion(from_forward='-Z',
+    from_up='Y',
+    to_forward='-Y',
+    to_up='Z').to_4x4()
+MATRIX34_INV_ROT = mathutils.Matrix.Rotation(math.radians(90), 4, 'X') @ mathutils.Matrix.Rotation(math.radians(180), 4, 'Y')
+
+def from_matrix34(values):
+    # Blender world matrix of the 4 flattened Matrix34 rows (3 rotation rows and translation) of a game file
+    col1 = [values[0], values[3], values[6], values[9]]
+    col2 = [values[1], values[4], values[7], values[10]]
+    col3 = [values[2], values[5], values[8], values[11]]
+
+    mtx = mathutils.Matrix((col1, col2, col3)).to_4x4()
+    mtx = MATRIX34_INV_CONVERT @ mtx
+    mtx @= MATRIX34_INV_ROT
+    return mtx
+
+def matrix34_values(matrix):
+    # The 4 Matrix34 rows (3 rotation rows and translation) of a converted matrix, flattened
+    return (matrix[0][0], matrix[1][0], matrix[2][0],
+            matrix[0][1], matrix[1][1], matrix[2][1],
+            matrix[0][2], matrix[1][2], matrix[2][2],
+            matrix[0][3], matrix[1][3], matrix[2][3])
+
+def load_texture_from_path(file_path, mip_level = 0):
     from .tex_file import TEXFile
     
     # extract the filename for manual image format names
     image_name= os.path.splitext(os.path.basename(file_path))[0]   
     if file_path.lower().endswith(".tex"):
-        tf = TEXFile(file_path)
+        with stage('texture.read', file_path):
+            tf = TEXFile(file_path)
         if tf.is_valid():
+            mip_level = tf.strip_mips(mip_level) # Smaller mip for preview imports
             if tf.is_compressed_format():
-                tf.decompress()
-            tf_img = tf.to_blender_image(image_name)
+                with stage('texture.decompress', file_path):
+                    tf.decompress()
+            with stage('texture.to_image', file_path):
+                tf_img = tf.to_blender_image(image_name)
+            count('texture.files')
+            count('texture.pixels', tf.width * tf.height)
             tf_img.filepath_raw = file_path # set filepath manually for TEX stuff, since it didn't come from an actual file import
             tf_img.alpha_mode = 'CHANNEL_PACKED' # Doesn't always work, especially for letter decal meshes
+            tf_img['mc2_mip_level'] = mip_level
             return tf_img
         else:
             print("Invalid TEX file: " + file_path)
@@ -184,21 +282,52 @@ def load_texture_from_path(file_path):
         
     return None
 
+def reload_texture(image, file_path):
+    # Decode a .tex file again at full resolution into an existing image, so materials using it stay intact
+    from .tex_file import TEXFile
+    from .texture_stream import discard_texture
+    discard_texture(image) # A background decode still on its way would be the preview mip
+    if 'mc2_evicted' in image:
+        del image['mc2_evicted'] # Full size again, the texture budget evicts it anew when needed
+
+    if not file_exists(file_path):
+        print('Tex file not found: ' + file_path)
+        return False
+
+    try:
+        tf = TEXFile(file_path)
+        if not tf.is_valid():
+            print("Invalid TEX file: " + file_path)
+            return False
+        if tf.is_compressed_format():
+            tf.decompress()
+        tf.fill_blender_image(image)
+    except:
+        print('Tex file reload failed: ' + file_path)
+        return False
+
+    image['mc2_mip_level'] = 0
+    return True
+
 def image_load_placeholder(name, path):
     image = bpy.data.images.new(name, 128, 128)
     image.filepath_raw = path
     return image
         
-def try_load_texture(tex_name, search_path):
+def try_load_texture(tex_name, search_path, mip_level = 0, background = False):
     existing_image = bpy.data.images.get(tex_name)
     if existing_image is not None:
         return existing_image
 
     bl_img = None
-    fp = os.path.join(search_path, tex_name + ".tex")
-    if os.path.exists(fp):
+    fp = find_file(os.path.join(search_path, tex_name + ".tex"))
+    if fp is not None and background:
+        # Placeholder now, decoded pixels get swapped in by texture_stream
+        from .texture_stream import create_placeholder
+        bl_img = create_placeholder(tex_name, fp, mip_level)
+    elif fp is not None:
         try:
-            bl_img = load_texture_from_path(fp)
+            bl_img = load_texture_from_path(fp, mip_level)
         except:
             print('Tex file load failed, creating placeholder: ' + tex_name)
             bl_img = image_load_placeholder(tex_name, fp)
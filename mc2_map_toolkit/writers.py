@@ -0,0 +1,41 @@
+# Text templates of .hood and .prop blocks. formats.py serializes every new or edited block
+# with one preformatted template instead of writing it line by line
+
+HOOD_HEADER_TEMPLATE = 'name: %s\nnum_unique_components: %d\nnum_instance_components: %d\n'
+
+UNIQUE_TEMPLATE = 'unique_component %d {\n\tname: %s\n\temin %.6f %.6f %.6f\n\temax %.6f %.6f %.6f\n}\n'
+
+INSTANCE_HEADER_TEMPLATE = 'instance_component %d {\n\ttype: %s\n\towner: %s\n\textension: %s\n'
+INSTANCE_VALUES_TEMPLATE = '\t%.6f\t%.6f\t%.6f\n' * 4 + '\temin %.6f %.6f %.6f\n\temax %.6f %.6f %.6f\n}\n'
+
+PROP_HEADER_TEMPLATE = 'prop_count: %d\nfixed_prop_count: %d\ngfx_prop_count: %d\nnum_prop_types: %d\n'
+
+PROP_TEMPLATE_PART_TEMPLATE = '\tpart %d {\n\t\tname: %s\n\t\toffset: %.6f\t%.6f\t%.6f \n\t}\n'
+PROP_TEMPLATE_FLAGS_TEMPLATE = '\tFixedObject: %s\n\tObstacle: %s\n\tGfxOnly: %s\n\tDrivable: %s\n\tFar: %s\n}\n'
+
+PROP_BEGIN_TEMPLATE = 'prop %s {\n\tmatrix {\n'
+PROP_VALUES_TEMPLATE = '\t\t%.6f\t%.6f\t%.6f \n' * 4 + '\t\t}\n'
+
+def format_rounded(template, values):
+    # Same output as formatting utils.round_vector3 values: round() and %.6f both round the exact value
+    # to 6 decimals, the only difference is round_vector3 writing -0.0 as 0.0
+    return (template % values).replace('-0.000000', '0.000000')
+
+def format_unique(idx, name, emin, emax):
+    # Unique extents are written unrounded
+    return UNIQUE_TEMPLATE % ((idx, name) + tuple(emin) + tuple(emax))
+
+def format_instance(idx, inst_type, owner, extension, values, emin, emax):
+    # values: the 4 Matrix34 rows flattened
+    return (INSTANCE_HEADER_TEMPLATE % (idx, inst_type, owner, extension) +
+            format_rounded(INSTANCE_VALUES_TEMPLATE, (*values, *emin, *emax)))
+
+def format_prop_template(name, animation, parts, fixedobject, obstacle, gfxonly, drivable, far):
+    # parts: (name, offset), offsets in game space
+    text = 'prop_template %s {\n\tanimation: %s\n\tnumparts: %d\n' % (name, animation, len(parts))
+    text += ''.join(PROP_TEMPLATE_PART_TEMPLATE % ((idx + 1, part_name) + tuple(offset)) for idx, (part_name, offset) in enumerate(parts))
+    return text + PROP_TEMPLATE_FLAGS_TEMPLATE % (fixedobject, obstacle, gfxonly, drivable, far)
+
+def format_prop(prop_id, values, template):
+    return (PROP_BEGIN_TEMPLATE % prop_id + format_rounded(PROP_VALUES_TEMPLATE, tuple(values)) +
+            '\t\tprop_template: %s\n}\n' % template)
@@ -0,0 +1,215 @@
+import os
+from .lexer import tokenize, to_floats, to_ints
+
+# Bpy-free .xmod and .xbcpv readers, shared by the blender importer and the command line converter.
+# Vectors and uvs are kept in game space, importers translate them
+
+class ModMaterial:
+    def __init__(self):
+        self.name = None
+        self.packet_count = 0
+        self.primitive_count = 0
+        self.texture_count = 0
+        self.illum = None
+        self.ambient = (0.0, 0.0, 0.0)
+        self.diffuse = (1.0, 1.0, 1.0)
+        self.specular = (0.0, 0.0, 0.0)
+        self.textures = []
+        self.material = None
+        self.packets = []
+
+class ModPacket:
+    def __init__(self):
+        self.num_adjs = 0
+        self.num_prims = 0
+        self.adjuncts = []
+        self.primitives = []
+
+class ModModel:
+    def __init__(self, name):
+        self.name = name
+        self.verts = []
+        self.normals = []
+        self.colors = []
+        self.tex1s = []
+        self.materials = [] # Textured materials first, see read_xmod
+        self.cpv_id_offsets = []
+
+def triangle_strip_to_list(strip, clockwise):
+    triangle_list = []
+    for v in range(len(strip) - 2):
+        if clockwise:
+            triangle_list.extend([strip[v+1], strip[v], strip[v+2]])
+        else:
+            triangle_list.extend([strip[v], strip[v+1], strip[v+2]])
+        clockwise = not clockwise
+
+    return triangle_list
+
+def parse_primitive_tri(prim_type, indices):
+    indices_ints = [int(x) for x in indices]
+    triangles = None
+
+    if prim_type == 'tri':
+        triangles = indices_ints
+    elif prim_type == 'str':
+        indices_ints = indices_ints[1:]
+        triangles = triangle_strip_to_list(indices_ints, False)
+    elif prim_type == 'stp':
+        indices_ints = indices_ints[1:]
+        triangles = triangle_strip_to_list(indices_ints, True)
+    else:
+        raise Exception(f'Invalid primitive type {prim_type}')
+
+    return triangles
+
+def parse_xmod(name, text):
+    model = ModModel(name)
+    tokens = list(tokenize(text.splitlines()))
+    mod_materials = []
+    mod_packets = []
+
+    # Read and parse file tokens
+    for t_idx, (l_idx, key, values, depth) in enumerate(tokens):
+        if key == 'v': # Read and add verts
+            model.verts.append(to_floats(values[:3]))
+
+        elif key == 'n': # Read normals
+            model.normals.append(to_floats(values[:3]))
+
+        elif key == 'c': # Read colors
+            model.colors.append(to_floats(values[:4]))
+
+        elif key == 't1': # Read UVs
+            model.tex1s.append(to_floats(values[:2]))
+
+        elif key.startswith('mtl'): # Read materials
+            mod_mat = ModMaterial()
+            mod_mat.name = values[0]
+
+            # Read material block until it closes
+            for b_idx in range(t_idx + 1, len(tokens)):
+                b_l_idx, b_key, b_values, b_depth = tokens[b_idx]
+                if b_key.startswith('}'): break
+                if b_key.startswith('packets:'): mod_mat.packet_count = int(b_values[0])
+                if b_key.startswith('primitives:'): mod_mat.primitive_count = int(b_values[0])
+                if b_key.startswith('textures:'): mod_mat.texture_count = int(b_values[0])
+                if b_key.startswith('illum:'): mod_mat.illum = b_values[0]
+                if b_key.startswith('ambient:'): mod_mat.ambient = to_floats(b_values[:3])
+                if b_key.startswith('diffuse:'): mod_mat.diffuse = to_floats(b_values[:3])
+                if b_key.startswith('specular:'): mod_mat.specular = to_floats(b_values[:3])
+
+                # Add all textures into an array, however only the first one will be used
+                if b_key.startswith('texture:'):
+                    texture_name = b_values[1]
+                    texture_name = texture_name[1:][:-1] # Removes parentheses
+                    mod_mat.textures.append(texture_name)
+
+            mod_materials.append(mod_mat)
+
+        # Read packets
+        elif key == 'packet':
+            mod_packet = ModPacket()
+            mod_packet.num_adjs = int(values[0])
+            mod_packet.num_prims = int(values[1])
+
+            # Adjunct format: vidx, nidx, cidx, u1idx, u2idx, mtx, the used indices are converted to ints once here
+            idx = t_idx + 1
+            mod_packet.adjuncts = [to_ints(t[2][:4]) for t in tokens[idx:idx + mod_packet.num_adjs]]
+            idx += mod_packet.num_adjs
+            mod_packet.primitives = [(t[1], t[2]) for t in tokens[idx:idx + mod_packet.num_prims]] # ('str', ['4', '0', '1', '2', '3'])
+
+            mod_packets.append(mod_packet)
+
+    # Associate packets to materials
+    packet_idx = 0
+    for mod_mat in mod_materials:
+        for packet in range(mod_mat.packet_count):
+            mod_mat.packets.append(mod_packets[packet_idx])
+            packet_idx += 1
+
+    # Place materials without textures last, so if there are duplicate/faulty faces, the textured ones get priority
+    solid_mats = [] # Temp list used to place solid materials at the end
+
+    cpv_id_offsets = [] # List of offsets, used when placing solid/textureless materials at the end, so that the xbcpv file later on knows about these offsets
+    solid_mat_adj_ctr = 0
+
+    for mod_mat in mod_materials:
+        if mod_mat.texture_count == 0:
+            for packet in mod_mat.packets:
+                solid_mat_adj_ctr += packet.num_adjs
+            solid_mats.append(mod_mat)
+            mod_materials.remove(mod_mat) # Remove solid material from this spot
+        cpv_id_offsets.append(solid_mat_adj_ctr) # Note the total offset for this material
+    mod_materials.extend(solid_mats) # Re-add solid material at the end
+
+    model.materials = mod_materials
+    model.cpv_id_offsets = cpv_id_offsets
+    return model
+
+def read_xmod(filepath):
+    name = os.path.splitext(os.path.basename(filepath))[0]
+    with open(filepath, 'r') as file:
+        return parse_xmod(name, file.read())
+
+def iter_material_triangles(model, mod_mat, tris_check, adj_offset = 0):
+    # Yields (cpv ids, adjuncts) of every valid triangle of a material, adjuncts being the (vidx, nidx, cidx, u1idx)
+    # of its corners and cpv ids counting on from adj_offset. tris_check holds the sorted vertex indices of the
+    # model's triangles so far, duplicate and degenerate triangles are skipped
+    for packet in mod_mat.packets:
+        for prim_type, prim_indices in packet.primitives:
+            adj_indices = parse_primitive_tri(prim_type, prim_indices) # [0, 1, 2, 2, 1, 3]
+
+            for y in range(0, len(adj_indices), 3): # Executes twice if it's 4 numbers for example
+                adj_tri = adj_indices[y:y+3] # [0, 1, 2], then [2, 1, 3]
+                adjuncts = [packet.adjuncts[adj_idx] for adj_idx in adj_tri]
+
+                # Mesh integrity checks
+                tri_verts = [adjunct[0] for adjunct in adjuncts]
+                tri_verts_sorted = tuple(sorted(tri_verts))
+                if tri_verts_sorted in tris_check or tri_verts[0] == tri_verts[1]:
+                    print('Skipping faulty primitive on', model.name, tri_verts)
+                    continue # Skip this primitive
+                tris_check.add(tri_verts_sorted)
+
+                yield [x + adj_offset for x in adj_tri], adjuncts # IDs get reset per packet, we keep track of total adjunct count here
+
+        adj_offset += packet.num_adjs
+
+def order_cpv_ids(model, xbcpv_id_lists):
+    # One cpv id list per material to the face corner order of the xbcpv file, which doesn't know about solid
+    # materials being placed last
+    xbcpv_id_lists = list(xbcpv_id_lists)
+    for mat_idx in range(len(xbcpv_id_lists)):
+        if model.materials[mat_idx].texture_count == 0:
+            textureless_cpvs = xbcpv_id_lists[mat_idx]
+            xbcpv_id_lists.pop(mat_idx)
+            xbcpv_id_lists.append(textureless_cpvs)
+        else:
+            # For example, if the first material is solid/textureless, and has 4 adjuncts,
+            # the material gets moved to the end of the materials list, because we prioritize textured materials first,
+            # but the xbcpv file doesn't know about this,
+            # this will give the following IDs an additional offset of 4 to make up for this,
+            # which is important for the IDs found in the xbcpv file.
+            temp_list = xbcpv_id_lists[mat_idx]
+            xbcpv_id_lists[mat_idx] = [x + model.cpv_id_offsets[mat_idx] for x in temp_list]
+
+    # Make the CPV IDs a single array, instead of a list of arrays
+    return [x for id_list in xbcpv_id_lists for x in id_list]
+
+def read_xbcpv(filepath):
+    # RGBA float colors of every adjunct, in file order
+    with open(filepath, 'rb') as f:
+        data = f.read()
+
+    mat_count = int.from_bytes(data[4:8], 'little')
+    cpvs = []
+    offset = 8
+    for mat_idx in range(mat_count):
+        adj_count = int.from_bytes(data[offset:offset + 4], 'little')
+        offset += 4
+        for cpv in range(adj_count):
+            b, g, r, a = data[offset:offset + 4]
+            cpvs.append((r / 255, g / 255, b / 255, a / 255)) # BGRA to RBGA
+            offset += 4
+    return cpvs